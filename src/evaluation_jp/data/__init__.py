@@ -1,4 +1,16 @@
-from ._model_data_handler import ModelDataHandler, datetime_cols, sql_clause_format
+from ._model_data_handler import (
+    ModelDataHandler,
+    datetime_cols,
+    sql_clause_format,
+    table_columns,
+)
 from .external._cso_statbank_data import cso_statbank_data
 from ._metadata_helpers import nearest_lr_date, lr_reporting_date
+from ._ists_snapshots import (
+    set_ists_snapshot_dir,
+    write_ists_snapshots,
+    read_ists_snapshot,
+)
+from ._arrow_sql import read_sql_arrow, set_arrow_reads, arrow_reads
+from ._source_fetcher import Source, SourceFetcher, fetch_source, source_fetching
 from ._import_helpers import *
@@ -0,0 +1,176 @@
+# %%
+# Standard library
+from typing import Dict, Iterator, List, Optional, Union
+
+# External packages
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Local packages
+from evaluation_jp.data import table_columns
+
+# Text columns that are (nearly) unique per record, so not worth dictionary-encoding
+PLAIN_TEXT_COLS = ["ppsn", "RSI_NO"]
+
+# Off by default: Arrow reads give categorical text columns, where callers written
+# against pd.read_sql() expect object columns
+_arrow_reads = False
+
+
+def set_arrow_reads(enabled: bool):
+    """Turn Arrow reads in get_{data}() helpers on or off (off by default)"""
+    global _arrow_reads
+    _arrow_reads = enabled
+
+
+def arrow_reads() -> bool:
+    """Return True if get_{data}() helpers should read through read_sql_arrow()"""
+    return pa is not None and _arrow_reads
+
+
+def arrow_types(engine, table_names: List[str]) -> Dict:
+    """Return Arrow type for each column in `table_names`
+    Numbers are int64 or float64, dates and datetimes date32, and text a string
+    dictionary, except for PLAIN_TEXT_COLS. Where tables share a column name, the
+    first table's type is used.
+    """
+    types = {}
+    for table_name in table_names:
+        for col in table_columns(engine, table_name):
+            if col["name"] in types:
+                continue
+            sa_type = col["type"]
+            if isinstance(sa_type, (sa.types.Date, sa.types.DateTime)):
+                types[col["name"]] = pa.date32()
+            elif isinstance(sa_type, (sa.types.Float, sa.types.Numeric)):
+                types[col["name"]] = pa.float64()
+            elif isinstance(sa_type, (sa.types.Integer, sa.types.Boolean)):
+                types[col["name"]] = pa.int64()
+            elif isinstance(sa_type, sa.types.String):
+                if col["name"] in PLAIN_TEXT_COLS:
+                    types[col["name"]] = pa.string()
+                else:
+                    types[col["name"]] = pa.dictionary(pa.int32(), pa.string())
+    return types
+
+
+def _to_arrow(values: np.ndarray, arrow_type) -> "pa.Array":
+    """Return Arrow array of `arrow_type` from object array of SQLite `values`
+    Falls back to an inferred type (or text) if values don't fit `arrow_type`, as
+    SQLite doesn't enforce column types.
+    """
+    try:
+        if arrow_type is None:
+            return pa.array(values, from_pandas=True)
+        if arrow_type == pa.date32():
+            datetimes = pd.to_datetime(values)
+            if (datetimes.dropna() != datetimes.dropna().normalize()).any():
+                # Keep times rather than truncate them
+                return pa.array(datetimes, from_pandas=True)
+            return pa.array(
+                datetimes.values.astype("datetime64[D]"),
+                mask=np.asarray(datetimes.isna()),
+                type=pa.date32(),
+            )
+        if pa.types.is_dictionary(arrow_type):
+            strings = pa.array(values, type=pa.string(), from_pandas=True)
+            return strings.dictionary_encode()
+        return pa.array(values, type=arrow_type, from_pandas=True)
+    except (pa.ArrowException, TypeError, ValueError):
+        try:
+            return pa.array(values, from_pandas=True)
+        except (pa.ArrowException, TypeError, ValueError):
+            mask = pd.isna(values)
+            return pa.array(values.astype(str), mask=mask, type=pa.string())
+
+
+def read_arrow_batches(
+    query, con, types: Dict, params: Optional[Dict] = None, batch_size: int = 100_000
+) -> Iterator["pa.RecordBatch"]:
+    """Yield results of `query` as Arrow record batches of up to `batch_size` rows
+
+    Rows are fetched from the DB-API cursor underneath `con`, bypassing SQLAlchemy
+    row processing, then each column is converted to its type in `types` (columns
+    not in `types` get an inferred type) in one go.
+    """
+    if isinstance(query, str):
+        query = sa.sql.text(query)
+    result = con.execute(query, **(params or {}))
+    cursor = result.cursor
+    names = [description[0] for description in cursor.description]
+    empty = True
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            empty = False
+            values = np.empty((len(rows), len(names)), dtype=object)
+            values[:] = rows
+            yield pa.RecordBatch.from_arrays(
+                [
+                    _to_arrow(values[:, i], types.get(name))
+                    for i, name in enumerate(names)
+                ],
+                names,
+            )
+    finally:
+        result.close()
+    if empty:
+        # Still give columns their types
+        yield pa.RecordBatch.from_arrays(
+            [
+                _to_arrow(np.array([], dtype=object), types.get(name, pa.null()))
+                for name in names
+            ],
+            names,
+        )
+
+
+def arrow_to_pandas(data: Union["pa.Table", "pa.RecordBatch"]) -> pd.DataFrame:
+    """Convert Arrow `data` to pandas, with dates as datetime64[ns] and dictionaries
+    as categoricals. Numeric columns without nulls are converted without copying
+    where Arrow allows it.
+    """
+    return data.to_pandas(date_as_object=False, split_blocks=True)
+
+
+def read_sql_arrow(
+    query,
+    con,
+    engine,
+    table_names: List[str],
+    params: Optional[Dict] = None,
+    chunksize: Optional[int] = None,
+    batch_size: int = 100_000,
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+    """
+    Return results of `query` on `table_names` as dataframe, read through Arrow
+
+    Replacement for pd.read_sql(query, con, params, parse_dates, chunksize) that
+    builds typed Arrow batches straight from the database cursor, rather than
+    building Python records then re-parsing dates. Column types come from the
+    `table_names` schemas (see arrow_types()): date and datetime columns come back
+    as datetime64[ns] and text code columns as categoricals.
+
+    If `chunksize` is given, return an iterator of dataframes with `chunksize` rows.
+    """
+    types = arrow_types(engine, table_names)
+    if chunksize is not None:
+        return (
+            arrow_to_pandas(batch)
+            for batch in read_arrow_batches(query, con, types, params, chunksize)
+        )
+    batches = list(read_arrow_batches(query, con, types, params, batch_size))
+    if any(not batch.schema.equals(batches[0].schema) for batch in batches):
+        # Batches inferred different types for some column
+        return pd.concat(
+            [arrow_to_pandas(batch) for batch in batches], ignore_index=True
+        )
+    return arrow_to_pandas(pa.Table.from_batches(batches))
@@ -1,45 +1,300 @@
 # %%
-from typing import List, Set, Dict, Tuple, Optional
+from typing import Iterator, List, Set, Dict, Tuple, Optional, Union
 from contextlib import contextmanager
+import os
+from urllib.request import pathname2url
 
 import numpy as np
 import pandas as pd
 
 import sqlalchemy as sa
 
-from evaluation_jp.data import nearest_lr_date, datetime_cols, sql_clause_format
+from evaluation_jp.data import (
+    nearest_lr_date,
+    datetime_cols,
+    read_ists_snapshot,
+    table_columns,
+    arrow_reads,
+    read_sql_arrow,
+)
 
 
-engine = sa.create_engine(
-    "sqlite:///\\\\cskma0294\\F\\Evaluations\\data\\wwld.db", echo=False
-)
+SOURCE_DB_ENV_VAR = "EVALUATION_JP_SOURCE_DB"
+DEFAULT_SOURCE_DB = "\\\\cskma0294\\F\\Evaluations\\data\\wwld.db"
+ISTS_PARTITIONS_ENV_VAR = "EVALUATION_JP_ISTS_PARTITIONS"
+# Partition directory looked for next to the source database if none is given
+ISTS_PARTITIONS_DIRNAME = "ists_partitions"
+# SQLite's default limit on databases attached to one connection
+MAX_ATTACHED = 10
+
+_engine = None
+
+
+def create_source_engine(
+    database: Optional[str] = None,
+    read_only: bool = True,
+    immutable: bool = False,
+    mmap_size: Optional[int] = None,
+    pool_size: int = 2,
+    ists_partition_dir: Optional[str] = None,
+) -> sa.engine.base.Engine:
+    """
+    Create engine for the source (WWLD) database
+
+    Parameters
+    ----------
+    database: Optional[str] = None
+        SQLite database file or full SQLAlchemy URL. Default is the
+        EVALUATION_JP_SOURCE_DB environment variable if set, else DEFAULT_SOURCE_DB.
+
+    read_only: bool = True
+        If True, open SQLite file with mode=ro. Temp tables still work.
+
+    immutable: bool = False
+        If True, open SQLite file with immutable=1, which skips all locking and
+        change detection. Only safe if nothing writes to the file during the run,
+        e.g. a local copy used for analysis.
+
+    mmap_size: Optional[int] = None
+        If set, PRAGMA mmap_size (in bytes) for each new connection
+
+    pool_size: int = 2
+        Number of connections kept open by the pool
+
+    ists_partition_dir: Optional[str] = None
+        Directory of ists_claims_YYYY.db partition files written by the ETL. Default
+        is the EVALUATION_JP_ISTS_PARTITIONS environment variable if set, else the
+        ists_partitions directory next to the database if there is one.
+        Connections read ists_claims through a temp view of the main table plus
+        attached partition files (see attach_ists_years()), opened read-only, and
+        also immutable for years the ETL has frozen. If the ETL has recorded
+        partitions that aren't in the directory, connecting fails with a ValueError
+        rather than reading claims from the main table alone.
+
+    Returns
+    -------
+    engine: sa.engine.base.Engine
+    """
+    database = database or os.environ.get(SOURCE_DB_ENV_VAR, DEFAULT_SOURCE_DB)
+    if "://" in database:
+        return sa.create_engine(database, echo=False)
+
+    if ists_partition_dir is None:
+        ists_partition_dir = os.environ.get(ISTS_PARTITIONS_ENV_VAR)
+    if ists_partition_dir is None:
+        sibling = os.path.join(
+            os.path.dirname(os.path.abspath(database)), ISTS_PARTITIONS_DIRNAME
+        )
+        if os.path.isdir(sibling):
+            ists_partition_dir = sibling
+
+    flags = {"mode": "ro" if read_only else "rw"}
+    if immutable:
+        flags["immutable"] = 1
+    query = "&".join(f"{key}={value}" for key, value in flags.items())
+    uri = f"file:{pathname2url(os.path.abspath(database))}?{query}&uri=true"
+    engine = sa.create_engine(
+        f"sqlite:///{uri}",
+        echo=False,
+        poolclass=sa.pool.QueuePool,
+        # Pooled connections can be checked out by any thread, e.g. SourceFetcher's
+        connect_args={"check_same_thread": False},
+        pool_size=pool_size,
+        max_overflow=pool_size,
+    )
+    if mmap_size is not None:
+
+        @sa.event.listens_for(engine, "connect")
+        def set_mmap_size(dbapi_connection, connection_record):
+            dbapi_connection.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+
+    @sa.event.listens_for(engine, "connect")
+    def attach_ists_partitions(dbapi_connection, connection_record):
+        attach_ists_partitions_to(
+            dbapi_connection, connection_record.info, ists_partition_dir
+        )
+
+    return engine
+
+
+def ists_partition_files(partition_dir: str) -> Dict[int, str]:
+    """Return {year: path} of ists_claims_YYYY.db files in `partition_dir`"""
+    files = {}
+    for name in sorted(os.listdir(partition_dir)):
+        stem, ext = os.path.splitext(name)
+        year = stem[len("ists_claims_") :]
+        if stem.startswith("ists_claims_") and ext == ".db" and year.isdigit():
+            files[int(year)] = os.path.join(partition_dir, name)
+    return files
+
+
+def ists_partition_registry(dbapi_connection) -> Dict[int, bool]:
+    """Return {year: frozen} of partition files the ETL has written, from its
+    ists_partitions table in the main database (empty if there isn't one)
+    """
+    if not dbapi_connection.execute(
+        "SELECT 1 FROM main.sqlite_master "
+        "WHERE type = 'table' AND name = 'ists_partitions'"
+    ).fetchone():
+        return {}
+    return {
+        year: bool(frozen)
+        for year, frozen in dbapi_connection.execute(
+            "SELECT year, frozen FROM main.ists_partitions"
+        )
+    }
+
+
+def ists_partition_uri(path: str, frozen: bool) -> str:
+    """Return URI to attach partition file `path` read-only, and immutable if the
+    ETL has frozen it, so nothing will write to it while it's open
+    """
+    flags = "mode=ro&immutable=1" if frozen else "mode=ro"
+    return f"file:{pathname2url(os.path.abspath(path))}?{flags}"
+
+
+def attach_ists_partitions_to(
+    dbapi_connection, info: Dict, partition_dir: Optional[str]
+):
+    """Set up SQLite `dbapi_connection` to read ISTS partition files in
+    `partition_dir`, keeping their state in `info` (its pool connection record's).
+    All the files are attached if there are at most MAX_ATTACHED of them, else
+    none are until a query asks for its years (see attach_ists_years()).
+    Raises ValueError if the ETL has recorded partitions that aren't there, as the
+    main ists_claims table alone would silently be missing their claims.
+    """
+    registry = ists_partition_registry(dbapi_connection)
+    files = ists_partition_files(partition_dir) if partition_dir else {}
+    missing = sorted(set(registry) - set(files))
+    if missing:
+        raise ValueError(
+            f"ISTS claims for {missing} are in partition files, but they aren't in "
+            f"{partition_dir or 'a partition directory'}. Pass ists_partition_dir or "
+            f"set {ISTS_PARTITIONS_ENV_VAR} to the ETL's partition_dir."
+        )
+    if not files:
+        return
+    frozen = {year for year, is_frozen in registry.items() if is_frozen}
+    info["ists_partitions"] = (files, frozen)
+    info["ists_years"] = []
+    if len(files) <= MAX_ATTACHED:
+        attach_ists_years(dbapi_connection, info, files)
+
+
+def attach_ists_years(dbapi_connection, info: Dict, years):
+    """Attach partition files of `years` to `dbapi_connection` as pYYYY, if they
+    aren't already, and make temp view ists_claims (shadowing main.ists_claims) of
+    main and attached partition claims.
+    Other years' files stay attached while there's room, else they're detached.
+    Raises ValueError if `years` have more files than SQLite's default limit of
+    MAX_ATTACHED attached databases.
+    """
+    files, frozen = info["ists_partitions"]
+    years = sorted(set(years) & set(files))
+    if len(years) > MAX_ATTACHED:
+        raise ValueError(
+            f"Query needs {len(years)} ISTS partition files, but SQLite can only "
+            f"attach {MAX_ATTACHED} databases to a connection"
+        )
+    attached = info["ists_years"]
+    needed = [year for year in years if year not in attached]
+    if not needed:
+        return
+    dbapi_connection.execute("DROP VIEW IF EXISTS temp.ists_claims")
+    if len(attached) + len(needed) > MAX_ATTACHED:
+        for year in attached:
+            if year not in years:
+                dbapi_connection.execute(f"DETACH DATABASE p{year}")
+        attached = [year for year in attached if year in years]
+    for year in needed:
+        uri = ists_partition_uri(files[year], year in frozen)
+        dbapi_connection.execute(f"ATTACH DATABASE ? AS p{year}", (uri,))
+    info["ists_years"] = attached = sorted(attached + needed)
+    selects = ["SELECT * FROM main.ists_claims"] + [
+        f"SELECT * FROM p{year}.ists_claims" for year in attached
+    ]
+    dbapi_connection.execute(
+        "CREATE TEMP VIEW ists_claims AS " + " UNION ALL ".join(selects)
+    )
+
+
+def use_ists_years(con: sa.engine.Connection, years):
+    """Make ists_claims on `con` include ISTS partition files of `years`, if its
+    engine reads partition files (see create_source_engine())
+    """
+    if "ists_partitions" in con.info:
+        attach_ists_years(con.connection, con.info, years)
+
+
+def set_source_engine(
+    database: Optional[str] = None, **kwargs
+) -> sa.engine.base.Engine:
+    """
+    Point all get_{data}() functions at a new source engine
+
+    Takes the same parameters as create_source_engine(). Returns the new engine.
+    """
+    global _engine
+    if _engine is not None:
+        _engine.dispose()
+    _engine = create_source_engine(database, **kwargs)
+    return _engine
+
+
+def get_engine() -> sa.engine.base.Engine:
+    """
+    Return source engine, creating it with default settings on first use
+    """
+    global _engine
+    if _engine is None:
+        _engine = create_source_engine()
+    return _engine
+
+
+def __getattr__(name):
+    # Module attribute `engine` is still available but created lazily
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 @contextmanager
-def temp_ids_con(engine: sa.engine.base.Engine, ids: set):
+def temp_ids_con(engine: sa.engine.base.Engine, ids: Optional[set] = None):
     """Create database connection that makes temp.ids available as single column temp table
-    """
 
+    temp.ids is a TEXT PRIMARY KEY table, so joins and `IN (SELECT id FROM temp.ids)`
+    filters use its index. Ids are bulk loaded with executemany and the load is
+    remembered on the pooled connection, so later calls with the same ids on the
+    same connection reuse the table instead of loading it again.
+    If `ids` is None, just yield a connection.
+    """
     with engine.connect() as con:
-        rows = ", ".join([f"({sql_clause_format(id)})" for id in ids])
-        queries = [
-            "DROP TABLE IF EXISTS temp.ids",
-            "CREATE TEMP TABLE temp.ids(id INTEGER)",
-            f"INSERT INTO temp.ids(id) VALUES {rows}",
-        ]
-        for query in queries:
-            con.execute(query)
+        if ids is not None:
+            ids = pd.unique(np.asarray(list(ids), dtype=object).astype(str))
+            # Order-independent fingerprint of the id set
+            fingerprint = (len(ids), int(pd.util.hash_array(ids).sum()))
+            if con.info.get("temp_ids_fingerprint") != fingerprint:
+                dbapi_con = con.connection
+                dbapi_con.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS ids(id TEXT PRIMARY KEY) "
+                    "WITHOUT ROWID"
+                )
+                dbapi_con.execute("DELETE FROM temp.ids")
+                dbapi_con.executemany(
+                    "INSERT INTO temp.ids(id) VALUES (?)", ((id,) for id in sorted(ids))
+                )
+                # Commit so that pool's rollback on checkin doesn't empty temp.ids
+                dbapi_con.commit()
+                con.info["temp_ids_fingerprint"] = fingerprint
         yield con
 
 
 def get_col_list(engine, table_name, columns=None, required_columns=None):
-    insp = sa.engine.reflection.Inspector.from_engine(engine)
-    column_metadata = insp.get_columns(table_name)
-    table_columns = [col["name"] for col in column_metadata]
+    column_names = [col["name"] for col in table_columns(engine, table_name)]
     if columns is not None:
-        ok_columns = (set(columns) | set(required_columns)) & set(table_columns)
+        ok_columns = (set(columns) | set(required_columns)) & set(column_names)
     else:
-        ok_columns = table_columns
+        ok_columns = column_names
     return [col for col in ok_columns if col not in ["index", "id"]]
 
 
@@ -47,19 +302,39 @@ def unpack(listlike):
     return ", ".join([str(i) for i in listlike])
 
 
-def get_parameterized_query(query_text, ids=None):
-    params = {}
-    if ids is not None:
-        query_text += f"""\
-            {"WHERE" if "WHERE" not in query_text else "AND"} ppsn in :ids
+def add_id_filter(query_text, id_col="ppsn"):
+    """Restrict `query_text` to `id_col` values in temp.ids (see temp_ids_con())"""
+    return (
+        query_text
+        + f"""\
+            {"WHERE" if "WHERE" not in query_text else "AND"} {id_col} IN (
+                SELECT id FROM temp.ids
+            )
         """
-        params["ids"] = list(set(ids))
-        query = sa.sql.text(query_text).bindparams(
-            sa.sql.expression.bindparam("ids", expanding=True)
+    )
+
+
+def read_source(
+    query,
+    con,
+    engine,
+    table_names: List[str],
+    params: Optional[Dict] = None,
+    chunksize: Optional[int] = None,
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+    """Return results of `query` on `table_names`, through read_sql_arrow() if
+    arrow_reads() is True or else through pd.read_sql() with dates parsed.
+    """
+    if arrow_reads():
+        return read_sql_arrow(
+            query, con, engine, table_names, params=params, chunksize=chunksize
         )
-    else:
-        query = query_text
-    return query, params
+    parse_dates = [
+        col for table_name in table_names for col in datetime_cols(engine, table_name)
+    ]
+    return pd.read_sql(
+        query, con=con, params=params, parse_dates=parse_dates, chunksize=chunksize
+    )
 
 
 #%%
@@ -85,22 +360,107 @@ def decode_bytestrings(series: pd.Series) -> pd.Series:
         return series
 
 
-# TODO Implement get_clusters
-def get_clusters(date: pd.Timestamp) -> pd.DataFrame:
+CLUSTERS_TABLE = "jld_clusters"
+
+
+def get_clusters(
+    date: pd.Timestamp, ids: Optional[pd.Index] = None, how: str = "exact"
+) -> pd.DataFrame:
     """
     Given a date, returns a dataframe with all available IDs and clusters for that date
 
     Parameters
     ----------
     date: pd.Timestamp
-        Exact date of cluster slice
+        Date of cluster slice
+
+    ids: pd.Index
+        optional list of ids to select
+
+    how: str = "exact"
+        "exact" for clusters extracted on `date` only, "previous" for clusters from
+        latest extract on or before `date`
 
     Returns
     -------
     df: pd.DataFrame
         Columns returned: "ppsn", "date", "cluster"
     """
-    pass
+    return get_clusters_many([date], ids=ids, how=how)[date]
+
+
+def get_clusters_many(
+    dates: List[pd.Timestamp], ids: Optional[pd.Index] = None, how: str = "exact"
+) -> Dict[pd.Timestamp, pd.DataFrame]:
+    """
+    Given a list of dates, return IDs and clusters for each date using a single query
+
+    Clusters are read from the long jld_clusters table (one row per ppsn and extract
+    date), whose (date, ppsn) primary key serves `date IN (...)` lookups with or
+    without an id filter.
+
+    Parameters
+    ----------
+    dates: List[pd.Timestamp]
+        Dates to look up
+
+    ids: pd.Index
+        optional list of ids to select
+
+    how: str = "exact"
+        As for get_clusters()
+
+    Returns
+    -------
+    Dict[pd.Timestamp, pd.DataFrame]
+        Dataframe for each of `dates` with columns "ppsn", "date", "cluster"
+    """
+    engine = get_engine()
+    dates = [pd.Timestamp(date) for date in dates]
+    if how == "exact":
+        lookup_dates = {date: date.normalize() for date in dates}
+    elif how == "previous":
+        extract_dates = pd.DatetimeIndex(
+            pd.read_sql(
+                f"SELECT DISTINCT date FROM {CLUSTERS_TABLE} ORDER BY date", con=engine
+            )["date"]
+        )
+        positions = extract_dates.searchsorted(
+            pd.DatetimeIndex([date.normalize() for date in dates]), side="right"
+        )
+        lookup_dates = {
+            date: extract_dates[position - 1] if position else pd.NaT
+            for date, position in zip(dates, positions)
+        }
+    else:
+        raise ValueError(f"Unknown cluster lookup method: {how}")
+
+    query_text = f"""\
+        SELECT ppsn, date, cluster
+            FROM {CLUSTERS_TABLE}
+            WHERE date IN :dates
+        """
+    params = {
+        "dates": sorted(
+            {str(date.date()) for date in lookup_dates.values() if date is not pd.NaT}
+        )
+    }
+    if ids is not None:
+        query_text = add_id_filter(query_text)
+    query = sa.sql.text(query_text).bindparams(
+        sa.sql.expression.bindparam("dates", expanding=True)
+    )
+    with temp_ids_con(engine, ids) as con:
+        clusters = pd.read_sql(query, con=con, params=params, parse_dates=["date"])
+
+    clusters_by_date = {
+        date: date_clusters.reset_index(drop=True)
+        for date, date_clusters in clusters.groupby("date")
+    }
+    return {
+        date: clusters_by_date.get(lookup_date, clusters.iloc[:0]).copy()
+        for date, lookup_date in lookup_dates.items()
+    }
 
 
 # //TODO Refactor common code in get_{data}() functions into helper function
@@ -116,6 +476,8 @@ def get_ists_claims(
     Given a series of IDs and a date, return a df with ISTS claim info for each ID
 
     Claim info is taken from last LR date before given date.
+    If there's an ISTS snapshot for that LR date (see write_ists_snapshots()), it's
+    read from the snapshot instead of the database.
 
     Parameters
     ----------
@@ -135,6 +497,14 @@ def get_ists_claims(
     -------
     df: pd.DataFrame
     """
+    lookup_date = nearest_lr_date(date.normalize(), how="previous")
+    snapshot = read_ists_snapshot(
+        lookup_date, ids=ids, lr_flag=lr_flag, columns=columns
+    )
+    if snapshot is not None:
+        return snapshot
+
+    engine = get_engine()
     col_list = unpack(
         get_col_list(
             engine, "ists_claims", columns=columns, required_columns=["lr_flag"]
@@ -143,7 +513,7 @@ def get_ists_claims(
             engine, "ists_personal", columns=columns, required_columns=["ppsn"]
         )
     )
-    lookup_date = nearest_lr_date(date.normalize(), how="previous").date()
+    lookup_date = lookup_date.date()
     query_text = f"""\
         SELECT {col_list} 
             FROM ists_claims c
@@ -155,14 +525,13 @@ def get_ists_claims(
         query_text += """\
             AND lr_flag is true
         """
-    query, params = get_parameterized_query(query_text, ids)
-    ists = pd.read_sql(
-        query,
-        con=engine,
-        params=params,
-        parse_dates=datetime_cols(engine, "ists_claims")
-        + datetime_cols(engine, "ists_personal"),
-    ).drop_duplicates("ppsn", keep="first")
+    if ids is not None:
+        query_text = add_id_filter(query_text)
+    with temp_ids_con(engine, ids) as con:
+        use_ists_years(con, [lookup_date.year])
+        ists = read_source(
+            query_text, con, engine, ["ists_claims", "ists_personal"]
+        ).drop_duplicates("ppsn", keep="first")
 
     return (
         ists.dropna(axis=0, how="all")
@@ -171,6 +540,129 @@ def get_ists_claims(
     )
 
 
+def get_ists_claims_many(
+    dates: List[pd.Timestamp],
+    ids: Optional[pd.Index] = None,
+    lr_flag: bool = True,
+    columns: Optional[List] = None,
+) -> Dict[pd.Timestamp, pd.DataFrame]:
+    """
+    Given a list of dates, return ISTS claim info for each date using a single query
+
+    Claim info for each date is taken from last LR date before that date, exactly as
+    for get_ists_claims(), but all LR dates are read with one `lr_date IN (...)`
+    query instead of one query per date. LR dates with an ISTS snapshot are read
+    from the snapshot instead.
+
+    Parameters
+    ----------
+    dates: List[pd.Timestamp]
+        Dates to look up
+
+    ids: pd.Index
+        optional list of ids to select
+
+    lr_flag: bool = True
+        If True, just return records flagged as on the Live Register 
+        
+    columns: Optional[List] = None
+        Columns from the ISTS claim database to return. Default is all columns.
+
+    Returns
+    -------
+    Dict[pd.Timestamp, pd.DataFrame]
+        Dataframe for each of `dates`, indexed by ppsn
+    """
+    lookup_dates = {
+        date: nearest_lr_date(date.normalize(), how="previous") for date in dates
+    }
+    ists_by_lr_date = {}
+    for lr_date in set(lookup_dates.values()):
+        snapshot = read_ists_snapshot(
+            lr_date, ids=ids, lr_flag=lr_flag, columns=columns
+        )
+        if snapshot is not None:
+            ists_by_lr_date[lr_date] = snapshot
+    query_lr_dates = set(lookup_dates.values()) - set(ists_by_lr_date)
+    if not query_lr_dates:
+        return {
+            date: ists_by_lr_date[lookup_date].copy()
+            for date, lookup_date in lookup_dates.items()
+        }
+
+    engine = get_engine()
+    col_list = unpack(
+        get_col_list(
+            engine,
+            "ists_claims",
+            columns=columns,
+            required_columns=["lr_flag", "lr_date"],
+        )
+        + get_col_list(
+            engine, "ists_personal", columns=columns, required_columns=["ppsn"]
+        )
+    )
+    query_text = f"""\
+        SELECT {col_list} 
+            FROM ists_claims c
+            JOIN ists_personal p
+            ON c.personal_id=p.id
+            WHERE lr_date IN :lr_dates
+        """
+    if lr_flag:
+        query_text += """\
+            AND lr_flag is true
+        """
+    if ids is not None:
+        query_text = add_id_filter(query_text)
+    query = sa.sql.text(query_text).bindparams(
+        sa.sql.expression.bindparam("lr_dates", expanding=True)
+    )
+    # One query per MAX_ATTACHED years, as each year can be a partition file
+    years = sorted({date.year for date in query_lr_dates})
+    year_groups = [
+        years[i : i + MAX_ATTACHED] for i in range(0, len(years), MAX_ATTACHED)
+    ]
+    with temp_ids_con(engine, ids) as con:
+        results = []
+        for group in year_groups:
+            use_ists_years(con, group)
+            params = {
+                "lr_dates": sorted(
+                    str(date.date()) for date in query_lr_dates if date.year in group
+                )
+            }
+            results.append(
+                read_source(
+                    query, con, engine, ["ists_claims", "ists_personal"], params=params
+                )
+            )
+    # pd.read_sql() gives empty results object columns, which concat would spread
+    results = [result for result in results if not result.empty] or results[:1]
+    if len(results) == 1:
+        ists = results[0]
+    else:
+        ists = pd.concat(results, ignore_index=True)
+        # Each query has its own categories, which concat turns into object columns
+        for col in results[0].select_dtypes("category"):
+            ists[col] = ists[col].astype("category")
+    ists_lr_date = pd.to_datetime(ists["lr_date"]).dt.normalize()
+    if columns is not None and "lr_date" not in columns:
+        ists = ists.drop("lr_date", axis="columns")
+
+    for lr_date, lr_date_ists in ists.groupby(ists_lr_date):
+        ists_by_lr_date[lr_date] = (
+            lr_date_ists.drop_duplicates("ppsn", keep="first")
+            .dropna(axis=0, how="all")
+            .reset_index(drop=True)
+            .set_index("ppsn", verify_integrity=True)
+        )
+    return {
+        date: ists_by_lr_date.get(lookup_date, ists.iloc[:0].set_index("ppsn")).copy()
+        for date, lookup_date in lookup_dates.items()
+    }
+
+
 # %%
 def get_vital_statistics(
     ids: Optional[pd.Index] = None, columns: Optional[List] = None
@@ -189,6 +681,7 @@ def get_vital_statistics(
     df: pd.DataFrame
         Columns returned are given in `columns`
     """
+    engine = get_engine()
     col_list = unpack(
         get_col_list(
             engine, "ists_personal", columns=columns, required_columns=["ppsn"]
@@ -198,13 +691,12 @@ def get_vital_statistics(
         SELECT {col_list} 
             FROM ists_personal
         """
-    query, params = get_parameterized_query(query_text, ids)
-    ists_personal = pd.read_sql(
-        query,
-        con=engine,
-        params=params,
-        parse_dates=datetime_cols(engine, "ists_personal"),
-    ).drop_duplicates("ppsn", keep="first")
+    if ids is not None:
+        query_text = add_id_filter(query_text)
+    with temp_ids_con(engine, ids) as con:
+        ists_personal = pd.read_sql(
+            query_text, con=con, parse_dates=datetime_cols(engine, "ists_personal"),
+        ).drop_duplicates("ppsn", keep="first")
 
     return (
         ists_personal.dropna(axis=0, how="all")
@@ -217,6 +709,7 @@ def get_vital_statistics(
 def get_les_data(
     ids: Optional[pd.Index] = None, columns: Optional[List] = None
 ) -> pd.DataFrame:
+    engine = get_engine()
     col_list = unpack(
         get_col_list(
             engine, "les", columns=columns, required_columns=["ppsn", "start_date"]
@@ -226,10 +719,12 @@ def get_les_data(
         SELECT {col_list} 
             FROM les
         """
-    query, params = get_parameterized_query(query_text, ids)
-    les = pd.read_sql(
-        query, con=engine, params=params, parse_dates=datetime_cols(engine, "les"),
-    )
+    if ids is not None:
+        query_text = add_id_filter(query_text)
+    with temp_ids_con(engine, ids) as con:
+        les = pd.read_sql(
+            query_text, con=con, parse_dates=datetime_cols(engine, "les"),
+        )
 
     # Add calculated columns if needed
     if not columns or (columns and "end_date" in columns):
@@ -243,6 +738,7 @@ def get_les_data(
 def get_jobpath_data(
     ids: Optional[pd.Index] = None, columns: Optional[List] = None
 ) -> pd.DataFrame:
+    engine = get_engine()
     required_columns = ["ppsn", "jobpath_start_date"]
     col_list = unpack(
         get_col_list(engine, "jobpath_referrals", columns, required_columns)
@@ -251,13 +747,14 @@ def get_jobpath_data(
         SELECT {col_list} 
             FROM jobpath_referrals
         """
-    query, params = get_parameterized_query(query_text, ids)
-    jobpath = pd.read_sql(
-        query,
-        con=engine,
-        params=params,
-        parse_dates=datetime_cols(engine, "jobpath_referrals"),
-    )
+    if ids is not None:
+        query_text = add_id_filter(query_text)
+    with temp_ids_con(engine, ids) as con:
+        jobpath = pd.read_sql(
+            query_text,
+            con=con,
+            parse_dates=datetime_cols(engine, "jobpath_referrals"),
+        )
 
     # Add calculated columns
     if columns is None or (columns is not None and "jobpath_end_date" in columns):
@@ -269,119 +766,316 @@ def get_jobpath_data(
     return jobpath
 
 
+EARNINGS_ERROR_FLAGS = [
+    "PAY_ERR_IND",
+    "PRSI_ERR_IND",
+    "WIES_ERR_IND",
+    "CLASS_ERR_IND",
+    "PRSI_REFUND_IND",
+    "CANCELLED_IND",
+]
+
+
+def column_dtypes(engine, table_name) -> Dict[str, str]:
+    """Return pandas dtype for each numeric column in `table_name`
+    Used to give every chunk of a chunked read the same dtypes, even all-null chunks
+    """
+    dtypes = {}
+    for col in table_columns(engine, table_name):
+        if isinstance(col["type"], (sa.types.Float, sa.types.Numeric)):
+            dtypes[col["name"]] = "float64"
+        elif isinstance(col["type"], sa.types.Integer):
+            dtypes[col["name"]] = "Int64"
+    return dtypes
+
+
+def query_chunks(
+    engine, table_name: str, query: str, ids=None, chunksize: Optional[int] = None
+) -> Iterator[pd.DataFrame]:
+    """Yield results of `query` on `table_name` as typed dataframes of `chunksize` rows
+    (or as a single dataframe if `chunksize` is None).
+    If `ids` is given, `query` can use temp.ids (see temp_ids_con()).
+    """
+    dtypes = column_dtypes(engine, table_name)
+    with temp_ids_con(engine, ids) as con:
+        if chunksize is None:
+            chunks = [read_source(query, con, engine, [table_name])]
+        else:
+            chunks = read_source(query, con, engine, [table_name], chunksize=chunksize)
+        for chunk in chunks:
+            yield chunk.astype(
+                {col: dtype for col, dtype in dtypes.items() if col in chunk.columns}
+            )
+
+
+def aggregate_chunks(
+    chunks: Iterator[pd.DataFrame], by: List, values: List, compact_every: int = 20
+) -> pd.DataFrame:
+    """Return sums of `values` columns by `by` over all `chunks`
+    Partial sums are combined every `compact_every` chunks, so memory use is bounded
+    by the size of the result rather than the number of records.
+    """
+    partials = []
+    for chunk in chunks:
+        partials.append(chunk.groupby(by)[values].sum())
+        if len(partials) >= compact_every:
+            partials = [pd.concat(partials).groupby(level=by).sum()]
+    if not partials:
+        return pd.DataFrame(columns=by + values).set_index(by)
+    return pd.concat(partials).groupby(level=by).sum()
+
+
 def get_earnings(
     # date: pd.Timestamp,
     ids: Optional[pd.Index] = None,
     year: Optional[int] = None,
     columns: Optional[List] = None,
-) -> pd.DataFrame:
+    chunksize: Optional[int] = None,
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
     """
     Given a series of IDs, return all available employment information for those IDs
 
+    Records with any error flag set are excluded in the query.
+
     Parameters
     ----------
     ids: pd.Index = None
         IDs for lookup.
 
+    year: Optional[int] = None
+        If given, just return records with this CON_YEAR
+
     columns: Optional[List] = None
         Columns from the database to return. Default is all columns.
 
+    chunksize: Optional[int] = None
+        If given, return an iterator of dataframes with `chunksize` rows each, so the
+        whole result never has to be in memory at once.
+
     Returns
     -------
-    df: pd.DataFrame
+    df: pd.DataFrame or Iterator[pd.DataFrame]
     """
-
-    error_flags = [
-        "PAY_ERR_IND",
-        "PRSI_ERR_IND",
-        "WIES_ERR_IND",
-        "CLASS_ERR_IND",
-        "PRSI_REFUND_IND",
-        "CANCELLED_IND",
-    ]
+    engine = get_engine()
     id_col = "RSI_NO"
-    required_columns = [id_col] + error_flags
 
-    col_list = unpack(get_col_list(engine, "earnings", columns, required_columns))
+    col_list = unpack(
+        col
+        for col in get_col_list(engine, "earnings", columns, [id_col])
+        if col not in EARNINGS_ERROR_FLAGS
+    )
+    no_error_flag = " AND ".join(
+        f"COALESCE({flag}, '') = ''" for flag in EARNINGS_ERROR_FLAGS
+    )
+    query = f"""\
+        SELECT {col_list} 
+            FROM earnings
+            WHERE {no_error_flag}
+        """
+    if year:
+        query += f"""\
+            AND CON_YEAR = '{year}'
+        """
     if ids is not None:
-        with temp_ids_con(engine, ids) as con:
-            query = f"""\
-                SELECT {col_list}
-                FROM earnings 
-                INNER JOIN temp.ids
-                ON earnings.{id_col} = temp.ids.id
-                """
-            if year:
-                query += f"""\
-                    WHERE CON_YEAR = '{year}'
-                """
-            df = pd.read_sql(
-                query, con=con, parse_dates=datetime_cols(engine, "earnings")
-            )
-
-    else:
-        query = f"""\
-            SELECT {col_list} 
-                FROM earnings
-            """
-        if year:
-            query += f"""\
-                WHERE CON_YEAR = '{year}'
-            """
-        df = pd.read_sql(
-            query, con=engine, parse_dates=datetime_cols(engine, "earnings"),
-        )
-    no_error_flag = ~df[error_flags].any(axis="columns")
-    df = (
-        df.loc[no_error_flag]
-        .drop(error_flags, axis="columns")
-        .rename(columns={"RSI_NO": "ppsn"})
+        query = add_id_filter(query, id_col)
+    chunks = (
+        chunk.rename(columns={"RSI_NO": "ppsn"})
+        for chunk in query_chunks(engine, "earnings", query, ids, chunksize)
     )
+    if chunksize is not None:
+        return chunks
+    (df,) = chunks
 
     # Rename columns
     # PRSI/earnings ratio
     return df
 
 
+def get_earnings_totals(
+    ids: Optional[pd.Index] = None,
+    year: Optional[int] = None,
+    columns: Optional[List] = None,
+    chunksize: int = 100_000,
+) -> pd.DataFrame:
+    """
+    Return sums of earnings `columns` by ppsn and CON_YEAR, aggregated chunk by chunk
+
+    Parameters are as for get_earnings(). Returned dataframe is indexed by
+    ("ppsn", "CON_YEAR"). Default `columns` is ["EARNINGS_AMT"].
+    """
+    columns = columns or ["EARNINGS_AMT"]
+    chunks = (
+        chunk.dropna(subset=["CON_YEAR"]).astype({"CON_YEAR": "int64"})
+        for chunk in get_earnings(
+            ids=ids, year=year, columns=["CON_YEAR"] + columns, chunksize=chunksize
+        )
+    )
+    return aggregate_chunks(chunks, by=["ppsn", "CON_YEAR"], values=columns)
+
+
 # %%
 def get_sw_payments(
     ids: Optional[pd.Index] = None,
     period: Optional[pd.Period] = None,
     columns: Optional[List] = None,
-) -> pd.DataFrame:
+    chunksize: Optional[int] = None,
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+    """
+    Given a series of IDs, return all SW payments records for those IDs
+
+    Parameters
+    ----------
+    ids: pd.Index = None
+        IDs for lookup.
+
+    period: Optional[pd.Period] = None
+        If given, just return records with this QTR
+
+    columns: Optional[List] = None
+        Columns from the database to return. Default is all columns.
+
+    chunksize: Optional[int] = None
+        If given, return an iterator of dataframes with `chunksize` rows each, so the
+        whole result never has to be in memory at once.
+
+    Returns
+    -------
+    df: pd.DataFrame or Iterator[pd.DataFrame]
+    """
+    engine = get_engine()
     id_col = "ppsn"
-    required_columns = ["id_col"]
+    required_columns = [id_col]
     col_list = unpack(get_col_list(engine, "payments", columns, required_columns))
 
+    query = f"""\
+        SELECT {col_list} 
+            FROM payments
+        """
+    if period:
+        query += f"""\
+            WHERE QTR = '{period}'
+        """
     if ids is not None:
-        with temp_ids_con(engine, ids) as con:
-            query = f"""\
-                SELECT {col_list}
-                FROM payments 
-                INNER JOIN temp.ids
-                ON payments.{id_col} = temp.ids.id
-                """
-            if period:
-                query_text += f"""\
-                    WHERE QTR = '{period}'
-                """
-            df = pd.read_sql(
-                query, con=con, parse_dates=datetime_cols(engine, "payments")
-            )
-    else:
-        query = f"""\
-            SELECT {col_list} 
-                FROM payments
-            """
-        if period:
-            query += f"""\
-                WHERE QTR = '{period}'
-            """
-        df = pd.read_sql(
-            query, con=engine, parse_dates=datetime_cols(engine, "payments"),
+        query = add_id_filter(query, id_col)
+    chunks = query_chunks(engine, "payments", query, ids, chunksize)
+    if chunksize is not None:
+        return chunks
+    (df,) = chunks
+
+    return df
+
+
+def get_sw_payments_totals(
+    ids: Optional[pd.Index] = None,
+    period: Optional[pd.Period] = None,
+    columns: Optional[List] = None,
+    chunksize: int = 100_000,
+) -> pd.DataFrame:
+    """
+    Return sums of SW payments `columns` by ppsn and year, aggregated chunk by chunk
+
+    Parameters are as for get_sw_payments(). Returned dataframe is indexed by
+    ("ppsn", "year"), with year taken from QTR. Default `columns` is ["AMOUNT"].
+    """
+    columns = columns or ["AMOUNT"]
+    chunks = (
+        chunk.assign(
+            year=pd.PeriodIndex(chunk["QTR"].to_numpy(), freq="Q").year
+        ).drop("QTR", axis="columns")
+        for chunk in get_sw_payments(
+            ids=ids, period=period, columns=["QTR"] + columns, chunksize=chunksize
         )
+    )
+    return aggregate_chunks(chunks, by=["ppsn", "year"], values=columns)
 
+
+# %%
+def get_earnings_summary(
+    ids: Optional[pd.Index] = None,
+    years: Optional[List[int]] = None,
+    wide: bool = False,
+) -> pd.DataFrame:
+    """
+    Return earnings totals by ppsn, year and PRSI class from earnings_summary table
+
+    earnings_summary is kept up to date by the ETL after each earnings load, with
+    error-flagged records left out and PRSI classes bucketed as "a", "s" or "other".
+
+    Parameters
+    ----------
+    ids: pd.Index = None
+        IDs for lookup.
+
+    years: Optional[List[int]] = None
+        If given, just return totals for these CON_YEARs
+
+    wide: bool = False
+        If True, return one column for each class ("earn_a", "earn_s", "earn_other")
+        indexed by ("ppsn", "CON_YEAR"), with zeros where there are no earnings.
+        Default is EARNINGS_AMT indexed by ("ppsn", "CON_YEAR", "class").
+
+    Returns
+    -------
+    df: pd.DataFrame
+    """
+    engine = get_engine()
+    query = """\
+        SELECT ppsn, CON_YEAR, class, EARNINGS_AMT
+            FROM earnings_summary
+        """
+    if years is not None:
+        query += f"""\
+            WHERE CON_YEAR IN ({unpack(int(year) for year in years)})
+        """
+    if ids is not None:
+        query = add_id_filter(query)
+    with temp_ids_con(engine, ids) as con:
+        df = pd.read_sql(query, con=con)
+    df = df.astype({"CON_YEAR": "int64", "EARNINGS_AMT": "float64"}).set_index(
+        ["ppsn", "CON_YEAR", "class"]
+    )
+    if wide:
+        df = (
+            df["EARNINGS_AMT"]
+            .unstack("class", fill_value=0.0)
+            .reindex(columns=["a", "s", "other"], fill_value=0.0)
+            .add_prefix("earn_")
+        )
+        df.columns.name = None
     return df
 
 
+def get_sw_payments_summary(
+    ids: Optional[pd.Index] = None,
+    periods: Optional[List[pd.Period]] = None,
+    schemes: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """
+    Return SW payments totals by ppsn, QTR and SCHEME_TYPE from payments_summary table
+
+    payments_summary is kept up to date by the ETL after each payments load.
+    Returned dataframe has AMOUNT indexed by ("ppsn", "QTR", "SCHEME_TYPE"). If given,
+    `periods` and `schemes` restrict the QTRs and SCHEME_TYPEs returned.
+    """
+    engine = get_engine()
+    query = """\
+        SELECT ppsn, QTR, SCHEME_TYPE, AMOUNT
+            FROM payments_summary
+        """
+    conditions = []
+    if periods is not None:
+        conditions.append(f"QTR IN ({unpack(repr(str(p)) for p in periods)})")
+    if schemes is not None:
+        conditions.append(f"SCHEME_TYPE IN ({unpack(repr(str(s)) for s in schemes)})")
+    if conditions:
+        query += f"""\
+            WHERE {" AND ".join(conditions)}
+        """
+    if ids is not None:
+        query = add_id_filter(query)
+    with temp_ids_con(engine, ids) as con:
+        df = pd.read_sql(query, con=con)
+    return df.astype({"AMOUNT": "float64"}).set_index(["ppsn", "QTR", "SCHEME_TYPE"])
+
+
 # %%
@@ -0,0 +1,181 @@
+# %%
+# Standard library
+from functools import lru_cache
+import os
+from pathlib import Path
+from typing import List, Optional
+
+# External packages
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Local packages
+from evaluation_jp.data import nearest_lr_date
+
+ISTS_SNAPSHOT_DIR_ENV_VAR = "EVALUATION_JP_ISTS_SNAPSHOTS"
+
+_ists_snapshot_dir = None
+
+
+def set_ists_snapshot_dir(directory: Optional[str]):
+    """
+    Use ISTS snapshots in `directory` (None to stop using snapshots)
+
+    Default is the EVALUATION_JP_ISTS_SNAPSHOTS environment variable, if set.
+    """
+    global _ists_snapshot_dir
+    _ists_snapshot_dir = directory
+
+
+def ists_snapshot_dir() -> Optional[Path]:
+    directory = _ists_snapshot_dir or os.environ.get(ISTS_SNAPSHOT_DIR_ENV_VAR)
+    return Path(directory) if directory else None
+
+
+def ists_snapshot_path(lr_date: pd.Timestamp, directory=None) -> Optional[Path]:
+    directory = Path(directory) if directory else ists_snapshot_dir()
+    if directory is None:
+        return None
+    return directory / f"ists_{lr_date:%Y-%m-%d}.arrow"
+
+
+def deduplicate_ists(ists: pd.DataFrame) -> pd.DataFrame:
+    """Return the records get_ists_claims() can pick for each ppsn, in query order
+
+    The database path keeps the first record per ppsn in query order, after
+    filtering on lr_flag if asked to. So each ppsn keeps its first record, and its
+    first record flagged as on the Live Register if that's a different one.
+    Reading a snapshot then takes the first of these, as the database path would.
+    """
+    first = ~ists["ppsn"].duplicated(keep="first").to_numpy()
+    flagged = ists["lr_flag"].fillna(False).astype(bool).to_numpy()
+    first_flagged = flagged.copy()
+    first_flagged[flagged] = ~ists.loc[flagged, "ppsn"].duplicated().to_numpy()
+    return ists.loc[first | first_flagged].dropna(axis=0, how="all")
+
+
+def write_ists_snapshots(
+    lr_dates: List[pd.Timestamp], directory=None, engine=None
+) -> List[Path]:
+    """
+    Write an ISTS snapshot file for each of `lr_dates` from the source database
+
+    Each snapshot is an Arrow IPC file with the joined ists_claims and ists_personal
+    columns for all records on that LR date, with text columns dictionary-encoded.
+    Each ppsn has its first record, plus its first record on the Live Register if
+    that's a different one (see deduplicate_ists()). Files are left uncompressed so
+    reads can memory-map them without copying.
+
+    Parameters
+    ----------
+    lr_dates: List[pd.Timestamp]
+        LR dates to write snapshots for
+
+    directory: Optional[str] = None
+        Snapshot directory. Default is directory set by set_ists_snapshot_dir().
+
+    engine: Optional[sa.engine.base.Engine] = None
+        Source database engine. Default is the get_{data}() helpers' engine.
+
+    Returns
+    -------
+    List[Path]
+        Paths of snapshot files written
+    """
+    # Import here as _import_helpers uses this module
+    from evaluation_jp.data._import_helpers import (
+        get_engine,
+        get_col_list,
+        unpack,
+        use_ists_years,
+    )
+    from evaluation_jp.data import datetime_cols
+
+    if pa is None:
+        raise ImportError("Writing ISTS snapshots needs pyarrow")
+    engine = engine or get_engine()
+    col_list = unpack(
+        get_col_list(engine, "ists_claims")
+        + get_col_list(engine, "ists_personal")
+    )
+    parse_dates = datetime_cols(engine, "ists_claims") + datetime_cols(
+        engine, "ists_personal"
+    )
+    paths = []
+    for lr_date in lr_dates:
+        lr_date = nearest_lr_date(pd.Timestamp(lr_date).normalize(), how="previous")
+        query = f"""\
+            SELECT {col_list}
+                FROM ists_claims c
+                JOIN ists_personal p
+                ON c.personal_id=p.id
+                WHERE lr_date = '{lr_date.date()}'
+            """
+        with engine.connect() as con:
+            use_ists_years(con, [lr_date.year])
+            ists = deduplicate_ists(
+                pd.read_sql(query, con=con, parse_dates=parse_dates)
+            ).reset_index(drop=True)
+        for col in ists.columns:
+            if col != "ppsn" and ists[col].dtype == object:
+                ists[col] = ists[col].astype("category")
+
+        path = ists_snapshot_path(lr_date, directory)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(".tmp")
+        table = pa.Table.from_pandas(ists, preserve_index=False)
+        with pa.OSFile(str(temp_path), "wb") as sink:
+            writer = pa.RecordBatchFileWriter(sink, table.schema)
+            writer.write_table(table)
+            writer.close()
+        temp_path.replace(path)
+        paths.append(path)
+    return paths
+
+
+@lru_cache(maxsize=16)
+def _snapshot_ppsn_index(path: str, mtime_ns: int) -> pd.Index:
+    """Return snapshot ppsn column as index, cached as it's costly to convert
+    `mtime_ns` is only there so a rewritten file isn't read from the cache
+    """
+    with pa.memory_map(path, "r") as source:
+        ppsn = pa.ipc.open_file(source).read_all().column("ppsn").to_pandas()
+    return pd.Index(ppsn, name="ppsn")
+
+
+def read_ists_snapshot(
+    lr_date: pd.Timestamp,
+    ids: Optional[pd.Index] = None,
+    lr_flag: bool = True,
+    columns: Optional[List] = None,
+) -> Optional[pd.DataFrame]:
+    """
+    Return ISTS snapshot for `lr_date` in get_ists_claims() format, or None if
+    there's no snapshot for that date (or pyarrow isn't installed).
+
+    The file is memory-mapped and only `columns` (plus "ppsn" and "lr_flag") are
+    converted to pandas. Text columns come back as categoricals.
+    """
+    path = ists_snapshot_path(lr_date)
+    if pa is None or path is None or not path.exists():
+        return None
+    ppsn = _snapshot_ppsn_index(str(path), path.stat().st_mtime_ns)
+    with pa.memory_map(str(path), "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+        names = [name for name in table.schema.names if name != "ppsn"]
+        if columns is not None:
+            names = [name for name in names if name in set(columns) | {"lr_flag"}]
+        ists = pa.Table.from_arrays(
+            [table.column(name) for name in names], names=names
+        ).to_pandas()
+    ists.index = ppsn
+    if lr_flag:
+        ists = ists.loc[ists["lr_flag"].fillna(False).astype(bool).to_numpy()]
+    if ids is not None:
+        ists = ists.loc[ists.index.isin(ids)]
+    # First of each ppsn's records, as get_ists_claims() keeps from the database
+    return ists.loc[~ists.index.duplicated(keep="first")]
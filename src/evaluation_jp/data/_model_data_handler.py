@@ -34,9 +34,42 @@ class DataNotFoundError(ModelDataHandlerError):
     pass
 
 
-def datetime_cols(engine, table_name) -> List:
+# Reflected column metadata by (engine URL, table), with schema version when read
+_schema_cache: Dict[Tuple[str, str], Tuple[Optional[int], List[Dict]]] = {}
+
+
+def schema_version(engine) -> Optional[int]:
+    """Return SQLite schema_version, which changes whenever the schema does.
+    Return None for other databases.
+    """
+    if engine.dialect.name != "sqlite":
+        return None
+    with engine.connect() as con:
+        return con.execute("PRAGMA schema_version").scalar()
+
+
+def table_columns(engine, table_name) -> List[Dict]:
+    """Return column metadata for `table_name`, as from Inspector.get_columns().
+    Metadata is cached by (engine URL, table name) and reflected again only when the
+    SQLite schema_version has changed. In-memory databases aren't cached, as the
+    same URL can point to different databases.
+    """
+    if engine.url.database in (None, "", ":memory:"):
+        insp = sa.engine.reflection.Inspector.from_engine(engine)
+        return insp.get_columns(table_name)
+    key = (str(engine.url), table_name)
+    version = schema_version(engine)
+    cached = _schema_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
     insp = sa.engine.reflection.Inspector.from_engine(engine)
     column_metadata = insp.get_columns(table_name)
+    _schema_cache[key] = (version, column_metadata)
+    return column_metadata
+
+
+def datetime_cols(engine, table_name) -> List:
+    column_metadata = table_columns(engine, table_name)
     datetime_cols = [
         col["name"]
         for col in column_metadata
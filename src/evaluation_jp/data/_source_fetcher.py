@@ -0,0 +1,104 @@
+# %%
+# Standard library
+from collections.abc import KeysView
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+
+def _hashable(value):
+    if isinstance(value, (list, set, frozenset, KeysView)):
+        return tuple(value)
+    return value
+
+
+@dataclass(frozen=True)
+class Source:
+    """A get_{data}() call, hashable so the same read is only made once"""
+
+    func: Callable
+    args: Tuple = ()
+    kwargs: Tuple = ()
+
+    @classmethod
+    def of(cls, func: Callable, *args, **kwargs) -> "Source":
+        return cls(
+            func,
+            tuple(_hashable(arg) for arg in args),
+            tuple(sorted((key, _hashable(value)) for key, value in kwargs.items())),
+        )
+
+    def __call__(self):
+        return self.func(*self.args, **dict(self.kwargs))
+
+
+class SourceFetcher:
+    """Run Source reads on a thread pool ahead of when they're needed
+
+    Each worker thread checks out its own connection from the (read-only) source
+    engine pool, and SQLite releases the GIL while it reads, so source I/O
+    overlaps with pandas work in the main thread.
+    """
+
+    def __init__(self, max_workers: int = 2):
+        self.max_workers = max_workers
+        self._executor = None
+        self._futures: Dict[Source, Future] = {}
+
+    def prefetch(self, sources: Iterable[Source]):
+        """Start reading `sources`, dropping any earlier results not in `sources`"""
+        sources = set(sources)
+        for source in set(self._futures) - sources:
+            self._futures.pop(source).cancel()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="SourceFetcher"
+            )
+        for source in sources - set(self._futures):
+            self._futures[source] = self._executor.submit(source)
+
+    def fetch(self, source: Source):
+        """Return result of `source`, from prefetch if available.
+        Results can be fetched more than once, so each fetch gets its own copy.
+        """
+        future = self._futures.get(source)
+        if future is None:
+            return source()
+        result = future.result()
+        return result.copy() if hasattr(result, "copy") else result
+
+    def close(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+_fetcher: Optional[SourceFetcher] = None
+
+
+def fetch_source(source: Source):
+    """Return result of `source`, from current SourceFetcher if there is one"""
+    if _fetcher is not None:
+        return _fetcher.fetch(source)
+    return source()
+
+
+@contextmanager
+def source_fetching(max_workers: int = 2, enabled: bool = True):
+    """Make a SourceFetcher current for fetch_source() calls inside the context
+    Yields None (and fetch_source() reads directly) if not `enabled`.
+    """
+    global _fetcher
+    if not enabled:
+        yield None
+        return
+    previous, _fetcher = _fetcher, SourceFetcher(max_workers=max_workers)
+    try:
+        yield _fetcher
+    finally:
+        _fetcher.close()
+        _fetcher = previous
@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+import datetime
+import re
+import sqlalchemy as sa
+from sqlalchemy import text
+
+# Per-connection settings for bulk loads: 1GB page cache, no fsync on each commit,
+# and temp tables and index build sorts in memory
+BULK_PRAGMAS = {
+    'cache_size': -1048576,
+    'synchronous': 'OFF',
+    'temp_store': 'MEMORY',
+}
+
+
+# Engines of databases being bulk loaded, by URL (see bulk_load())
+_bulk_engines = {}
+
+
+def create_engine(db, **kwargs):
+    """Return the bulk load engine for db if it's being bulk loaded, else a new engine.
+    Loads use this so their connections get the bulk pragmas, without other
+    engines in the process being affected.
+    """
+    if db in _bulk_engines:
+        return _bulk_engines[db]
+    return sa.create_engine(db, **kwargs)
+
+
+def create_deferred_index_table(conn):
+    conn.execute(text("""CREATE TABLE IF NOT EXISTS deferred_index (
+                             name TEXT PRIMARY KEY,
+                             sql  TEXT
+                         )"""))
+
+
+def secondary_indexes(conn, table, keep=()):
+    """Return [(name, sql)] of explicitly created, non-unique indexes on table,
+    except those named in keep. Unique indexes are constraints, so are never deferred.
+    """
+    rows = conn.execute(text("select name, sql from sqlite_master "
+                             "where type = 'index' and tbl_name = :table and sql is not null"),
+                        table=table)
+    return [(name, sql) for name, sql in rows
+            if name not in keep and not re.match(r'\s*CREATE\s+UNIQUE', sql, re.IGNORECASE)]
+
+
+def restore_deferred_indexes(conn):
+    """(Re)create every index recorded in deferred_index, then forget it.
+    Also picks up indexes left dropped by a load that was killed part way.
+    """
+    create_deferred_index_table(conn)
+    for name, sql in conn.execute(text("select name, sql from deferred_index")).fetchall():
+        print("     rebuilding index " + name + "   " + str(datetime.datetime.now()))
+        conn.execute(text(re.sub(r'^\s*CREATE\s+INDEX', 'CREATE INDEX IF NOT EXISTS', sql,
+                                 flags=re.IGNORECASE)))
+        conn.execute(text("delete from deferred_index where name = :name"), name=name)
+
+
+def set_pragmas(dbapi_conn, pragmas):
+    """Set pragmas on dbapi_conn, returning their previous values"""
+    previous = {}
+    for pragma, value in pragmas.items():
+        previous[pragma] = dbapi_conn.execute('pragma ' + pragma).fetchone()[0]
+        dbapi_conn.execute('pragma ' + pragma + ' = ' + str(value))
+    return previous
+
+
+@contextmanager
+def bulk_load(db, tables, keep_indexes=(), pragmas=BULK_PRAGMAS):
+    """Load into tables with their secondary indexes dropped and bulk pragmas on.
+    On entry, non-unique indexes on tables (other than keep_indexes, e.g. those the
+    load's own deletes and summary refreshes look up by) are dropped, recording their
+    SQL in deferred_index. Inside the block, create_engine(db) returns an engine
+    whose connections all get pragmas. On exit, even after an error, the indexes
+    are rebuilt once each, and the engine is disposed of, so later connections get
+    SQLite's default settings again.
+    """
+    engine = sa.create_engine(db, echo=False)
+    with engine.begin() as conn:
+        restore_deferred_indexes(conn)
+        for table in tables:
+            for name, sql in secondary_indexes(conn, table, keep_indexes):
+                conn.execute(text("insert into deferred_index (name, sql) values (:name, :sql)"),
+                             name=name, sql=sql)
+                conn.execute(text("drop index " + name))
+    # Connections opened above have default settings: start the load with new ones
+    engine.dispose()
+
+    def on_connect(dbapi_conn, connection_record):
+        set_pragmas(dbapi_conn, pragmas)
+
+    sa.event.listen(engine, 'connect', on_connect)
+    _bulk_engines[db] = engine
+    try:
+        yield engine
+    finally:
+        del _bulk_engines[db]
+        print(" rebuilding indexes " + str(datetime.datetime.now()))
+        # Bulk settings for the rebuild's sorts too
+        with engine.begin() as conn:
+            restore_deferred_indexes(conn)
+        sa.event.remove(engine, 'connect', on_connect)
+        engine.dispose()
+        print("   end rebuilding indexes " + str(datetime.datetime.now()))
@@ -0,0 +1,141 @@
+import csv
+import datetime
+import logging
+import os
+import re
+import shutil
+import time
+import pandas as pd
+import evaluation_jp.data.etl.pipeline.bulk as bulk
+
+# Text SQLite stores as a number in a FLOAT column
+NUMBER_PATTERN = r'\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*$'
+NUMBER = re.compile(NUMBER_PATTERN)
+
+logger = logging.getLogger(__name__)
+
+
+def split_line(line):
+    """Return fields of CSV line. Only lines with quotes go through the csv module."""
+    line = line.rstrip('\r\n')
+    if '"' in line:
+        return next(csv.reader([line]))
+    return line.split(',')
+
+
+def typed_values(fields, numeric):
+    """Return fields as SQLite stores them: number text in numeric columns as floats"""
+    return [float(f) if num and isinstance(f, str) and NUMBER.match(f) else f
+            for f, num in zip(fields, numeric)]
+
+
+def parse_lines(lines, columns, numeric):
+    """Return typed values of CSV lines, as a list with a tuple for each line, or
+    None for lines without one field per column.
+    Lines are split by split_line(), so quoted fields go through the csv module.
+    Types follow typed_values(): numeric columns have number text as floats (converted
+    a column at a time by pandas), and everything else stays text.
+    """
+    fields = [split_line(line) for line in lines]
+    valid = [len(f) == len(columns) for f in fields]
+    rows = [f for f, ok in zip(fields, valid) if ok]
+    if not rows:
+        return [None] * len(lines)
+    df = pd.DataFrame(rows, columns=columns, dtype=object)
+    values = []
+    for col, num in zip(columns, numeric):
+        s = df[col].copy()
+        if num:
+            is_number = s.str.match(NUMBER_PATTERN)
+            s[is_number] = pd.to_numeric(s[is_number].str.strip()).astype(float)
+        values.append(s.tolist())
+    parsed = iter(zip(*values))
+    return [next(parsed) if ok else None for ok in valid]
+
+
+class Rejects:
+    """Lines a load couldn't parse. They're logged and kept in reject_file + '.tmp' as
+    they're found, and added to reject_file by commit() once the load has committed,
+    so a failed load that's run again doesn't reject its lines twice.
+    Without a reject_file, ValueError is raised.
+    """
+
+    def __init__(self, reject_file=None):
+        self.reject_file = reject_file
+        self.count = 0
+        if reject_file is not None and os.path.exists(reject_file + '.tmp'):
+            os.remove(reject_file + '.tmp')
+
+    def add(self, lines):
+        if not lines:
+            return
+        if self.reject_file is None:
+            raise ValueError(str(len(lines)) + " lines with the wrong number of fields, e.g. " +
+                             repr(lines[0].rstrip('\r\n')))
+        with open(self.reject_file + '.tmp', 'at') as out:
+            out.writelines(line.rstrip('\r\n') + '\n' for line in lines)
+        self.count += len(lines)
+        logger.warning("%d lines with the wrong number of fields rejected to %s",
+                       len(lines), self.reject_file)
+
+    def commit(self):
+        """Add the rejected lines to reject_file"""
+        if not self.count:
+            return
+        with open(self.reject_file + '.tmp', 'rt') as rejected, \
+                open(self.reject_file, 'at') as out:
+            shutil.copyfileobj(rejected, out)
+        os.remove(self.reject_file + '.tmp')
+
+
+def report(label, rows, start):
+    seconds = max(time.perf_counter() - start, 1e-9)
+    print("     " + label + " " + str(rows) + " rows, " + str(int(rows / seconds)) +
+          " rows/sec   " + str(datetime.datetime.now()))
+
+
+def insert_lines(db, table, columns, numeric, lines, batch_size=100000, reject_file=None):
+    """Insert CSV lines into table, parsed to typed values in batches of batch_size.
+    The batches are inserted by executemany, all in one transaction, so on error
+    nothing is inserted and the load can simply be run again.
+    Lines with the wrong number of fields go to reject_file (see Rejects), or if
+    there isn't one, raise ValueError. Returns the number of rows inserted.
+    """
+    insert_sql = ("insert into " + table + " (" + ", ".join(columns) + ") values (" +
+                  ", ".join("?" * len(columns)) + ")")
+    engine = bulk.create_engine(db, echo=False)
+    conn = engine.raw_connection()
+    rejects = Rejects(reject_file)
+    start = time.perf_counter()
+    total = 0
+    batch = []
+
+    def flush():
+        rows = parse_lines(batch, columns, numeric)
+        rejects.add([line for line, row in zip(batch, rows) if row is None])
+        rows = [row for row in rows if row is not None]
+        conn.executemany(insert_sql, rows)
+        report("inserted", total + len(rows), start)
+        return len(rows)
+
+    print(" start " + str(datetime.datetime.now()))
+    try:
+        conn.execute("begin")
+        for line in lines:
+            if not line.strip():
+                continue
+            batch.append(line)
+            if len(batch) >= batch_size:
+                total += flush()
+                batch = []
+        if batch:
+            total += flush()
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    rejects.commit()
+    print("   end " + str(datetime.datetime.now()))
+    return total
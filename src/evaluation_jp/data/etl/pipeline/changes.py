@@ -0,0 +1,325 @@
+import datetime
+import hashlib
+import os
+import struct
+import time
+from sqlalchemy import text
+import bulk_apply
+import evaluation_jp.data.etl.pipeline.bulk as bulk
+from bulk_apply import split_line, typed_values
+
+# Change set file: MAGIC, then one record per change.
+#   insert: b'I', new row_hash, line length, new line
+#   delete: b'D', old row_hash, key length, key
+#   update: b'U', old row_hash, new row_hash, line length, new line
+# Row hashes are signed 64 bit ints, lengths unsigned 32 bit, text UTF-8.
+MAGIC = b'WWLDCHG1'
+INSERT, DELETE, UPDATE = b'I', b'D', b'U'
+HASH = struct.Struct('<q')
+LENGTH = struct.Struct('<I')
+BUFFER_SIZE = 1 << 20
+
+def row_hash(values):
+    """64 bit hash of a row's (typed) values, the same for a parsed line and the row
+    read back from the database. Trailing newlines are ignored, as older loads kept
+    them on the last field.
+    """
+    return text_hash('\x1f'.join(
+        '\0' if v is None else repr(float(v)) if isinstance(v, (int, float))
+        else str(v).rstrip('\r\n') for v in values))
+
+
+def text_hash(text):
+    """row_hash() of a row, given the text it hashes"""
+    h = hashlib.blake2b(text.encode(), digest_size=8)
+    return int.from_bytes(h.digest(), 'little', signed=True)
+
+
+def line_hash(line, numeric):
+    return row_hash(typed_values(split_line(line), numeric))
+
+
+def line_key(line, key_fields):
+    """Return line up to and including the comma after its first key_fields fields"""
+    end = -1
+    for _ in range(key_fields):
+        end = line.find(',', end + 1)
+        if end < 0:
+            return line
+    return line[:end + 1]
+
+
+def key_groups(lines, key_fields):
+    """Yield (key, [lines]) for each run of lines with the same key"""
+    key, group = None, []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        k = line_key(line, key_fields)
+        if k != key and group:
+            yield key, group
+            group = []
+        key = k
+        group.append(line)
+    if group:
+        yield key, group
+
+
+class Text_rows:
+    """Rows of a sorted CSV text snapshot, grouped by key"""
+
+    def __init__(self, lines, key_fields, numeric):
+        self.lines = lines
+        self.key_fields = key_fields
+        self.numeric = numeric
+
+    def groups(self):
+        return key_groups(self.lines, self.key_fields)
+
+    def hash(self, row):
+        return line_hash(row, self.numeric)
+
+    def line(self, row):
+        return row
+
+
+def group_changes(key, old_rows, new_rows, old, new):
+    """Yield changes turning old_rows (of old) into new_rows (of new), all with the
+    same key. Rows are compared by row hash, so e.g. '2015' and '2015.0' in a numeric
+    column are the same. Changed rows are paired up as updates, and any left over are
+    deletes or inserts.
+    """
+    new_hashes = {}
+    for row in new_rows:
+        new_hashes.setdefault(new.hash(row), []).append(row)
+    removed = []
+    for row in old_rows:
+        h = old.hash(row)
+        if new_hashes.get(h):
+            new_hashes[h].pop()
+        else:
+            removed.append(h)
+    added = [(h, row) for h, rows in new_hashes.items() for row in rows]
+    for old_hash, (new_hash, row) in zip(removed, added):
+        yield UPDATE, old_hash, new_hash, new.line(row)
+    for old_hash in removed[len(added):]:
+        yield DELETE, old_hash, None, key
+    for new_hash, row in added[len(removed):]:
+        yield INSERT, None, new_hash, new.line(row)
+
+
+def ordered_groups(groups, name):
+    """Yield groups, raising ValueError if their keys aren't strictly increasing,
+    e.g. a snapshot sorted in a different order to the other
+    """
+    previous = None
+    for group in groups:
+        if previous is not None and group[0] <= previous:
+            raise ValueError(name + " snapshot is not sorted by key: " + repr(group[0]) +
+                             " after " + repr(previous))
+        previous = group[0]
+        yield group
+
+
+def diff_rows(old, new):
+    """Yield (op, old row_hash, new row_hash, line) changes from snapshot old to new
+    in one pass. Each snapshot (e.g. Text_rows) groups its rows by key, in key order.
+    Records are matched on their key, so a changed field is one update rather than a
+    delete and an insert. Keys needn't be unique.
+    Both snapshots must be in the same (Python string) order, else ValueError is
+    raised part way, before a wrong delete can be applied.
+    """
+    old_groups = ordered_groups(old.groups(), "old")
+    new_groups = ordered_groups(new.groups(), "new")
+    o = next(old_groups, None)
+    n = next(new_groups, None)
+    while o or n:
+        if n is None or (o is not None and o[0] < n[0]):
+            for row in o[1]:
+                yield DELETE, old.hash(row), None, o[0]
+            o = next(old_groups, None)
+        elif o is None or n[0] < o[0]:
+            for row in n[1]:
+                yield INSERT, None, new.hash(row), new.line(row)
+            n = next(new_groups, None)
+        else:
+            if type(old) is not type(new) or o[1] != n[1]:
+                yield from group_changes(o[0], o[1], n[1], old, new)
+            o = next(old_groups, None)
+            n = next(new_groups, None)
+
+
+def diff_lines(old_lines, new_lines, key_fields, numeric):
+    """Yield changes from sorted (by Python string order) CSV old_lines to new_lines,
+    matching records on their first key_fields fields
+    """
+    return diff_rows(Text_rows(old_lines, key_fields, numeric),
+                     Text_rows(new_lines, key_fields, numeric))
+
+
+def write_change_set(changes, change_file):
+    """Write changes to change_file, returning {op: count}.
+    The file is written under a temporary name and only renamed once complete, so
+    a diff that fails part way doesn't leave a change set to be applied.
+    """
+    counts = {INSERT: 0, DELETE: 0, UPDATE: 0}
+    with open(change_file + '.tmp', 'wb', buffering=BUFFER_SIZE) as out:
+        out.write(MAGIC)
+        for op, old_hash, new_hash, line in changes:
+            out.write(op)
+            if op != INSERT:
+                out.write(HASH.pack(old_hash))
+            if op != DELETE:
+                out.write(HASH.pack(new_hash))
+            data = line.encode('utf-8')
+            out.write(LENGTH.pack(len(data)))
+            out.write(data)
+            counts[op] += 1
+    os.replace(change_file + '.tmp', change_file)
+    return counts
+
+
+def read_change_set(change_file):
+    """Yield (op, old row_hash, new row_hash, line) from change_file"""
+    with open(change_file, 'rb', buffering=BUFFER_SIZE) as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(change_file + ' is not a change set')
+        while True:
+            op = f.read(1)
+            if not op:
+                return
+            old_hash = HASH.unpack(f.read(HASH.size))[0] if op != INSERT else None
+            new_hash = HASH.unpack(f.read(HASH.size))[0] if op != DELETE else None
+            length = LENGTH.unpack(f.read(LENGTH.size))[0]
+            yield op, old_hash, new_hash, f.read(length).decode('utf-8')
+
+
+def create_diff(old_file, new_file, change_file, key_fields, numeric):
+    """Write the change set from sorted text file old_file to new_file"""
+    with open(old_file, 'rt', buffering=BUFFER_SIZE) as fold, \
+            open(new_file, 'rt', buffering=BUFFER_SIZE) as fnew:
+        write_diff(Text_rows(fold, key_fields, numeric), Text_rows(fnew, key_fields, numeric),
+                   change_file)
+
+
+def write_diff(old, new, change_file):
+    """Write the change set from snapshot old to new (see diff_rows())"""
+    print(" start " + str(datetime.datetime.now()))
+    counts = write_change_set(diff_rows(old, new), change_file)
+    print("     " + str(counts[INSERT]) + " inserts, " + str(counts[DELETE]) + " deletes, " +
+          str(counts[UPDATE]) + " updates")
+    print("   end " + str(datetime.datetime.now()))
+
+
+def add_row_hash(conn, table, columns, numeric, chunk_rows=100000):
+    """Add a row_hash column (and index) to table if it hasn't one, hashing existing rows.
+    Rows are hashed in rowid order, chunk_rows at a time, each chunk committed, so a
+    backfill that's interrupted carries on from the first row without a hash when run
+    again. The index is created last, so it marks the backfill as finished.
+    """
+    index = "idx_" + table + "_row_hash"
+    if conn.execute(text("select count(*) from sqlite_master where type = 'index' and name = :name"),
+                    name=index).scalar():
+        return
+    existing = [row[1] for row in conn.execute(text("pragma table_info(" + table + ")"))]
+    if 'row_hash' not in existing:
+        print('adding ' + table + '.row_hash ' + str(datetime.datetime.now()))
+        conn.execute(text("alter table " + table + " add column row_hash INTEGER"))
+    raw = conn.connection
+    # Earlier chunks were hashed in rowid order, so every row after this one is left
+    first = raw.execute("select min(rowid) from " + table + " where row_hash is null").fetchone()[0]
+    last_rowid = None if first is None else first - 1
+    hashed = 0
+    start = time.perf_counter()
+    while last_rowid is not None:
+        batch = raw.execute("select rowid, " + ", ".join(columns) + " from " + table +
+                            " where rowid > ? order by rowid limit ?",
+                            (last_rowid, chunk_rows)).fetchall()
+        if not batch:
+            break
+        raw.executemany("update " + table + " set row_hash = ? where rowid = ?",
+                        [(row_hash(typed_values(row[1:], numeric)), row[0]) for row in batch])
+        raw.commit()
+        last_rowid = batch[-1][0]
+        hashed += len(batch)
+        bulk_apply.report("hashed", hashed, start)
+    conn.execute(text("create index if not exists " + index + " on " + table + " (row_hash)"))
+
+
+def apply_change_set(db, table, columns, numeric, key_fields, change_file, batch_size=100000,
+                     reject_file=None):
+    """Apply change_file to table, finding deleted and updated rows by row_hash and
+    key (the first key_fields columns), so rows of different records that happen to
+    hash the same are never mixed up.
+    New lines are parsed to typed values a batch at a time (see bulk_apply), and the
+    batches are applied by executemany, all in one transaction. On error it's rolled
+    back, so the change set can simply be applied again once the problem is fixed.
+    Inserts and updates whose line hasn't one field per column go to reject_file, or
+    if there isn't one, raise ValueError (see bulk_apply.Rejects).
+    Returns the set of ids (first fields) changed.
+    """
+    # The first row with the hash and key: identical rows are interchangeable
+    by_key = ("rowid = (select rowid from " + table + " where row_hash = ?" +
+               "".join(" and " + c + " = ?" for c in columns[:key_fields]) + " limit 1)")
+    insert_sql = ("insert into " + table + " (" + ", ".join(columns) + ", row_hash) values (" +
+                  ", ".join("?" * (len(columns) + 1)) + ")")
+    update_sql = ("update " + table + " set " + ", ".join(c + " = ?" for c in columns) +
+                  ", row_hash = ? where " + by_key)
+    delete_sql = "delete from " + table + " where " + by_key
+    engine = bulk.create_engine(db, echo=False)
+    conn = engine.raw_connection()
+    rejects = bulk_apply.Rejects(reject_file)
+    ids = set()
+    counts = {INSERT: 0, DELETE: 0, UPDATE: 0}
+    # Deletes: (old hash,) + key, inserts and updates: (hashes, new line)
+    batch = {INSERT: [], DELETE: [], UPDATE: []}
+    start = time.perf_counter()
+
+    def parsed(op, keyed=False):
+        """(values + hashes), and key values if keyed, of op's batched changes,
+        rejecting unparseable lines
+        """
+        lines = [line for _, line in batch[op]]
+        rows = bulk_apply.parse_lines(lines, columns, numeric)
+        rejects.add([line for line, values in zip(lines, rows) if values is None])
+        key_end = key_fields if keyed else 0
+        return [values + hashes + values[:key_end] for values, (hashes, _) in zip(rows, batch[op])
+                if values is not None]
+
+    def flush():
+        changed = {DELETE: batch[DELETE], UPDATE: parsed(UPDATE, keyed=True), INSERT: parsed(INSERT)}
+        conn.executemany(delete_sql, changed[DELETE])
+        conn.executemany(update_sql, changed[UPDATE])
+        conn.executemany(insert_sql, changed[INSERT])
+        for op in batch:
+            counts[op] += len(changed[op])
+            batch[op] = []
+        bulk_apply.report("applied", sum(counts.values()), start)
+
+    print(" start " + str(datetime.datetime.now()))
+    try:
+        conn.execute("begin")
+        for op, old_hash, new_hash, line in read_change_set(change_file):
+            ids.add(split_line(line)[0].strip())
+            if op == DELETE:
+                key = typed_values(split_line(line)[:key_fields], numeric)
+                batch[DELETE].append((old_hash,) + tuple(key))
+            elif op == INSERT:
+                batch[INSERT].append(((new_hash,), line))
+            else:
+                batch[UPDATE].append(((new_hash, old_hash), line))
+            if sum(len(changes) for changes in batch.values()) >= batch_size:
+                flush()
+        flush()
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    rejects.commit()
+    print("     " + str(counts[INSERT]) + " inserts, " + str(counts[DELETE]) + " deletes, " +
+          str(counts[UPDATE]) + " updates")
+    print("   end " + str(datetime.datetime.now()))
+    return ids
@@ -1,49 +1,50 @@
 
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import datetime
 import os
 import sqlalchemy as sa
 from sqlalchemy import text
 
+import evaluation_jp.data.etl.pipeline.bulk as bulk
 import evaluation_jp.data.etl.pipeline.futil as futil
+import evaluation_jp.data.etl.pipeline.manifest as manifest
 
 
 class Data_file(metaclass=ABCMeta):
+    # Tables whose secondary indexes can be deferred while loading, and indexes the
+    # load itself needs (see bulk.bulk_load). Deferring is on if self.bulk_load is set.
+    bulk_tables = ()
+    bulk_keep_indexes = ()
+    bulk_load = False
+
+    def bulk_loading(self):
+        if self.bulk_load and self.bulk_tables:
+            return bulk.bulk_load(self.db, self.bulk_tables, self.bulk_keep_indexes)
+        return nullcontext()
+
+    def source_files(self):
+        """Files this load reads, checked and recorded in the load manifest"""
+        return [self.filename]
 
     def processed(self):
-        if os.path.isfile(self.filename):
-            engine = sa.create_engine( self.db)
-            conn = engine.connect()
-            t = text("select count(*) from load_file where file='" + self.filename + "'")
-            if next(conn.execute(t))[0] > 0:
-                mtime = futil.modification_date(self.filename)
-                t = text("select count(*) from load_file where file='" + self.filename +
-                         "' and mod_date='" + mtime.strftime("%Y-%m-%d %H:%M:%S.%f") + "'")
-                if next(conn.execute(t))[0] > 0:
-                    return True
-                else:
-                    print("source file " + self.filename + " has been modified")
-                    return False
-            else:
-                print("source file " + self.filename + " not loaded")
-                return False
-        else:
-            print("source file " + self.filename + " not present")
-            return True
+        load_manifest = manifest.Load_manifest.for_db(self.db)
+        # Check every file, so each one missing or modified is reported
+        return all([load_manifest.processed(f) for f in self.source_files()])
 
     def do_process(self):
-        mtime = futil.modification_date(self.filename)
-        self.read()
-        engine = sa.create_engine( self.db)
-        conn = engine.connect()
-        t = text("delete from load_file where file ='" +
-                 self.filename + "'")
-        conn.execute(t)
-        t = text("insert into load_file (file, mod_date, load_time) values('" +
-                 self.filename +
-                 "', '" + mtime.strftime("%Y-%m-%d %H:%M:%S.%f") +
-                 "', '" + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f") + "')")
-        conn.execute(t)
+        load_manifest = manifest.Load_manifest.for_db(self.db)
+        files = [f for f in self.source_files() if os.path.isfile(f)]
+        stats = [(futil.modification_date(f), os.path.getsize(f)) for f in files]
+        # Content hashes (if processed() didn't already work them out) are read on a
+        # thread while the load runs, instead of as a separate pass before it
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            hashes = [pool.submit(load_manifest.content_hash, f) for f in files]
+            with self.bulk_loading():
+                self.read()
+            for f, (mtime, file_size), file_hash in zip(files, stats, hashes):
+                load_manifest.record(f, mtime, file_size, file_hash.result())
 
     @abstractmethod
     def read(self):
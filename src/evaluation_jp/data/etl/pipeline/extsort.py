@@ -0,0 +1,125 @@
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import heapq
+import io
+import os
+import shutil
+import tempfile
+
+BUFFER_SIZE = 1 << 20
+# Most runs merged at once, well inside open file limits (512 by default on Windows)
+MAX_FAN_IN = 256
+# Marker file next to a snapshot sorted by external_sort() (see ensure_sorted())
+SORTED_SUFFIX = '.sorted'
+
+
+def chunk_ranges(infile, chunk_lines):
+    """Yield (start, end) byte ranges of infile with chunk_lines lines each (the last
+    may have fewer), found by counting newlines without decoding any lines
+    """
+    start = offset = lines = 0
+    with open(infile, 'rb') as f:
+        while True:
+            block = f.read(BUFFER_SIZE)
+            if not block:
+                break
+            pos = 0
+            while block.count(b'\n', pos) >= chunk_lines - lines:
+                for _ in range(chunk_lines - lines):
+                    pos = block.index(b'\n', pos) + 1
+                yield start, offset + pos
+                start = offset + pos
+                lines = 0
+            lines += block.count(b'\n', pos)
+            offset += len(block)
+    if offset > start:
+        yield start, offset
+
+
+def sort_run(infile, start, end, run_file):
+    """Sort the lines in bytes start to end of infile, stripped and without blank
+    lines, and write them to run_file. Run in a worker process, which reads its own
+    chunk so that only file offsets are sent to it.
+    """
+    with open(infile, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # Decoded as open(infile, 'rt') would
+    stripped = (l.strip() for l in io.TextIOWrapper(io.BytesIO(data)))
+    lines = [l + '\n' for l in stripped if l]
+    del data
+    lines.sort()
+    with open(run_file, 'wt', buffering=BUFFER_SIZE) as out:
+        out.writelines(lines)
+    return run_file
+
+
+def merge_runs(run_files, outfile):
+    """k-way merge of sorted run_files into outfile"""
+    files = [open(f, 'rt', buffering=BUFFER_SIZE) for f in run_files]
+    try:
+        with open(outfile, 'wt', buffering=BUFFER_SIZE) as out:
+            out.writelines(heapq.merge(*files))
+    finally:
+        for f in files:
+            f.close()
+
+
+def mark_sorted(filename):
+    """Record that filename was sorted by external_sort()"""
+    open(filename + SORTED_SUFFIX, 'w').close()
+
+
+def ensure_sorted(filename, workdir, chunk_lines, processes=None):
+    """Sort filename in place with external_sort(), unless it's marked as sorted by it.
+    Current snapshots from before external_sort() were sorted by the Windows sort
+    command, in a different order to the one the diffs compare lines in.
+    """
+    if not os.path.exists(filename) or os.path.exists(filename + SORTED_SUFFIX):
+        return
+    print('re-sorting ' + filename)
+    external_sort(filename, filename + '.tmp', workdir, chunk_lines, processes)
+    os.replace(filename + '.tmp', filename)
+    mark_sorted(filename)
+
+
+def external_sort(infile, outfile, workdir, chunk_lines, processes=None):
+    """Sort the lines of infile into outfile, using at most about chunk_lines lines
+    per process in memory.
+    Lines are stripped and blank lines dropped. The file is split into chunks of
+    chunk_lines lines, each read and sorted by a worker process, then the sorted runs
+    are merged with heapq.merge (in several passes if there are more than MAX_FAN_IN).
+    Lines sort by Python string comparison, the same order the diffs compare them in.
+    Run files go in a temporary directory under workdir, removed however this ends.
+    """
+    processes = processes or os.cpu_count()
+    tmpdir = tempfile.mkdtemp(prefix='sort_', dir=workdir)
+    print(" start " + str(datetime.datetime.now()))
+    try:
+        runs = []
+        pending = []
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for start, end in chunk_ranges(infile, chunk_lines):
+                # Keep at most one chunk per process in flight, to bound memory
+                if len(pending) >= processes:
+                    runs.append(pending.pop(0).result())
+                    print("     " + str(len(runs)) + "   " + str(datetime.datetime.now()))
+                run_file = os.path.join(tmpdir, 'run_' + str(len(runs) + len(pending)) + '.txt')
+                pending.append(pool.submit(sort_run, infile, start, end, run_file))
+            runs.extend(f.result() for f in pending)
+        print("     " + str(len(runs)) + " runs sorted   " + str(datetime.datetime.now()))
+        merge_pass = 0
+        while len(runs) > MAX_FAN_IN:
+            merged = []
+            for i in range(0, len(runs), MAX_FAN_IN):
+                merged_file = os.path.join(tmpdir, 'merge_' + str(merge_pass) + '_' + str(i) + '.txt')
+                merge_runs(runs[i:i + MAX_FAN_IN], merged_file)
+                for run_file in runs[i:i + MAX_FAN_IN]:
+                    os.remove(run_file)
+                merged.append(merged_file)
+            runs = merged
+            merge_pass += 1
+        merge_runs(runs, outfile)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    print("   end " + str(datetime.datetime.now()))
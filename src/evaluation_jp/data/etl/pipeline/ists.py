@@ -1,13 +1,212 @@
 from datetime import timedelta
 import datetime
 import os
+import re
 import sqlalchemy as sa
 from sqlalchemy import text
+import hashlib
+import pandas as pd
 import pyreadstat
 import data_file
+import evaluation_jp.data.etl.pipeline.bulk as bulk
+
+PERSONAL_HASH_COLS = ['date_of_birth', 'sex', 'nat_code', 'occupation', 'ppsn', 'RELATED_RSI_NO']
+
+
+CLAIMS_INSERT = """
+    insert into {table} ( lr_code, lr_flag, lls_code, clm_reg_date, clm_comm_date,
+                          location, CLM_STATUS, CLM_SUSP_DTL_REAS_CODE, CDAS, ada_code,
+                          JobPath_Flag, JobPathHold, PERS_RATE, ADA_AMT, CDA_AMT, MEANS,
+                          EMEANS, NEMEANS, NET_FLAT, FUEL, RRA, WEEKLY_RATE, Recip_flag,
+                          lr_date, personal_id )
+    select te.lr_code, te.lr_flag, te.lls_code, te.clm_reg_date, te.clm_comm_date, te.location, te.CLM_STATUS,
+           te.CLM_SUSP_DTL_REAS_CODE, te.CDAS, te.ada_code, te.JobPath_Flag, te.JobPathHold, te.PERS_RATE,
+           te.ADA_AMT, te.CDA_AMT, te.MEANS, te.EMEANS, te.NEMEANS, te.NET_FLAT, te.FUEL, te.RRA, te.WEEKLY_RATE,
+           te.Recip_flag, te.lr_date, pd.id
+        from ists_data_tmp te
+        join ists_personal pd
+            on pd.row_hash = te.row_hash
+"""
+
+
+def personal_row_hash(personal):
+    """Return row_hash key for each row of ists_personal columns in personal.
+    Values are normalised first (dates to YYYY-MM-DD, nulls distinct from ''), so
+    rows read back from the database hash the same as rows from SAS files.
+    """
+    parts = []
+    for col in PERSONAL_HASH_COLS:
+        values = personal[col]
+        if col == 'date_of_birth':
+            values = pd.to_datetime(values, errors='coerce').dt.strftime('%Y-%m-%d')
+        parts.append(values.astype(object).where(values.notna(), '\0').astype(str))
+    keys = parts[0].str.cat(parts[1:], sep='\x1f')
+    return keys.map(lambda key: hashlib.blake2b(key.encode(), digest_size=16).hexdigest())
+
+
+def add_personal_row_hash(conn, chunk_rows=100000):
+    """Add row_hash key, with unique index, to an ists_personal table without it.
+    Existing rows with the same hash are merged into the one with the lowest id:
+    ists_claims rows pointing at the others are repointed to it, then the others
+    are deleted.
+    Rows are hashed in id order, chunk_rows at a time, each chunk committed, so a
+    backfill that's interrupted carries on where it stopped when run again. Merged
+    ids are kept in ists_personal_merge until claims are repointed at the end, and
+    the table's dropped once they are, marking the backfill as finished.
+    """
+    columns = [row[1] for row in conn.execute(text("pragma table_info(ists_personal)"))]
+    if 'row_hash' not in columns:
+        print('adding ists_personal.row_hash ' + str(datetime.datetime.now()))
+        with conn.begin():
+            conn.execute(text("alter table ists_personal add column row_hash TEXT"))
+            # Rows not hashed yet are null, which a unique index lets repeat
+            conn.execute(text("create unique index idx_ists_p_row_hash on ists_personal (row_hash)"))
+            conn.execute(text("create table ists_personal_merge "
+                              "(id INTEGER PRIMARY KEY, kept_id INTEGER)"))
+    elif not conn.execute(text("select count(*) from sqlite_master "
+                               "where type = 'table' and name = 'ists_personal_merge'")).scalar():
+        return
+    # Earlier chunks were hashed in id order, so every row after this one is left
+    first = conn.execute(text("select min(id) from ists_personal where row_hash is null")).scalar()
+    last_id = None if first is None else first - 1
+    hashed = merged_rows = 0
+    while last_id is not None:
+        personal = pd.read_sql(text("select id, " +
+                                    ", ".join(col + " as " + col for col in PERSONAL_HASH_COLS) +
+                                    " from ists_personal where id > :last_id order by id limit :rows"),
+                               con=conn, params={'last_id': last_id, 'rows': chunk_rows})
+        if personal.empty:
+            break
+        row_hash = personal_row_hash(personal)
+        kept_id = personal['id'].groupby(row_hash.values).transform('min')
+        with conn.begin():
+            raw = conn.connection
+            # Rows of earlier chunks have lower ids, so are kept over this chunk's
+            conn.execute(text("create temp table if not exists personal_chunk "
+                              "(row_hash TEXT PRIMARY KEY)"))
+            conn.execute(text("delete from personal_chunk"))
+            raw.executemany("insert into personal_chunk values (?)",
+                            ((h,) for h in row_hash.unique().tolist()))
+            earlier = pd.read_sql("select c.row_hash, p.id from personal_chunk c "
+                                  "join ists_personal p on p.row_hash = c.row_hash", con=conn)
+            earlier_id = row_hash.map(pd.Series(earlier['id'].values, index=earlier['row_hash']))
+            kept_id = kept_id.where(earlier_id.isna(), earlier_id).astype('int64')
+            merged = kept_id != personal['id']
+            raw.executemany("insert into ists_personal_merge values (?, ?)",
+                            zip(personal.loc[merged, 'id'].tolist(), kept_id[merged].tolist()))
+            raw.executemany("delete from ists_personal where id = ?",
+                            ((i,) for i in personal.loc[merged, 'id'].tolist()))
+            raw.executemany("update ists_personal set row_hash = ? where id = ?",
+                            zip(row_hash[~merged].tolist(), personal.loc[~merged, 'id'].tolist()))
+        last_id = int(personal['id'].iloc[-1])
+        hashed += len(personal)
+        merged_rows += int(merged.sum())
+        print("     hashed " + str(hashed) + " rows, " + str(merged_rows) + " duplicates merged   " +
+              str(datetime.datetime.now()))
+    has_claims = conn.execute(text("select count(*) from sqlite_master "
+                                   "where type = 'table' and name = 'ists_claims'")).scalar()
+    with conn.begin():
+        if has_claims:
+            conn.execute(text("""update ists_claims
+                                    set personal_id = (select kept_id from ists_personal_merge
+                                                        where id = personal_id)
+                                  where personal_id in (select id from ists_personal_merge)"""))
+        conn.execute(text("drop table ists_personal_merge"))
+    print('added ists_personal.row_hash ' + str(datetime.datetime.now()))
+
+
+def partition_path(partition_dir, year):
+    return os.path.join(partition_dir, "ists_claims_" + str(year) + ".db")
+
+
+def create_partition_registry(conn):
+    """Table of the years with a partition file, which readers use to check they
+    can see every partition, and to open frozen years' files as immutable
+    """
+    conn.execute(text("""CREATE TABLE IF NOT EXISTS ists_partitions (
+                             year   INTEGER PRIMARY KEY,
+                             frozen INTEGER NOT NULL DEFAULT 0
+                         )"""))
+
+
+def freeze_partitions(conn, before_year):
+    """Freeze partitions of years before before_year: the ETL won't write to them
+    again, so readers can open them as immutable, skipping all locking.
+    Reloading a week of a frozen year needs unfreeze_partition() first, with no
+    readers running.
+    """
+    create_partition_registry(conn)
+    conn.execute(text("update ists_partitions set frozen = 1 where year < :year and not frozen"),
+                 year=before_year)
+
+
+def unfreeze_partition(conn, year):
+    create_partition_registry(conn)
+    conn.execute(text("update ists_partitions set frozen = 0 where year = :year"), year=year)
+
+
+def attach_partition(conn, partition_dir, year):
+    """Attach year's partition file as part, creating it if need be, and record it
+    in ists_partitions. Raises ValueError if the year is frozen.
+    Each partition file (ists_claims_YYYY.db) has one ists_claims table, like the
+    main one, for all of that year's LR dates, indexed on (lr_date, personal_id).
+    """
+    create_partition_registry(conn)
+    frozen = conn.execute(text("select frozen from ists_partitions where year = :year"),
+                          year=year).scalar()
+    if frozen:
+        raise ValueError("ISTS partition " + str(year) + " is frozen, so readers may have it "
+                         "open as immutable. Unfreeze it (ists.unfreeze_partition()) first.")
+    conn.execute(text("insert or ignore into ists_partitions (year) values (:year)"), year=year)
+    os.makedirs(partition_dir, exist_ok=True)
+    ddl = conn.execute(text(
+        "select sql from sqlite_master where type = 'table' and name = 'ists_claims'"
+    )).scalar()
+    raw = conn.connection
+    raw.execute("attach database ? as part", (partition_path(partition_dir, year),))
+    raw.execute(re.sub(r'^\s*CREATE\s+TABLE\s+ists_claims',
+                       'CREATE TABLE IF NOT EXISTS part.ists_claims', ddl, flags=re.IGNORECASE))
+    raw.execute("create index if not exists part.idx_ists_claims_lr_pid "
+                "on ists_claims (lr_date, personal_id)")
+
+
+def migrate_claims_to_partitions(db, partition_dir):
+    """Move any claims in the main ists_claims table to the partition files, a year
+    at a time. Rows already in a partition for the same LR dates are replaced.
+    Once the main table is empty this is just one query.
+    """
+    engine = sa.create_engine(db, echo=False)
+    conn = engine.connect()
+    try:
+        years = [int(row[0]) for row in conn.execute(text(
+            "select distinct substr(lr_date, 1, 4) from ists_claims where lr_date is not null"))]
+        raw = conn.connection
+        for year in years:
+            print('moving ' + str(year) + ' ists_claims to partition ' + str(datetime.datetime.now()))
+            in_year = "lr_date >= '" + str(year) + "' and lr_date < '" + str(year + 1) + "'"
+            attach_partition(conn, partition_dir, year)
+            try:
+                raw.execute("begin")
+                raw.execute("delete from part.ists_claims where lr_date in "
+                            "(select distinct lr_date from main.ists_claims where " + in_year + ")")
+                raw.execute("insert into part.ists_claims select * from main.ists_claims where " +
+                            in_year)
+                raw.execute("delete from main.ists_claims where " + in_year)
+                raw.commit()
+            except:
+                raw.rollback()
+                raise
+            finally:
+                raw.execute("detach database part")
+    finally:
+        conn.close()
+        engine.dispose()
 
 
 class Ists_file(data_file.Data_file):
+    bulk_tables = ('ists_claims',)
+    # Each load first deletes its LR date's claims
+    bulk_keep_indexes = ('idx_ists_cl_lr_d',)
 
     def __init__(self, sunday, settings):
         self.db = settings['db']
@@ -29,10 +228,19 @@ class Ists_file(data_file.Data_file):
         self.date_cols = ["clm_reg_date", "clm_comm_date", 'date_of_birth']
         self.filename = self.location + "\\ists_ext_" + \
                     self.file_date.strftime("%d%b%Y").lower() + ".sas7bdat"
+        # Files with more rows than chunksize are decoded in chunks across processes
+        self.chunksize = settings['ists'].get('chunksize', 500000)
+        self.num_processes = settings['ists'].get('num_processes', os.cpu_count())
+        # If set, claims go to per-year partition files in this directory. Readers
+        # find it without configuration if it's ists_partitions next to the database.
+        self.partition_dir = settings['ists'].get('partition_dir')
+        # If set, a load freezes partitions more than this many years before its own
+        self.freeze_after_years = settings['ists'].get('freeze_after_years')
+        self.bulk_load = settings['ists'].get('bulk_load', settings.get('bulk_load', False))
 
     def read(self):
         print('----  begin`>' + str(datetime.datetime.now()))
-        engine = sa.create_engine(self.db)
+        engine = bulk.create_engine(self.db)
         conn = engine.connect()
         ists_file = self.location + "\\ists_ext_" + \
                     self.file_date.strftime("%d%b%Y").lower() + ".sas7bdat"
@@ -41,8 +249,8 @@ class Ists_file(data_file.Data_file):
             cols_fl = self.personal_cols.copy()
             cols_fl.extend(self.claim_cols)
             try:
-                data = self.load(ists_file, cols_fl)
-                self.processData(data, lr_date, self.claim_cols, self.personal_cols, self.to_int_cols)
+                data = self.load(ists_file, cols_fl, lr_date)
+                data['row_hash'] = personal_row_hash(data)
                 data.to_sql("ists_data_tmp", con=engine, if_exists="replace")
                 self.run_sql(conn, ists_file)
             except:
@@ -57,61 +265,87 @@ class Ists_file(data_file.Data_file):
         conn.execute(t)
         print( '1.1>' + str(datetime.datetime.now()))
         t = text(""" CREATE INDEX idx_ists_t_1 ON ists_data_tmp (
-                        ppsn
+                        row_hash
                      )
                  """)
         conn.execute(t)
         print( '2>' + str(datetime.datetime.now()))
-        t = text("""  INSERT INTO ists_personal (date_of_birth, sex, nat_code, occupation, ppsn, RELATED_RSI_NO)      
-                      select te.date_of_birth, te.sex, te.nat_code, te.occupation, te.ppsn, te.RELATED_RSI_NO
+        # New people only - existing row_hash values conflict with the unique index
+        t = text("""  INSERT OR IGNORE INTO ists_personal (date_of_birth, sex, nat_code, occupation, ppsn, RELATED_RSI_NO, row_hash)
+                      select te.date_of_birth, te.sex, te.nat_code, te.occupation, te.ppsn, te.RELATED_RSI_NO, te.row_hash
                           from ists_data_tmp te
-                          left join ists_personal pd 
-                              on te.ppsn = pd.ppsn
-                                  and te.date_of_birth = pd.date_of_birth 
-                                  and te.sex = pd.sex
-                                  and te.nat_code = pd.nat_code
-                                  and te.occupation = pd.occupation
-                                  and ((te.RELATED_RSI_NO IS NULL AND pd.RELATED_RSI_NO IS NULL) OR (te.RELATED_RSI_NO = pd.RELATED_RSI_NO))
-                        where pd.ppsn IS NULL
-                        group by te.date_of_birth, te.sex, te.nat_code, te.occupation, te.ppsn, te.RELATED_RSI_NO;
+                        group by te.row_hash;
             """)
         conn.execute(t)
         print( '3>' + str(datetime.datetime.now()))
-        t = text(""" 
-                       insert into ists_claims ( lr_code, lr_flag, lls_code, clm_reg_date, clm_comm_date, 
-                                                     location, CLM_STATUS, CLM_SUSP_DTL_REAS_CODE, CDAS, ada_code, 
-                                                     JobPath_Flag, JobPathHold, PERS_RATE, ADA_AMT, CDA_AMT, MEANS, 
-                                                     EMEANS, NEMEANS, NET_FLAT, FUEL, RRA, WEEKLY_RATE, Recip_flag, 
-                                                     lr_date, personal_id )         
-                       select te.lr_code, te.lr_flag, te.lls_code, te.clm_reg_date, te.clm_comm_date, te.location, te.CLM_STATUS,
-                              te.CLM_SUSP_DTL_REAS_CODE, te.CDAS, te.ada_code, te.JobPath_Flag, te.JobPathHold, te.PERS_RATE, 
-                              te.ADA_AMT, te.CDA_AMT, te.MEANS, te.EMEANS, te.NEMEANS, te.NET_FLAT, te.FUEL, te.RRA, te.WEEKLY_RATE,
-                              te.Recip_flag, te.lr_date, pd.id
-                           from ists_data_tmp te
-                           join ists_personal pd 
-                               on te.ppsn = pd.ppsn
-                                   and te.date_of_birth = pd.date_of_birth 
-                                   and te.sex = pd.sex
-                                   and te.nat_code = pd.nat_code
-                                   and te.occupation = pd.occupation
-                                   and ((te.RELATED_RSI_NO IS NULL AND pd.RELATED_RSI_NO IS NULL) OR (te.RELATED_RSI_NO = pd.RELATED_RSI_NO)) 
-                    """)
-        conn.execute(t)
+        if self.partition_dir:
+            self.load_partition(conn)
+        else:
+            conn.execute(text(CLAIMS_INSERT.format(table="ists_claims")))
         print( '4>' + str(datetime.datetime.now()))
         t = text("""  drop table ists_data_tmp """)
         conn.execute(t)
         print( '5>' + str(datetime.datetime.now()))
 
-    def load(self, filepath, cols):
-        data, meta = pyreadstat.read_sas7bdat(filepath, encoding='LATIN1')
-        data = data[cols]
-        return data
+    def load_partition(self, conn):
+        """Replace this week's claims in its year's partition file.
+        The week's claims are first built in a staging table in the partition file,
+        outside any transaction on the live table. Then one short transaction deletes
+        the week's old rows, copies the staged rows in and drops the staging table,
+        so a failed load leaves the year's claims as they were.
+        """
+        lr_date = self.file_date - timedelta(days=2)
+        raw = conn.connection
+        attach_partition(conn, self.partition_dir, lr_date.year)
+        try:
+            raw.execute("drop table if exists part.ists_claims_stage")
+            raw.execute("create table part.ists_claims_stage as "
+                        "select * from part.ists_claims where 0")
+            raw.execute(CLAIMS_INSERT.format(table="part.ists_claims_stage"))
+            raw.commit()
+            raw.execute("begin")
+            raw.execute("delete from part.ists_claims "
+                        "where lr_date in (select lr_date from ists_data_tmp group by lr_date)")
+            raw.execute("insert into part.ists_claims select * from part.ists_claims_stage")
+            raw.execute("drop table part.ists_claims_stage")
+            raw.commit()
+        except:
+            raw.rollback()
+            raise
+        finally:
+            raw.execute("detach database part")
+        if self.freeze_after_years is not None:
+            freeze_partitions(conn, lr_date.year - self.freeze_after_years)
+
+    def load(self, filepath, cols, lr_date):
+        """Read just cols from SAS file and processData() them.
+        Big files are read in chunks, each decoded across num_processes processes,
+        and each chunk is processed as it's read.
+        """
+        _, meta = pyreadstat.read_sas7bdat(filepath, metadataonly=True)
+        usecols = [col for col in cols if col in meta.column_names]
+        if meta.number_rows is not None and meta.number_rows <= self.chunksize:
+            chunks = [pyreadstat.read_sas7bdat(filepath, encoding='LATIN1', usecols=usecols)]
+        else:
+            chunks = pyreadstat.read_file_in_chunks(
+                pyreadstat.read_sas7bdat, filepath, chunksize=self.chunksize,
+                multiprocess=self.num_processes > 1, num_processes=self.num_processes,
+                encoding='LATIN1', usecols=usecols)
+        processed = []
+        for chunk, _ in chunks:
+            # Keep cols order, as before
+            chunk = chunk[usecols]
+            self.processData(chunk, lr_date, self.claim_cols, self.personal_cols, self.to_int_cols)
+            processed.append(chunk)
+            print('   ' + str(sum(len(c) for c in processed)) + ' rows>' + str(datetime.datetime.now()))
+        return pd.concat(processed, ignore_index=True)
 
     def processData(self, data, lr_date, claim_cols, personal_cols, to_int_cols):
-        data[to_int_cols] = data[to_int_cols].fillna(0).astype("int8")
+        # Older extracts don't have JobPath columns
         if "JobPath_Flag" not in data.columns.to_list():
             data["JobPath_Flag"] = 0
         if "JobPathHold" not in data.columns.to_list():
             data["JobPathHold"] = 0
+        data[to_int_cols] = data[to_int_cols].fillna(0).astype("int8")
         data["lr_date"] = lr_date
 
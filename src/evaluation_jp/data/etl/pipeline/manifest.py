@@ -0,0 +1,159 @@
+import datetime
+import hashlib
+import os
+
+import sqlalchemy as sa
+from sqlalchemy import text
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+MOD_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+HASH_CHUNK_SIZE = 1 << 22
+
+
+def content_hash(filename, sample_blocks=None, chunk_size=HASH_CHUNK_SIZE):
+    """Return "<method>:<hex digest>" hash of filename contents, read in chunks.
+    Uses xxh64 if xxhash is installed, else blake2b.
+    With sample_blocks (at least 2), files bigger than sample_blocks chunks just have
+    the file size and sample_blocks evenly spaced chunks (incl. first and last) hashed.
+    """
+    if xxhash is not None:
+        method, h = 'xxh64', xxhash.xxh64()
+    else:
+        method, h = 'blake2b', hashlib.blake2b(digest_size=16)
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        if sample_blocks is None or size <= sample_blocks * chunk_size:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+        else:
+            method += '-s' + str(sample_blocks)
+            h.update(str(size).encode())
+            step = (size - chunk_size) / (sample_blocks - 1)
+            for i in range(sample_blocks):
+                f.seek(int(i * step))
+                h.update(f.read(chunk_size))
+    return method + ':' + h.hexdigest()
+
+
+class Load_manifest:
+    """In-memory copy of the load_file table, plus cached file stats.
+
+    load_file is read once per database and each source directory is listed once,
+    so the complete() checks of all load tasks are dictionary lookups instead of
+    a new engine, two queries and a network stat per task.
+    Each load also records the file size and content hash. If a file's modification
+    date changes (e.g. copied on the network share) but its size and hash don't,
+    it isn't reloaded and its new modification date is recorded.
+    Content hashes are kept with the modification date and size they were worked
+    out for, so a load reuses the hash its processed() check needed.
+    Use Load_manifest.for_db(db) to share one manifest per database.
+    """
+
+    _manifests = {}
+
+    def __init__(self, db, sample_blocks=None):
+        self.db = db
+        self.engine = sa.create_engine(db)
+        self.sample_blocks = sample_blocks
+        self.loaded = None
+        self.dir_stats = {}
+        self.hashes = {}
+
+    @classmethod
+    def for_db(cls, db):
+        if db not in cls._manifests:
+            cls._manifests[db] = cls(db)
+        return cls._manifests[db]
+
+    def add_hash_columns(self, conn):
+        """Add file_size and content_hash columns to load_file tables without them"""
+        columns = [row[1] for row in conn.execute(text("pragma table_info(load_file)"))]
+        if 'file_size' not in columns:
+            conn.execute(text("alter table load_file add column file_size INTEGER"))
+        if 'content_hash' not in columns:
+            conn.execute(text("alter table load_file add column content_hash TEXT"))
+
+    def refresh(self):
+        """(Re)read load_file and forget cached file stats"""
+        with self.engine.begin() as conn:
+            self.add_hash_columns(conn)
+            rows = conn.execute(
+                text("select file, mod_date, file_size, content_hash from load_file"))
+            self.loaded = {row[0]: tuple(row[1:]) for row in rows}
+        self.dir_stats = {}
+
+    def stat(self, filename):
+        """Return os.stat_result for filename, or None if it isn't there.
+        Stats come from one listing of filename's directory.
+        """
+        directory, name = os.path.split(filename)
+        if directory not in self.dir_stats:
+            stats = {}
+            try:
+                with os.scandir(directory or '.') as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            stats[os.path.normcase(entry.name)] = entry.stat()
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            self.dir_stats[directory] = stats
+        return self.dir_stats[directory].get(os.path.normcase(name))
+
+    def mod_date(self, filename):
+        return datetime.datetime.fromtimestamp(self.stat(filename).st_mtime)
+
+    def content_hash(self, filename):
+        """Return content_hash() of filename, hashing it again only if it's changed"""
+        st = os.stat(filename)
+        if filename in self.hashes and self.hashes[filename][0] == (st.st_mtime, st.st_size):
+            return self.hashes[filename][1]
+        file_hash = content_hash(filename, self.sample_blocks)
+        self.hashes[filename] = ((st.st_mtime, st.st_size), file_hash)
+        return file_hash
+
+    def processed(self, filename):
+        if self.loaded is None:
+            self.refresh()
+        if self.stat(filename) is None:
+            print("source file " + filename + " not present")
+            return True
+        if filename not in self.loaded:
+            print("source file " + filename + " not loaded")
+            return False
+        loaded_mod_date, loaded_size, loaded_hash = self.loaded[filename]
+        mod_date = self.mod_date(filename).strftime(MOD_DATE_FORMAT)
+        if loaded_mod_date == mod_date:
+            return True
+        if (loaded_hash is not None and loaded_size == self.stat(filename).st_size
+                and self.content_hash(filename) == loaded_hash):
+            print("source file " + filename + " has new modification date but same contents")
+            with self.engine.begin() as conn:
+                conn.execute(text("update load_file set mod_date = :mod_date where file = :file"),
+                             mod_date=mod_date, file=filename)
+            self.loaded[filename] = (mod_date, loaded_size, loaded_hash)
+            return True
+        print("source file " + filename + " has been modified")
+        return False
+
+    def record(self, filename, mtime, file_size=None, file_hash=None):
+        """Record filename (with modification date mtime, size and content hash)
+        as loaded now
+        """
+        mod_date = mtime.strftime(MOD_DATE_FORMAT)
+        with self.engine.begin() as conn:
+            self.add_hash_columns(conn)
+            conn.execute(text("delete from load_file where file = :file"), file=filename)
+            conn.execute(
+                text("insert into load_file "
+                     "(file, mod_date, load_time, file_size, content_hash) "
+                     "values (:file, :mod_date, :load_time, :file_size, :content_hash)"),
+                file=filename, mod_date=mod_date,
+                load_time=datetime.datetime.now().strftime(MOD_DATE_FORMAT),
+                file_size=file_size, content_hash=file_hash)
+        if self.loaded is not None:
+            self.loaded[filename] = (mod_date, file_size, file_hash)
+        self.dir_stats.pop(os.path.split(filename)[0], None)
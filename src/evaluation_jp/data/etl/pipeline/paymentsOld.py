@@ -1,96 +1,41 @@
 import pandas as pd
-import futil
 import glob
 import datetime
 import os
 import sqlalchemy as sa
 from sqlalchemy import text
 from sas7bdat import SAS7BDAT
+import bulk_apply
 import data_file
+import evaluation_jp.data.etl.pipeline.bulk as bulk
+import extsort
 import luigi
 from os import path
 
+PAY_OLD_COLUMNS = ['CLMT_RSI_NO', 'CLM_SCH_CODE', 'CLM_REG_DATE', 'ISSUE_DATE', 'STAT_CODE', 'AMOUNT', 'year']
+PAY_OLD_NUMERIC = [c in ('AMOUNT', 'year') for c in PAY_OLD_COLUMNS]
+
 
 class PaymentsOld_file(data_file.Data_file):
+    bulk_tables = ('pay_old',)
 
     def __init__(self, settings):
         self.settings = settings
         self.db = settings['db']
         self.location = settings['pay_old']['location']
+        self.bulk_load = settings['pay_old'].get('bulk_load', settings.get('bulk_load', False))
         self.dir = settings['pay_old']['workdir']
         if not(os.path.exists(str( self.dir))):
             os.makedirs(self.dir, exist_ok=True)
 
-    def check_file(self, filename, conn):
-        if os.path.isfile(filename):
-            t = text("select count(*) from load_file where file='" + filename + "'")
-            if next(conn.execute(t))[0] > 0:
-                mtime = futil.modification_date(filename)
-                t = text("select count(*) from load_file where file='" + filename +
-                         "' and mod_date='" + mtime.strftime("%Y-%m-%d %H:%M:%S.%f") + "'")
-                if next(conn.execute(t))[0] > 0:
-                    return True
-                else:
-                    return False
-            else:
-                return False
-        else:
-            return True
-
-    def processed(self):
-        engine = sa.create_engine(self.db)
-        conn = engine.connect()
-        self.processed_files = []
-        result = True
-        for f in glob.glob(self.location + self.settings['pay_old']['pattern']):
-            self.processed_files.append( {'file': f ,
-                                          'mod': futil.modification_date(f).strftime("%Y-%m-%d %H:%M:%S.%f"),
-                                          'current': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f") } )
-            if not( self.check_file( f, conn) ):
-                result = False
-        return result
-
-    def do_process(self):
-        self.read()
-        engine = sa.create_engine( self.db)
-        conn = engine.connect()
-        for d in self.processed_files:
-            t = text("delete from load_file where file ='" +
-                     d['file'] + "'")
-            conn.execute(t)
-            t = text("insert into load_file (file, mod_date, load_time) values('" +
-                 d['file'] +
-                 "', '" +d['mod'] +
-                 "', '" + d['current'] + "')")
-            conn.execute(t)
+    def source_files(self):
+        return glob.glob(self.location + self.settings['pay_old']['pattern'])
 
     def insertData(self, diff_file):
-        headings = ['CLMT_RSI_NO', 'CLM_SCH_CODE', 'CLM_REG_DATE', 'ISSUE_DATE', 'STAT_CODE', 'AMOUNT','year']
-        engine = sa.create_engine( self.db, echo=False)
-        c = 0
-        count = 0
-        insert_buffer = []
-        print(" start " + str(datetime.datetime.now()))
         with open(diff_file, 'rt') as diffin:
-            for l in diffin:
-                if c >= 1000000:
-                    df = pd.DataFrame(insert_buffer, columns=headings)
-                    insert_buffer = []
-                    df.to_sql("pay_old", con=engine, if_exists="append", index=False)
-                    print("     " + str(count) + "   " + str(datetime.datetime.now()))
-                    count += 1
-                    c = 0
-                c += 1
-                if l[0] == '>':
-                    if l[1] == '"':
-                        print("error   "+l)
-                    else:
-                        insert_buffer.append(l[1:].split(","))
-            df = pd.DataFrame(insert_buffer, columns=headings)
-            df.to_sql("pay_old", con=engine, if_exists="append", index=False)
-            print("     " + str(count) + "   " + str(datetime.datetime.now()))
-            count += 1
-        print("   end " + str(datetime.datetime.now()))
+            bulk_apply.insert_lines(self.db, 'pay_old', PAY_OLD_COLUMNS, PAY_OLD_NUMERIC,
+                                    (l[1:] for l in diffin if l[0] == '>'),
+                                    reject_file=self.dir+'diff-payold.rej')
 
     def deleteData(self, diff_file):
         headings = ['CLMT_RSI_NO', 'CLM_SCH_CODE', 'CLM_REG_DATE', 'ISSUE_DATE', 'STAT_CODE', 'AMOUNT','year']
@@ -170,7 +115,7 @@ class PaymentsOld_file(data_file.Data_file):
         # os.remove( self.dir+'diff-payold.txt')
         # shutil.move(self.dir + 'output-payold-sort.txt', self.dir + 'payold_current.txt')
 
-        engine = sa.create_engine(self.db)
+        engine = bulk.create_engine(self.db)
         conn = engine.connect()
         print( '1>   ' + str(datetime.datetime.now()))
         t = text("drop table pay_old" )
@@ -281,59 +226,11 @@ class PaymentsOld_sort(luigi.Task):
         self.dir = self.settings['pay_old']['workdir']
         return path.exists(self.dir+'output-payold-sort.txt')
 
-    def merge_sort(self, infile, outfile, dir):
-        chunks = []
-        print(" start " + str(datetime.datetime.now()))
-        count = 0
-        c = 0
-        outtfile = open(dir + '\\temp_pay_' + str(count) + '.txt', 'wt')
-        with open(infile, 'rt') as inf:
-            for l in inf:
-                if c >= int(self.settings['pay_old']['blocksize']):
-                    outtfile.close()
-                    os.system('sort < ' + self.dir + '\\temp_pay_' + str(count) + '.txt  > ' +  self.dir + '\\temp_pay_' + str( count) + '_sort.txt')
-                    print("     " + str(count) + "   " + str(datetime.datetime.now()))
-                    chunks.append(self.dir + '\\temp_pay_' + str(count) + '_sort.txt')
-                    count += 1
-                    outtfile = open(self.dir + '\\temp_pay_' + str(count) + '.txt', 'wt')
-                    c = 0
-                if (len(l) > 1):
-                    outtfile.write(l.strip() + '\n')
-                    c += 1
-        outtfile.close()
-        if c > 0:
-            os.system( 'sort < ' +  self.dir + '\\temp_pay_' + str(count) + '.txt  > ' +  self.dir + '\\temp_pay_' + str(count) + '_sort.txt')
-            chunks.append(self.dir +'temp_pay_' + str(count) + '_sort.txt')
-        print("     " + str(count) + "   " + str(datetime.datetime.now()))
-        print("   end " + str(datetime.datetime.now()))
-        sfiles = []
-        slines = []
-        for ff in chunks:
-            f = open(ff, 'rt')
-            sfiles.append(f)
-            li = f.readline()
-            if li:
-                slines.append(li)
-            else:
-                slines.append('zzzzzzzzzzzzzzzzzzzzzzzzzzzzzzz')
-        fout = open(outfile, 'wt')
-        while True:
-            ind = slines.index(min(slines))
-            if slines[ind] == 'zzzzzzzzzzzzzzzzzzzzzzzzzzzzzzz':
-                break
-            fout.write(slines[ind])
-            slines[ind] = sfiles[ind].readline()
-            if not (slines[ind]):
-                slines[ind] = 'zzzzzzzzzzzzzzzzzzzzzzzzzzzzzzz'
-        fout.close()
-
     def run(self):
         print('Sorting new text')
-        self.merge_sort(self.dir+'output-payold.txt', self.dir+'output-payold-sort.txt', self.dir)
-        for root, dirs, files in os.walk(self.dir, topdown=False):
-            for name in files:
-                if 'temp' in name:
-                    os.remove(os.path.join(root, name))
+        extsort.external_sort(self.dir+'output-payold.txt', self.dir+'output-payold-sort.txt', self.dir,
+                              int(self.settings['pay_old']['blocksize']),
+                              self.settings['pay_old'].get('sort_processes'))
         os.remove(self.dir+'output-payold.txt')
 
 
@@ -0,0 +1,206 @@
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import glob
+import heapq
+import os
+import re
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+import pyreadstat
+import changes
+from bulk_apply import NUMBER_PATTERN
+
+# Snapshot of a SAS file: a directory of Arrow IPC run files, each sorted by key.
+# Every run has columns key (CSV text of the key fields, plus a comma), row_hash,
+# then the data columns: float64 for SAS numbers in numeric columns (null if
+# missing), else the text csv.writer would have written for the value.
+RUN_PATTERN = 'run_*.arrow'
+DONE_FILE = '_done'
+# Rows per record batch in run files: the merge holds one batch of every run in memory
+BATCH_ROWS = 10000
+# Characters csv.writer quotes a field for
+QUOTED = re.compile('[,"\r\n]')
+
+
+def csv_text(value):
+    """Return text csv.writer writes for value (before any quoting)"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    return str(value)
+
+
+def csv_field(text):
+    if QUOTED.search(text):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+
+def csv_line(values):
+    return ','.join(csv_field(csv_text(v)) for v in values)
+
+
+def is_datetime_format(sas_format):
+    """True if SAS format sas_format shows a date and time (the sas7bdat package, which
+    made the old text export, gave a datetime for these, and a date for other date
+    formats)
+    """
+    return re.match(r'(DATETIME|DATEAMPM|[BE]8601DT|IS8601DT)', (sas_format or '').upper())
+
+
+def column_text(s, sas_format):
+    """Return text of column s as the old text export had it: dates as YYYY-MM-DD,
+    datetimes as YYYY-MM-DD HH:MM:SS (plus microseconds if any), missing as ''
+    """
+    if not pd.api.types.is_datetime64_any_dtype(s):
+        return s.astype(object).where(s.notna(), '').astype(str)
+    if is_datetime_format(sas_format):
+        text = s.dt.strftime('%Y-%m-%d %H:%M:%S')
+        fraction = s.dt.microsecond != 0
+        if fraction.any():
+            text = text.where(~fraction, s.dt.strftime('%Y-%m-%d %H:%M:%S.%f'))
+    else:
+        text = s.dt.strftime('%Y-%m-%d')
+    return text.where(s.notna(), '')
+
+
+def chunk_table(df, columns, numeric, key_fields, formats=None):
+    """Return chunk df of a SAS file as an Arrow table sorted by key, with row hashes.
+    Values hash the same as the line the old text export would have had (see
+    changes.row_hash()), with dates formatted as it had them using SAS formats.
+    The text each row hashes is built a column at a time.
+    """
+    formats = formats or [None] * len(columns)
+    stored = []
+    texts = []
+    hashed = []
+    for col, num, sas_format in zip(columns, numeric, formats):
+        s = df[col]
+        if num and pd.api.types.is_float_dtype(s):
+            text = s.map(repr).where(s.notna(), '')
+            stored.append(s)
+            texts.append(text)
+            hashed.append(text)
+        else:
+            text = column_text(s, sas_format)
+            stored.append(text)
+            texts.append(text)
+            if num:
+                # Number text is hashed as the float SQLite stores
+                is_number = text.str.match(NUMBER_PATTERN)
+                text = text.copy()
+                text[is_number] = pd.to_numeric(text[is_number].str.strip()).astype(float).map(repr)
+            hashed.append(text)
+    keys = texts[0].map(csv_field) + ','
+    for text in texts[1:key_fields]:
+        keys = keys + text.map(csv_field) + ','
+    keys = keys.values.astype(str)
+    order = np.argsort(keys, kind='stable')
+    row_texts = hashed[0].str.cat(hashed[1:], sep='\x1f')
+    # row_hash() ignores trailing newlines: rare, so only strip them where there are any
+    newlines = row_texts.str.contains('[\r\n]').to_numpy()
+    if newlines.any():
+        stripped = [text[newlines].str.rstrip('\r\n') for text in hashed]
+        row_texts[newlines] = stripped[0].str.cat(stripped[1:], sep='\x1f')
+    hashes = np.fromiter((changes.text_hash(t) for t in row_texts), dtype=np.int64,
+                         count=len(row_texts))
+    arrays = [pa.array(keys[order], type=pa.string()), pa.array(hashes[order], type=pa.int64())]
+    for s in stored:
+        if pd.api.types.is_float_dtype(s):
+            arrays.append(pa.array(s.values[order], type=pa.float64(), from_pandas=True))
+        else:
+            arrays.append(pa.array(s.values[order], type=pa.string()))
+    return pa.Table.from_arrays(arrays, ['key', 'row_hash'] + columns)
+
+
+def write_run(df, run_file, columns, numeric, key_fields, formats):
+    """Write chunk df as run_file (see chunk_table()). Run in a worker process."""
+    table = chunk_table(df, columns, numeric, key_fields, formats)
+    with pa.OSFile(run_file, 'wb') as sink:
+        writer = pa.ipc.new_file(sink, table.schema)
+        writer.write_table(table, max_chunksize=BATCH_ROWS)
+        writer.close()
+    return run_file
+
+
+def convert_sas(source, run_dir, columns, numeric, key_fields, chunksize=1000000,
+                limit=0, num_processes=None):
+    """Convert SAS file source to a directory of sorted, row-hashed Arrow run files.
+    The SAS file is read in chunks of chunksize rows by pyreadstat (limit rows at most,
+    if set), decoded across num_processes processes. Each chunk is sorted, hashed and
+    written as one run in a pool of num_processes worker processes while the next
+    chunks are read. SAS columns are taken in order as columns.
+    """
+    print(" start " + str(datetime.datetime.now()))
+    processes = num_processes or 1
+    os.makedirs(run_dir, exist_ok=True)
+    # Until the new runs are all written, the directory isn't a converted snapshot
+    if converted(run_dir):
+        os.remove(os.path.join(run_dir, DONE_FILE))
+    for old_run in glob.glob(os.path.join(run_dir, RUN_PATTERN)):
+        os.remove(old_run)
+    chunks = pyreadstat.read_file_in_chunks(
+        pyreadstat.read_sas7bdat, source, chunksize=chunksize, limit=limit,
+        multiprocess=processes > 1, num_processes=processes,
+        dates_as_pandas_datetime=True)
+    count = 0
+    pending = []
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for df, meta in chunks:
+            formats = [meta.original_variable_types.get(c) for c in df.columns]
+            df.columns = columns
+            # Keep at most one chunk per process in flight, to bound memory
+            if len(pending) >= processes:
+                pending.pop(0).result()
+                count += 1
+                print("     " + str(count) + "   " + str(datetime.datetime.now()))
+            run_file = os.path.join(run_dir, 'run_%05d.arrow' % (count + len(pending)))
+            pending.append(pool.submit(write_run, df, run_file, columns, numeric, key_fields,
+                                       formats))
+        for run in pending:
+            run.result()
+            count += 1
+            print("     " + str(count) + "   " + str(datetime.datetime.now()))
+    open(os.path.join(run_dir, DONE_FILE), 'w').close()
+    print("   end " + str(datetime.datetime.now()))
+
+
+def converted(run_dir):
+    return os.path.exists(os.path.join(run_dir, DONE_FILE))
+
+
+def run_rows(run_file):
+    """Yield (key, row_hash, values) of run_file, a batch at a time"""
+    reader = pa.ipc.open_file(pa.memory_map(run_file, 'r'))
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        columns = [column.to_pylist() for column in batch.columns]
+        yield from zip(columns[0], columns[1], zip(*columns[2:]))
+
+
+class Run_rows:
+    """Rows of an Arrow run file snapshot (see convert_sas()), grouped by key.
+    The runs are merged with heapq.merge as they're read.
+    """
+
+    def __init__(self, run_dir):
+        self.run_files = sorted(glob.glob(os.path.join(run_dir, RUN_PATTERN)))
+
+    def groups(self):
+        key, group = None, []
+        rows = heapq.merge(*(run_rows(f) for f in self.run_files), key=lambda row: row[0])
+        for row in rows:
+            if row[0] != key and group:
+                yield key, group
+                group = []
+            key = row[0]
+            group.append(row)
+        if group:
+            yield key, group
+
+    def hash(self, row):
+        return row[1]
+
+    def line(self, row):
+        return csv_line(row[2])
@@ -0,0 +1,118 @@
+import datetime
+
+import sqlalchemy as sa
+import evaluation_jp.data.etl.pipeline.bulk as bulk
+
+
+# Earnings records with any of these flags set are left out of summaries
+EARNINGS_ERROR_FLAGS = ['PAY_ERR_IND', 'PRSI_ERR_IND', 'WIES_ERR_IND',
+                        'CLASS_ERR_IND', 'PRSI_REFUND_IND', 'CANCELLED_IND']
+
+SUMMARY_TABLES = {
+    'earnings_summary': {
+        'source': 'earnings',
+        'id_col': 'RSI_NO',
+        'create': """
+            CREATE TABLE IF NOT EXISTS earnings_summary (
+                ppsn          TEXT,
+                CON_YEAR      INTEGER,
+                class         TEXT,
+                EARNINGS_AMT  FLOAT,
+                PRIMARY KEY (ppsn, CON_YEAR, class)
+            ) WITHOUT ROWID
+            """,
+        # Class A and class S PRSI contributions, everything else as other
+        'select': """
+            SELECT RSI_NO AS ppsn,
+                   CAST(CON_YEAR AS INTEGER) AS CON_YEAR,
+                   CASE substr(CONS_CLASS_CODE, 1, 1)
+                       WHEN 'A' THEN 'a'
+                       WHEN 'S' THEN 's'
+                       ELSE 'other'
+                   END AS class,
+                   SUM(EARNINGS_AMT) AS EARNINGS_AMT
+                FROM earnings
+                WHERE RSI_NO IS NOT NULL AND CON_YEAR IS NOT NULL
+                  AND """ + " AND ".join("COALESCE(" + flag + ", '') = ''"
+                                         for flag in EARNINGS_ERROR_FLAGS) + """
+                  {id_filter}
+                GROUP BY 1, 2, 3
+            """,
+    },
+    'payments_summary': {
+        'source': 'payments',
+        'id_col': 'ppsn',
+        'create': """
+            CREATE TABLE IF NOT EXISTS payments_summary (
+                ppsn         TEXT,
+                QTR          TEXT,
+                SCHEME_TYPE  TEXT,
+                AMOUNT       FLOAT,
+                PRIMARY KEY (ppsn, QTR, SCHEME_TYPE)
+            ) WITHOUT ROWID
+            """,
+        'select': """
+            SELECT ppsn,
+                   QTR,
+                   COALESCE(SCHEME_TYPE, '') AS SCHEME_TYPE,
+                   SUM(AMOUNT) AS AMOUNT
+                FROM payments
+                WHERE ppsn IS NOT NULL AND QTR IS NOT NULL
+                  {id_filter}
+                GROUP BY 1, 2, 3
+            """,
+    },
+}
+
+
+def create_summary_tables(conn):
+    for table in SUMMARY_TABLES.values():
+        conn.execute(sa.text(table['create']))
+
+
+def diff_file_ids(diff_file):
+    """Return set of ids (first field) on every insert or delete line of diff_file"""
+    ids = set()
+    with open(diff_file, 'rt') as diffin:
+        for l in diffin:
+            if l[0] in '<>' and len(l) > 1:
+                ids.add(l[1:].split(',', 1)[0].strip().strip('"'))
+    return ids
+
+
+def refresh_summary(db, summary_table, diff_file=None, ids=None):
+    """Bring summary_table up to date with its source table.
+    With ids (or a diff_file), just recalculate summaries for those ids (or the ids
+    changed by that diff). Without either (or if the summary table is empty), rebuild
+    the whole table.
+    """
+    table = SUMMARY_TABLES[summary_table]
+    engine = bulk.create_engine(db, echo=False)
+    conn = engine.raw_connection()
+    print(" start " + summary_table + " " + str(datetime.datetime.now()))
+    try:
+        conn.execute(table['create'])
+        empty = conn.execute('SELECT COUNT(*) FROM (SELECT 1 FROM ' + summary_table +
+                             ' LIMIT 1)').fetchone()[0] == 0
+        if (diff_file is None and ids is None) or empty:
+            conn.execute('DELETE FROM ' + summary_table)
+            conn.execute('INSERT INTO ' + summary_table + ' ' +
+                         table['select'].format(id_filter=''))
+        else:
+            if ids is None:
+                ids = diff_file_ids(diff_file)
+            print("     " + str(len(ids)) + " ids changed")
+            conn.execute('DROP TABLE IF EXISTS temp.summary_ids')
+            conn.execute('CREATE TEMP TABLE summary_ids (id TEXT PRIMARY KEY) WITHOUT ROWID')
+            conn.executemany('INSERT INTO temp.summary_ids (id) VALUES (?)',
+                             ((i,) for i in sorted(ids)))
+            conn.execute('DELETE FROM ' + summary_table +
+                         ' WHERE ppsn IN (SELECT id FROM temp.summary_ids)')
+            id_filter = 'AND ' + table['id_col'] + ' IN (SELECT id FROM temp.summary_ids)'
+            conn.execute('INSERT INTO ' + summary_table + ' ' +
+                         table['select'].format(id_filter=id_filter))
+            conn.execute('DROP TABLE temp.summary_ids')
+        conn.commit()
+    finally:
+        conn.close()
+    print("   end " + summary_table + " " + str(datetime.datetime.now()))
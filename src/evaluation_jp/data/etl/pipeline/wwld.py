@@ -9,6 +9,9 @@ import payments as payments
 import les as les
 import penalties as penalties
 import plss as plss
+import summaries as summaries
+import evaluation_jp.data.etl.pipeline.bulk as bulk
+import evaluation_jp.data.etl.pipeline.manifest as manifest
 import pandas as pd
 import json
 import glob
@@ -156,10 +159,12 @@ class WWLDEtl(luigi.Task):
         conn = engine.connect()
         try:
             t = text("""CREATE TABLE load_file (
-                     id         INTEGER PRIMARY KEY AUTOINCREMENT,
-                     file       TEXT,
-                     mod_date   DATETIME,
-                     load_time  DATETIME)
+                     id           INTEGER PRIMARY KEY AUTOINCREMENT,
+                     file         TEXT,
+                     mod_date     DATETIME,
+                     load_time    DATETIME,
+                     file_size    INTEGER,
+                     content_hash TEXT)
                      """)
             conn.execute(t)
         except:
@@ -173,6 +178,13 @@ class WWLDEtl(luigi.Task):
         self.create_les_sql(conn)
         self.create_penalties_sql(conn)
         self.create_ists_sql(conn)
+        partition_dir = self.settings.get('ists', {}).get('partition_dir')
+        if partition_dir:
+            # One-off move of claims loaded before partitioning was switched on
+            ists.migrate_claims_to_partitions(db, partition_dir)
+        summaries.create_summary_tables(conn)
+        # Put back any indexes a killed bulk load left dropped
+        bulk.restore_deferred_indexes(conn)
 
     def create_plss_sql(self, conn):
         try:
@@ -317,7 +329,8 @@ class WWLDEtl(luigi.Task):
                             LA_DATE_TIME             FLOAT,
                             RECORD_VERS_NO           FLOAT,
                             USER_ID_CODE             FLOAT,
-                            PROGRAM_ID_CODE          TEXT
+                            PROGRAM_ID_CODE          TEXT,
+                            row_hash                 INTEGER
                         )
             """)
             conn.execute(t)
@@ -377,6 +390,7 @@ class WWLDEtl(luigi.Task):
             conn.execute(t)
         except:
             print("table 'earnings' already exists")
+        earnings.add_row_hash(conn)
 
     def create_les_sql(self, conn):
         try:
@@ -490,7 +504,8 @@ class WWLDEtl(luigi.Task):
                             nat_code       TEXT,
                             occupation     TEXT,
                             ppsn           TEXT,
-                            related_rsi_no TEXT
+                            related_rsi_no TEXT,
+                            row_hash       TEXT
                         )
             """)
             conn.execute(t)
@@ -500,8 +515,15 @@ class WWLDEtl(luigi.Task):
                         )
             """)
             conn.execute(t)
+            t = text("""
+                        CREATE UNIQUE INDEX idx_ists_p_row_hash ON ists_personal (
+                            row_hash
+                        )
+            """)
+            conn.execute(t)
         except:
             print("table 'ists_personal' already exists")
+        ists.add_personal_row_hash(conn)
         try:
             t = text("""CREATE TABLE ists_claims (
                             id             INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -632,7 +654,8 @@ class WWLDEtl(luigi.Task):
                             SCHEME_TYPE TEXT,
                             AMOUNT      FLOAT,
                             QTR         TEXT,
-                            count       FLOAT
+                            count       FLOAT,
+                            row_hash    INTEGER
                         )
             """)
             conn.execute(t)
@@ -686,6 +709,7 @@ class WWLDEtl(luigi.Task):
             conn.execute(t)
         except:
             print("table 'payments' already exists")
+        payments.add_row_hash(conn)
 
     def requires(self):
         if 'ists' in self.settings:
@@ -714,6 +738,9 @@ class WWLDEtl(luigi.Task):
         with open(self.config, 'r') as f:
             self.settings = json.load(f)
         self.create_db(self.settings['db'])
+        # Optionally just hash a sample of each big source file's chunks
+        manifest.Load_manifest.for_db(self.settings['db']).sample_blocks = \
+            self.settings.get('hash_sample_blocks')
         return self.task_complete
 
     def run(self):
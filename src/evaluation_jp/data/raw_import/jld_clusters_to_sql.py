@@ -49,6 +49,37 @@ df = out_df.set_index("ppsn")
 #%%
 df.to_sql("jld_q_clusters", con=engine, if_exists="replace")
 
+#%%
+# Long (ppsn, date, cluster) version for get_clusters()
+# Primary key on (date, ppsn) so lookups for given dates (and ids) use the index
+clusters_long = (
+    df.rename_axis(columns="date")
+    .stack()
+    .rename("cluster")
+    .reset_index()
+    .drop_duplicates(["date", "ppsn"])
+)
+clusters_long["date"] = pd.to_datetime(clusters_long["date"]).dt.strftime("%Y-%m-%d")
+clusters_long["cluster"] = clusters_long["cluster"].astype("int64")
+
+with engine.begin() as con:
+    con.execute("DROP TABLE IF EXISTS jld_clusters")
+    con.execute(
+        """
+        CREATE TABLE jld_clusters (
+            ppsn     TEXT,
+            date     TEXT,
+            cluster  INTEGER,
+            PRIMARY KEY (date, ppsn)
+        ) WITHOUT ROWID
+        """
+    )
+    con.execute(
+        "INSERT INTO jld_clusters (ppsn, date, cluster) VALUES (?, ?, ?)",
+        list(clusters_long[["ppsn", "date", "cluster"]].itertuples(index=False)),
+    )
+    con.execute("CREATE INDEX idx_jld_clusters_ppsn ON jld_clusters (ppsn, date)")
+
 # %%
 query = """
         SELECT *
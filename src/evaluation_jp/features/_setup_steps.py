@@ -2,13 +2,21 @@
 import collections
 import abc
 from dataclasses import dataclass, field
-from typing import ClassVar, List, Set, Dict, Tuple, Optional
+from typing import ClassVar, List, Set, Dict, Tuple, Optional, Iterator
 
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from evaluation_jp.data import get_ists_claims, get_les_data, get_jobpath_data
+from evaluation_jp.data import (
+    Source,
+    SourceFetcher,
+    fetch_source,
+    get_ists_claims,
+    get_ists_claims_many,
+    get_les_data,
+    get_jobpath_data,
+)
 
 
 # %%
@@ -92,6 +100,14 @@ class SetupStep(abc.ABC):
         """Do something and return data"""
         pass
 
+    def prefetch(self, data_ids):
+        """Optionally get source data for all `data_ids` ahead of run()"""
+        pass
+
+    def sources(self, data_id) -> List[Source]:
+        """Source reads run() will make for `data_id`, so they can be fetched ahead"""
+        return []
+
 
 @dataclass
 class SetupSteps:
@@ -107,6 +123,45 @@ class SetupSteps:
 
         return data
 
+    def prefetch(self, data_ids):
+        for step in self.steps:
+            step.prefetch(data_ids)
+
+    def sources(self, data_id) -> List[Source]:
+        return [source for step in self.steps for source in step.sources(data_id)]
+
+
+def prefetch_setup_steps(setup_steps_by_date: NearestKeyDict, dates_by_id: Dict):
+    """Prefetch source data for each data id in `dates_by_id`...
+    ...using the setup steps that will run for that id's date
+    """
+    ids_by_setup_steps = {}
+    for data_id, date in dates_by_id.items():
+        setup_steps = setup_steps_by_date[date]
+        ids_by_setup_steps.setdefault(id(setup_steps), (setup_steps, []))[1].append(
+            data_id
+        )
+    for setup_steps, data_ids in ids_by_setup_steps.values():
+        setup_steps.prefetch(data_ids)
+
+
+def fetch_ahead(
+    fetcher: Optional[SourceFetcher], setup_steps_by_date: NearestKeyDict, dates_by_id
+) -> Iterator:
+    """Yield each data id in `dates_by_id`...
+    ...after setting `fetcher` reading sources needed by it and the next data id, so
+    the next data id's reads overlap with this one being set up
+    """
+    items = list(dates_by_id.items())
+    for i, (data_id, date) in enumerate(items):
+        if fetcher is not None:
+            sources = setup_steps_by_date[date].sources(data_id)
+            if i + 1 < len(items):
+                next_id, next_date = items[i + 1]
+                sources += setup_steps_by_date[next_date].sources(next_id)
+            fetcher.prefetch(sources)
+        yield data_id
+
 
 @dataclass
 class LiveRegisterPopulation(SetupStep):
@@ -118,16 +173,41 @@ class LiveRegisterPopulation(SetupStep):
     columns_by_type: Dict[str, str]
     starting_pop_col: str = None  # Must be bool!
 
+    # ISTS claims by ref date, from prefetch()
+    prefetched: Dict[pd.Timestamp, pd.DataFrame] = field(
+        default_factory=dict, init=False, repr=False
+    )
+
+    def prefetch(self, data_ids):
+        """Get ISTS claims for all `data_ids` with one query"""
+        self.prefetched.update(
+            get_ists_claims_many(
+                [ref_date_from_id(data_id) for data_id in data_ids],
+                columns=self.columns_by_type.keys(),
+            )
+        )
+
+    def sources(self, data_id):
+        ref_date = ref_date_from_id(data_id)
+        if ref_date in self.prefetched:
+            return []
+        return [
+            Source.of(get_ists_claims, ref_date, columns=self.columns_by_type.keys())
+        ]
+
+    def get_live_register_population(self, data_id):
+        ref_date = ref_date_from_id(data_id)
+        if ref_date in self.prefetched:
+            return self.prefetched.pop(ref_date)
+        (ists_source,) = self.sources(data_id)
+        return fetch_source(ists_source)
+
     # Setup method
     def run(self, data_id, data=None):
         if data is None:
-            data = get_ists_claims(
-                ref_date_from_id(data_id), columns=self.columns_by_type.keys()
-            )
+            data = self.get_live_register_population(data_id)
         else:
-            live_register_population = get_ists_claims(
-                ref_date_from_id(data_id), columns=self.columns_by_type.keys()
-            )
+            live_register_population = self.get_live_register_population(data_id)
             live_register_population["on_live_register"] = True
             data = pd.merge(
                 data,
@@ -251,8 +331,12 @@ class OnLES(SetupStep):
     assumed_episode_length: Dict[str, int]
     how: str = None  # Can be "start" or "end" for periods. Leave as None for slices.
 
+    def sources(self, data_id):
+        return [Source.of(get_les_data, columns=["start_date"])]
+
     def run(self, data_id, data):
-        les = get_les_data(columns=["start_date"])
+        (les_source,) = self.sources(data_id)
+        les = fetch_source(les_source)
         les["end_date"] = les["start_date"] + pd.DateOffset(
             **self.assumed_episode_length
         )
@@ -277,11 +361,19 @@ class OnJobPath(SetupStep):
     ists_jobpath_flag_col: str = None
     combine_data: str = None  # "either" or "both"
 
+    def sources(self, data_id):
+        if self.use_jobpath_operational_data:
+            return [
+                Source.of(
+                    get_jobpath_data, columns=["jobpath_start_date", "jobpath_end_date"]
+                )
+            ]
+        return []
+
     def run(self, data_id, data):
         if self.use_jobpath_operational_data:
-            jobpath_operational = get_jobpath_data(
-                columns=["jobpath_start_date", "jobpath_end_date"]
-            )
+            (jobpath_source,) = self.sources(data_id)
+            jobpath_operational = fetch_source(jobpath_source)
             jobpath_operational["jobpath_end_date"] = jobpath_operational[
                 "jobpath_end_date"
             ].fillna(
@@ -323,11 +415,19 @@ class OnJobPath(SetupStep):
 
 @dataclass
 class JobPathStartedEndedSamePeriod(SetupStep):
+    def sources(self, data_id):
+        return [
+            Source.of(
+                get_jobpath_data, columns=["jobpath_start_date", "jobpath_end_date"]
+            )
+        ]
+
     def run(self, data_id, data):
         start = ref_date_from_id(data_id, how="start")
         end = ref_date_from_id(data_id, how="end")
 
-        jobpath = get_jobpath_data(columns=["jobpath_start_date", "jobpath_end_date"])
+        (jobpath_source,) = self.sources(data_id)
+        jobpath = fetch_source(jobpath_source)
         starts = jobpath["jobpath_start_date"].between(start, end)
         ends = jobpath["jobpath_end_date"].between(start, end)
         started_and_ended_by_id = (
@@ -415,12 +515,23 @@ class JobPathStarts(SetupStep):
     ists_jobpath_flag_col: str = None
     combine_data: str = None  # "either" or "both"
 
+    def sources(self, data_id):
+        if self.use_jobpath_operational_data:
+            # Same read as OnJobPath, so fetching ahead only reads JobPath data once
+            return [
+                Source.of(
+                    get_jobpath_data, columns=["jobpath_start_date", "jobpath_end_date"]
+                )
+            ]
+        return []
+
     def run(self, data_id, data):
         start = ref_date_from_id(data_id, how="start")
         end = ref_date_from_id(data_id, how="end")
 
         if self.use_jobpath_operational_data:
-            jobpath_operational = get_jobpath_data(columns=["jobpath_start_date"])
+            (jobpath_source,) = self.sources(data_id)
+            jobpath_operational = fetch_source(jobpath_source)
             started = jobpath_operational[
                 jobpath_operational["jobpath_start_date"].between(start, end)
             ]
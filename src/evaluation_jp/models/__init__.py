@@ -1,5 +1,14 @@
 from ._population_slice import PopulationSliceID, PopulationSlice, PopulationSliceGenerator
-from ._treatment_period import TreatmentPeriodID, TreatmentPeriod, TreatmentPeriodGenerator
+from ._treatment_period import (
+    TreatmentPeriodID,
+    TreatmentPeriod,
+    TreatmentPeriodGenerator,
+    treatment_period_chains,
+)
+from ._propensity_scoring import PropensityScoring
+from ._weighting import Weighting, WeightBackPropagation
+from .outcomes import OutcomeGenerator
+from ._bootstrap import Bootstrap
 from ._evaluation_model import EvaluationModel
 
 
@@ -0,0 +1,163 @@
+# %%
+# Standard library
+from dataclasses import dataclass
+from typing import List, Optional
+
+# External packages
+from joblib import Parallel, delayed
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+def _bootstrap_block(
+    values, keys, n_keys, n_replicates, seed, method="poisson", chunksize=100_000
+):
+    """Return (key x column x replicate) sums of `values` for one block of replicates.
+    Resampling weights are drawn from a generator seeded with `seed`, so each block
+    gives the same result whichever process runs it.
+    """
+    rng = np.random.default_rng(seed)
+    n_records, n_cols = values.shape
+    sums = np.zeros((n_keys, n_cols, n_replicates))
+    if method == "poisson":
+        # Poisson(1) weights for each record are drawn independently...
+        # ...so record chunks keep the weight matrix small
+        for start in range(0, n_records, chunksize):
+            chunk = slice(start, min(start + chunksize, n_records))
+            chunk_keys = keys[chunk]
+            key_matrix = sparse.csr_matrix(
+                (np.ones(len(chunk_keys)), (chunk_keys, np.arange(len(chunk_keys)))),
+                shape=(n_keys, len(chunk_keys)),
+            )
+            multipliers = rng.poisson(
+                1.0, size=(len(chunk_keys), n_replicates)
+            ).astype(np.float32)
+            for col in range(n_cols):
+                sums[:, col, :] += key_matrix @ (
+                    values[chunk, col, None] * multipliers
+                )
+    elif method == "multinomial":
+        key_matrix = sparse.csr_matrix(
+            (np.ones(n_records), (keys, np.arange(n_records))),
+            shape=(n_keys, n_records),
+        )
+        for replicate in range(n_replicates):
+            counts = np.bincount(
+                rng.integers(0, n_records, n_records), minlength=n_records
+            )
+            sums[:, :, replicate] = key_matrix @ (values * counts[:, None])
+    else:
+        raise ValueError(f"Unknown bootstrap method: {method}")
+    return sums
+
+
+@dataclass
+class Bootstrap:
+    """Bootstrap confidence intervals for weighted T minus C differences in means.
+
+    Replicates resample records with precomputed weight matrices rather than
+    copying data: either independent Poisson(1) weights per record ("poisson") or
+    multinomial counts from resampling all records with replacement ("multinomial").
+    Weighted sums for every group and replicate come from one sparse matrix product.
+
+    Replicates are run in blocks of `block_size` across `n_jobs` processes. Each
+    block has its own seed spawned from `seed`, so results are reproducible and
+    don't depend on the number of processes.
+    """
+
+    # Parameters
+    n_replicates: int = 1000
+    block_size: int = 50
+    method: str = "poisson"
+    alpha: float = 0.05
+    seed: int = 0
+    n_jobs: int = None
+    chunksize: int = 100_000
+    weight_col: Optional[str] = "weight"
+    group_col: str = "evaluation_group"
+    treatment_label: str = "T"
+    control_label: str = "C"
+
+    def _setup(self, data, outcome_cols, by):
+        """Return weighted values, T/C x stratum keys and strata for `data`"""
+        group = data[self.group_col]
+        data = data.loc[group.isin([self.treatment_label, self.control_label])]
+        if by is not None:
+            strata, codes = np.unique(data[by].to_numpy(), return_inverse=True)
+        else:
+            strata, codes = np.array(["all"], dtype=object), np.zeros(len(data), int)
+        is_t = (data[self.group_col] == self.treatment_label).to_numpy()
+        keys = codes * 2 + is_t
+        if self.weight_col is not None:
+            weights = data[self.weight_col].to_numpy(dtype=np.float64)
+        else:
+            weights = np.ones(len(data))
+        values = np.column_stack(
+            [data[outcome_cols].to_numpy(dtype=np.float64) * weights[:, None], weights]
+        )
+        return values, keys, strata
+
+    @staticmethod
+    def _impacts(sums):
+        """Return (stratum x outcome ...) weighted T mean minus weighted C mean
+        from (T/C x stratum key) x (outcomes + weight) x ... sums
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = sums[:, :-1] / sums[:, -1:]
+        return means[1::2] - means[0::2]
+
+    def replicates(
+        self, data: pd.DataFrame, outcome_cols: List[str], by: str = None
+    ) -> np.ndarray:
+        """Return (replicate x stratum x outcome) array of bootstrapped impacts"""
+        values, keys, strata = self._setup(data, outcome_cols, by)
+        n_keys = 2 * len(strata)
+        block_sizes = [
+            min(self.block_size, self.n_replicates - start)
+            for start in range(0, self.n_replicates, self.block_size)
+        ]
+        seeds = np.random.SeedSequence(self.seed).spawn(len(block_sizes))
+        blocks = Parallel(n_jobs=self.n_jobs)(
+            delayed(_bootstrap_block)(
+                values, keys, n_keys, size, seed, self.method, self.chunksize
+            )
+            for size, seed in zip(block_sizes, seeds)
+        )
+        sums = np.concatenate(blocks, axis=2)
+        return np.moveaxis(self._impacts(sums), 2, 0)
+
+    def run(
+        self, data: pd.DataFrame, outcome_cols: List[str], by: str = None
+    ) -> pd.DataFrame:
+        """Return impact estimate, standard error and confidence interval by stratum.
+        Impact is weighted T mean minus weighted C mean of each of `outcome_cols`,
+        for each value of column `by` (or for all records if `by` is None).
+        """
+        values, keys, strata = self._setup(data, outcome_cols, by)
+        sums = np.stack(
+            [
+                np.bincount(keys, weights=values[:, col], minlength=2 * len(strata))
+                for col in range(values.shape[1])
+            ],
+            axis=1,
+        )
+        estimates = self._impacts(sums)
+        replicates = self.replicates(data, outcome_cols, by)
+        lower, upper = np.nanpercentile(
+            replicates, [100 * self.alpha / 2, 100 * (1 - self.alpha / 2)], axis=0
+        )
+        stats = {
+            "impact": estimates,
+            "se": np.nanstd(replicates, axis=0, ddof=1),
+            "lower": lower,
+            "upper": upper,
+        }
+        results = pd.DataFrame(
+            np.stack(list(stats.values()), axis=2).reshape(len(strata), -1),
+            index=pd.Index(strata, name=by),
+            columns=pd.MultiIndex.from_product(
+                [outcome_cols, list(stats)], names=["outcome", "stat"]
+            ),
+        )
+        return results
@@ -9,7 +9,14 @@ from tqdm import tqdm
 
 # Local packages
 from evaluation_jp.data import ModelDataHandler
-from evaluation_jp.models import PopulationSliceGenerator, TreatmentPeriodGenerator
+from evaluation_jp.models import (
+    OutcomeGenerator,
+    PopulationSliceGenerator,
+    PropensityScoring,
+    TreatmentPeriodGenerator,
+    Weighting,
+    WeightBackPropagation,
+)
 
 # //TODO Read EvaluationModel parameters from yml file
 @dataclass
@@ -19,7 +26,10 @@ class EvaluationModel:
     data_handler: ModelDataHandler = None
     population_slice_generator: PopulationSliceGenerator = None
     treatment_period_generator: TreatmentPeriodGenerator = None
-    # outcome_generator: OutcomeGenerator = None
+    propensity_scoring: PropensityScoring = None
+    weighting: Weighting = None
+    weight_back_propagation: WeightBackPropagation = None
+    outcome_generator: OutcomeGenerator = None
 
     # Attributes - set up post init
     data: pd.DataFrame = None
@@ -90,8 +100,39 @@ class EvaluationModel:
                 )
                 t0.update()
 
-    # //TODO Run weighting algorithm for periods
+    def add_propensity_scores(self):
+        """Fit propensity model for each treatment period and add scores to its data.
+        Scores are stored as `t_period.data[propensity_scoring.score_col]`
+        """
+        scores = self.propensity_scoring.run(self.treatment_periods)
+        for t_period_id, t_period_scores in scores.items():
+            t_period = self.treatment_periods[t_period_id]
+            t_period.data[self.propensity_scoring.score_col] = t_period_scores
 
-    # //TODO Back-propagations of weights through periods
+    def add_weights(self):
+        """Run weighting algorithm for all treatment periods in one pass.
+        Weights for each period are stored with the period as `t_period.weights`
+        """
+        weights = self.weighting.run(self.treatment_periods)
+        for t_period_id, t_period_weights in weights.items():
+            self.treatment_periods[t_period_id].weights = t_period_weights
 
-    # //TODO Add outcomes with weighting
+    def back_propagate_weights(self):
+        """Back-propagate weights through each chain of treatment periods.
+        Adds "future_T" to each period's weights and stores its counterfactual factors
+        with the period as `t_period.counterfactual_factors`
+        """
+        results = self.weight_back_propagation.run(self.treatment_periods)
+        for t_period_id, (weights, counterfactual_factors) in results.items():
+            self.treatment_periods[t_period_id].weights = weights
+            self.treatment_periods[t_period_id].counterfactual_factors = (
+                counterfactual_factors
+            )
+
+    def add_outcomes(self):
+        """Add weighted outcomes to all treatment periods.
+        Outcomes for each period are stored with the period as `t_period.outcomes`
+        """
+        results = self.outcome_generator.run(self.treatment_periods)
+        for t_period_id, outcomes in results.items():
+            self.treatment_periods[t_period_id].outcomes = outcomes
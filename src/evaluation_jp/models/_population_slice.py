@@ -7,8 +7,13 @@ from typing import List, Set, Dict
 import pandas as pd
 
 # Local packages
-from evaluation_jp.data import ModelDataHandler
-from evaluation_jp.features import NearestKeyDict, SetupSteps
+from evaluation_jp.data import ModelDataHandler, source_fetching
+from evaluation_jp.features import (
+    NearestKeyDict,
+    SetupSteps,
+    prefetch_setup_steps,
+    fetch_ahead,
+)
 
 
 @dataclass(frozen=True)
@@ -53,6 +58,8 @@ class PopulationSliceGenerator:
 
     # Attributes
     setup_steps_by_date: NearestKeyDict = None
+    prefetch: bool = False  # Get source data for all slices up front
+    fetch_ahead: bool = False  # Read next slice's source data while this one runs
 
     date_range: pd.DatetimeIndex = field(init=False)
 
@@ -61,13 +68,19 @@ class PopulationSliceGenerator:
         self.date_range = pd.date_range(start=start, end=end, freq=freq)
 
     def run(self, data_handler=None):
-        for date in self.date_range:
-            population_slice = PopulationSlice(
-                id=PopulationSliceID(date),
-                setup_steps=self.setup_steps_by_date[date],
-                data_handler=data_handler,
-            )
-            yield population_slice
+        dates_by_id = {PopulationSliceID(date): date for date in self.date_range}
+        if self.prefetch:
+            prefetch_setup_steps(self.setup_steps_by_date, dates_by_id)
+        with source_fetching(enabled=self.fetch_ahead) as fetcher:
+            for slice_id in fetch_ahead(
+                fetcher, self.setup_steps_by_date, dates_by_id
+            ):
+                population_slice = PopulationSlice(
+                    id=slice_id,
+                    setup_steps=self.setup_steps_by_date[slice_id.date],
+                    data_handler=data_handler,
+                )
+                yield population_slice
 
 
 # %%
@@ -0,0 +1,221 @@
+# %%
+# Standard library
+from dataclasses import dataclass, field
+import hashlib
+from typing import Dict, List, Tuple
+
+# External packages
+from joblib import Parallel, delayed
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.linear_model import LogisticRegression
+
+# Local packages
+from evaluation_jp.models import treatment_period_chains
+
+
+def _fit_chain(designs, targets, coef=None, intercept=None, **params):
+    """Fit logistic regression to each of `designs` in turn, warm-starting each fit
+    from the previous one (or from `coef` and `intercept` for the first fit).
+    Return list of (scores, coef, intercept), with NaN scores if T or C is empty.
+    Fits start cold if `coef` doesn't have one coefficient per design column.
+    """
+    model = LogisticRegression(warm_start=True, **params)
+    results = []
+    for design, target in zip(designs, targets):
+        if len(np.unique(target)) < 2:
+            results.append((np.full(len(target), np.nan, np.float32), coef, intercept))
+            continue
+        # Warm start only if coefficients line up with this design's columns
+        if coef is not None and coef.shape == (1, design.shape[1]):
+            model.coef_ = coef.copy()
+            model.intercept_ = intercept.copy()
+        model.fit(design, target)
+        coef, intercept = model.coef_, model.intercept_
+        results.append(
+            (model.predict_proba(design)[:, 1].astype(np.float32), coef, intercept)
+        )
+    return results
+
+
+@dataclass
+class PropensityScoring:
+    """Add propensity score column `score_col` to T and C records in each period.
+
+    Each treatment period gets its own L1-penalised logistic regression of T vs C
+    on `features`, fitted on a sparse float32 design matrix (categorical features
+    are one-hot encoded). Periods in the same chain are fitted in time order, each
+    warm-started from the previous period's coefficients. Chains are independent,
+    so they're fitted in parallel with `n_jobs` processes (all CPUs by default).
+
+    Scores are cached by (period, feature-set fingerprint, data fingerprint), so
+    re-running with the same features, parameters and data only fits periods that
+    haven't been scored. The data fingerprint covers the record ids, T/C labels and
+    design matrix (so also its width and categories), so changed data is refitted.
+    """
+
+    # Parameters
+    features: List[str]
+    score_col: str = "propensity"
+    C: float = 25.0
+    max_iter: int = 1000
+    n_jobs: int = -1
+    group_col: str = "evaluation_group"
+    treatment_label: str = "T"
+    control_label: str = "C"
+
+    # Cache of (scores, coef, intercept) by (period id, fingerprint, data fingerprint)
+    cache: Dict[Tuple, Tuple] = field(default_factory=dict, init=False, repr=False)
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of everything other than period data that the scores depend on"""
+        settings = (
+            sorted(self.features),
+            self.C,
+            self.max_iter,
+            self.treatment_label,
+            self.control_label,
+        )
+        return hashlib.sha1(repr(settings).encode("utf8")).hexdigest()
+
+    @staticmethod
+    def data_fingerprint(
+        data: pd.DataFrame, design: sparse.csr_matrix, target: np.ndarray
+    ) -> str:
+        """Hash of the period data the scores are fitted on: row count, record ids,
+        T/C target and design matrix (including its shape)
+        """
+        digest = hashlib.sha1(repr((len(data), design.shape)).encode("utf8"))
+        digest.update(pd.util.hash_pandas_object(data.index).to_numpy().tobytes())
+        digest.update(np.ascontiguousarray(target).tobytes())
+        for array in (design.indptr, design.indices, design.data):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    def _evaluation_data(self, t_period) -> pd.DataFrame:
+        group = t_period.data[self.group_col]
+        in_evaluation = group.isin([self.treatment_label, self.control_label])
+        return t_period.data.loc[in_evaluation]
+
+    def _encoders(self, chain) -> Dict:
+        """Return encoders for each feature, shared by all periods in `chain` so that
+        coefficients line up for warm starts. Numeric features are standardised on
+        the first period; other features are one-hot encoded on all values seen,
+        with the first value as the reference level.
+        """
+        first = self._evaluation_data(chain[0])
+        encoders = {}
+        for feature in self.features:
+            column = first[feature]
+            if pd.api.types.is_bool_dtype(column) or pd.api.types.is_numeric_dtype(
+                column
+            ):
+                values = column.astype(np.float64)
+            elif pd.api.types.is_datetime64_any_dtype(column):
+                values = column.values.astype("datetime64[D]").astype(np.float64)
+            else:
+                categories = pd.Index(
+                    pd.concat(
+                        [
+                            self._evaluation_data(t_period)[feature].astype(str)
+                            for t_period in chain
+                        ]
+                    ).unique()
+                ).sort_values()
+                encoders[feature] = ("categorical", categories)
+                continue
+            std = values.std()
+            encoders[feature] = ("numeric", (values.mean(), std if std else 1.0))
+        return encoders
+
+    def design_matrix(self, data: pd.DataFrame, encoders: Dict) -> sparse.csr_matrix:
+        """Return sparse float32 design matrix for `data` using `encoders`"""
+        blocks = []
+        for feature, (kind, encoder) in encoders.items():
+            column = data[feature]
+            if kind == "numeric":
+                if pd.api.types.is_datetime64_any_dtype(column):
+                    values = column.values.astype("datetime64[D]").astype(np.float64)
+                else:
+                    values = column.astype(np.float64).to_numpy()
+                mean, std = encoder
+                values = np.nan_to_num((values - mean) / std).astype(np.float32)
+                blocks.append(sparse.csr_matrix(values[:, None]))
+            else:
+                # First category is the reference level, so it gets no column
+                codes = encoder.get_indexer(column.astype(str)) - 1
+                known = codes >= 0
+                blocks.append(
+                    sparse.csr_matrix(
+                        (
+                            np.ones(known.sum(), dtype=np.float32),
+                            (np.nonzero(known)[0], codes[known]),
+                        ),
+                        shape=(len(data), len(encoder) - 1),
+                    )
+                )
+        return sparse.hstack(blocks, format="csr", dtype=np.float32)
+
+    def run(self, treatment_periods: Dict) -> Dict:
+        """Return dict of propensity score series (T and C records) for each period
+        Keys are the keys of `treatment_periods`.
+        """
+        fingerprint = self.fingerprint
+        keys = {}
+        jobs = []
+        for chain in treatment_period_chains(treatment_periods):
+            encoders = self._encoders(chain)
+            data = [self._evaluation_data(t_period) for t_period in chain]
+            designs = [self.design_matrix(d, encoders) for d in data]
+            targets = [
+                (d[self.group_col] == self.treatment_label).to_numpy() for d in data
+            ]
+            for t_period, d, design, target in zip(chain, data, designs, targets):
+                keys[t_period.id] = (
+                    t_period.id,
+                    fingerprint,
+                    self.data_fingerprint(d, design, target),
+                )
+            uncached = [
+                k
+                for k, t_period in enumerate(chain)
+                if keys[t_period.id] not in self.cache
+            ]
+            if not uncached:
+                continue
+            first = uncached[0]
+            if first > 0:
+                _, coef, intercept = self.cache[keys[chain[first - 1].id]]
+            else:
+                coef, intercept = None, None
+            jobs.append(
+                (
+                    chain[first:],
+                    data[first:],
+                    delayed(_fit_chain)(
+                        designs[first:],
+                        targets[first:],
+                        coef,
+                        intercept,
+                        penalty="l1",
+                        C=self.C,
+                        solver="saga",
+                        max_iter=self.max_iter,
+                    ),
+                )
+            )
+
+        fitted = Parallel(n_jobs=self.n_jobs)(job for _, _, job in jobs)
+        for (to_fit, data, _), chain_results in zip(jobs, fitted):
+            for t_period, d, (scores, coef, intercept) in zip(
+                to_fit, data, chain_results
+            ):
+                scores = pd.Series(scores, index=d.index, name=self.score_col)
+                self.cache[keys[t_period.id]] = (scores, coef, intercept)
+
+        return {
+            t_period_id: self.cache[keys[t_period_id]][0]
+            for t_period_id in treatment_periods
+        }
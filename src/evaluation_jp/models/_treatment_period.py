@@ -1,14 +1,21 @@
 # %%
 # Standard library
+import collections
 from dataclasses import dataclass, field, InitVar
+from typing import Dict, List
 
 
 # External packages
 import pandas as pd
 
 # Local packages
-from evaluation_jp.data import ModelDataHandler
-from evaluation_jp.features import NearestKeyDict, SetupSteps
+from evaluation_jp.data import ModelDataHandler, source_fetching
+from evaluation_jp.features import (
+    NearestKeyDict,
+    SetupSteps,
+    prefetch_setup_steps,
+    fetch_ahead,
+)
 from evaluation_jp.models import PopulationSliceID, PopulationSlice
 
 # TODO Use dataclass metadata to implement choice of id attrs for TreatmentPeriod and EvaluationSlice
@@ -31,6 +38,13 @@ class TreatmentPeriod:
     # Set up post-init
     data: pd.DataFrame = field(init=False)
 
+    # Set up by EvaluationModel weighting
+    weights: pd.DataFrame = field(default=None, init=False)
+    counterfactual_factors: pd.DataFrame = field(default=None, init=False)
+
+    # Set up by EvaluationModel outcomes
+    outcomes: pd.DataFrame = field(default=None, init=False)
+
     @property
     def class_name(self):
         return type(self).__name__
@@ -47,12 +61,27 @@ class TreatmentPeriod:
             self.data = setup_steps.run(data_id=self.id, data=init_data)
 
 
+def treatment_period_chains(treatment_periods: Dict) -> List[List[TreatmentPeriod]]:
+    """Group `treatment_periods` into chains by population slice, in time order.
+    Each period's population is the previous period's control group.
+    """
+    chains = collections.defaultdict(list)
+    for t_period in treatment_periods.values():
+        chains[t_period.id.population_slice_id].append(t_period)
+    return [
+        sorted(chain, key=lambda t_period: t_period.id.time_period)
+        for chain in chains.values()
+    ]
+
+
 # TODO TreatmentPeriodGenerator starting at different times (e.g. slice + 1 year)
 @dataclass
 class TreatmentPeriodGenerator:
     setup_steps_by_date: dict = None
     end: pd.Period = None
     freq: str = "M"
+    prefetch: bool = False  # Get source data for all periods in a slice up front
+    fetch_ahead: bool = False  # Read next period's source data while this one runs
 
     def __post_init__(self):
         self.setup_steps_by_date = NearestKeyDict(self.setup_steps_by_date)
@@ -62,15 +91,24 @@ class TreatmentPeriodGenerator:
 
     def run(self, population_slice, data_handler=None):
         init_data = population_slice.data.copy()
-        for time_period in self.treatment_period_range(population_slice.id.date):
-            treatment_period = TreatmentPeriod(
-                id=TreatmentPeriodID(
-                    population_slice_id=population_slice.id, time_period=time_period
-                ),
-                setup_steps=self.setup_steps_by_date[time_period.to_timestamp()],
-                init_data=init_data,
-                data_handler=data_handler,
-            )
-            yield treatment_period
-            # Use survivors from previous period as pop for next period
-            init_data = treatment_period.data.copy()
+        dates_by_id = {
+            TreatmentPeriodID(
+                population_slice_id=population_slice.id, time_period=time_period
+            ): time_period.to_timestamp()
+            for time_period in self.treatment_period_range(population_slice.id.date)
+        }
+        if self.prefetch:
+            prefetch_setup_steps(self.setup_steps_by_date, dates_by_id)
+        with source_fetching(enabled=self.fetch_ahead) as fetcher:
+            for t_period_id in fetch_ahead(
+                fetcher, self.setup_steps_by_date, dates_by_id
+            ):
+                treatment_period = TreatmentPeriod(
+                    id=t_period_id,
+                    setup_steps=self.setup_steps_by_date[dates_by_id[t_period_id]],
+                    init_data=init_data,
+                    data_handler=data_handler,
+                )
+                yield treatment_period
+                # Use survivors from previous period as pop for next period
+                init_data = treatment_period.data.copy()
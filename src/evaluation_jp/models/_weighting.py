@@ -0,0 +1,282 @@
+# %%
+# Standard library
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+# External packages
+import numpy as np
+import pandas as pd
+
+# Local packages
+from evaluation_jp.models import treatment_period_chains
+
+
+@dataclass
+class Weighting:
+    """Bin treatment (T) and control (C) groups on `score_col` and weight C records.
+
+    For every treatment period, T records are split into `n_bins` equal-sized bins
+    by their rank on `score_col`. C records go into the bin of the nearest T record
+    at or below their score. C records scoring below the lowest or above the highest
+    T score in their period are excluded (outliers). T records get weight 1 and each
+    C record in a bin gets weight (T count / C count) for that bin.
+
+    All periods are processed together in one pass over a stacked period x person
+    frame, so there's no per-period or per-bin python loop.
+    """
+
+    # Parameters
+    score_col: str
+    n_bins: int = 100
+    group_col: str = "evaluation_group"
+    treatment_label: str = "T"
+    control_label: str = "C"
+
+    def stack(self, treatment_periods: Dict) -> pd.DataFrame:
+        """Return T and C records for all `treatment_periods` as a single dataframe.
+        Records are in `treatment_periods` order with an integer "period" code column.
+        """
+        frames = []
+        for t_period in treatment_periods.values():
+            group = t_period.data[self.group_col]
+            in_evaluation = group.isin([self.treatment_label, self.control_label])
+            frames.append(
+                t_period.data.loc[in_evaluation, [self.group_col, self.score_col]]
+            )
+        lengths = [len(frame) for frame in frames]
+        stacked = pd.concat(frames, axis="index", sort=False)
+        stacked["period"] = np.repeat(np.arange(len(frames), dtype=np.int32), lengths)
+        return stacked
+
+    def weight_stacked(self, stacked: pd.DataFrame) -> pd.DataFrame:
+        """Add "bin" and "weight" columns to `stacked` and drop excluded C records.
+        `stacked` must have an integer "period" column, as returned by stack().
+        """
+        period = stacked["period"].to_numpy()
+        n_periods = int(period.max()) + 1 if len(period) else 0
+        score = stacked[self.score_col].to_numpy(dtype=np.float64)
+        is_t = (stacked[self.group_col] == self.treatment_label).to_numpy()
+
+        # Sort by period, then score, with T ahead of C on tied scores...
+        # ...so running count of T at each record is number of T scoring <= record
+        # Single int64 sort key from dense score rank is much faster than lexsort
+        unique_scores, score_rank = np.unique(score, return_inverse=True)
+        sort_key = period.astype(np.int64) * len(unique_scores) + score_rank
+        order = np.argsort(sort_key * 2 + ~is_t, kind="stable")
+        sorted_period = period[order]
+        sorted_is_t = is_t[order]
+        t_count = np.bincount(period[is_t], minlength=n_periods)
+        t_offset = np.concatenate([[0], np.cumsum(t_count)[:-1]])
+        t_at_or_below = np.cumsum(sorted_is_t) - t_offset[sorted_period]
+
+        # Equal-sized T bins from rank; C gets bin of nearest T at or below it
+        safe_t_count = np.maximum(t_count, 1)[sorted_period]
+        sorted_bin = (t_at_or_below - 1) * self.n_bins // safe_t_count
+
+        # Exclude C below lowest T or above highest T in each period
+        sorted_t_score = score[order][sorted_is_t]
+        max_t_score = np.full(n_periods, -np.inf)
+        has_t = t_count > 0
+        max_t_score[has_t] = sorted_t_score[(t_offset + t_count - 1)[has_t]]
+        sorted_keep = sorted_is_t | (
+            (t_at_or_below > 0) & (score[order] <= max_t_score[sorted_period])
+        )
+
+        # Restore original (stacked) order
+        bins = np.empty_like(sorted_bin)
+        bins[order] = sorted_bin
+        keep = np.empty_like(sorted_keep)
+        keep[order] = sorted_keep
+
+        # Weights for C are T count / C count in each period x bin
+        key = period.astype(np.int64) * self.n_bins + bins
+        size = n_periods * self.n_bins
+        t_bin_counts = np.bincount(key[is_t], minlength=size)
+        c_bin_counts = np.bincount(key[keep & ~is_t], minlength=size)
+        weight = np.ones(len(stacked), dtype=np.float64)
+        is_kept_c = keep & ~is_t
+        weight[is_kept_c] = (
+            t_bin_counts[key[is_kept_c]] / c_bin_counts[key[is_kept_c]]
+        )
+
+        stacked["bin"] = bins.astype(np.int32)
+        stacked["weight"] = weight
+        return stacked.loc[keep]
+
+    def run(self, treatment_periods: Dict) -> Dict:
+        """Return dict of dataframes with "bin" and "weight" columns for each period.
+        Keys are the keys of `treatment_periods`.
+        """
+        if not treatment_periods:
+            return {}
+        weighted = self.weight_stacked(self.stack(treatment_periods))
+        period = weighted["period"].to_numpy()
+        # Weighted records are still in period order so split on period boundaries
+        boundaries = np.searchsorted(period, np.arange(1, len(treatment_periods)))
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(weighted)]])
+        return {
+            t_period_id: weighted.iloc[start:end][["bin", "weight"]]
+            for t_period_id, start, end in zip(treatment_periods, starts, ends)
+        }
+
+
+@dataclass
+class WeightBackPropagation:
+    """Propagate control weights backwards through each chain of treatment periods.
+
+    Each population slice has a chain of treatment periods, where each period's
+    population is the previous period's control (C) group. C records that are
+    treated (T) in a later period can't stand in for the counterfactual, so their
+    weight is handed on to the C records in their later T bin, in proportion to
+    those records' own weights, and so on through the rest of the chain.
+
+    Because the handover is proportional within bins, all of it can be summarised
+    per period as a (bin x earlier period) table of counterfactual factors. A C
+    record at period k in bin b that is never treated later in the chain carries,
+    on behalf of earlier period j, its own weight times factor[j][b] on top of
+    any weight it has for period k itself.
+
+    The factors are built from person x period group, bin and weight matrices with
+    a backward scan for each record's next T period, bincounts and a small
+    bin-level recursion, so cost is linear in people x periods.
+    """
+
+    # Parameters
+    group_col: str = "evaluation_group"
+    treatment_label: str = "T"
+    control_label: str = "C"
+
+    def chain_matrices(self, chain: List) -> Tuple:
+        """Return person index and person x period T, bin and weight arrays for `chain`
+        Bin is -1 and weight is 0 for records without a weight in a period.
+        """
+        groups = [
+            t_period.data[self.group_col].loc[
+                lambda group: group.isin([self.treatment_label, self.control_label])
+            ]
+            for t_period in chain
+        ]
+        people = groups[0].index.append([group.index for group in groups[1:]]).unique()
+        is_t = np.zeros((len(people), len(chain)), dtype=bool)
+        bins = np.full((len(people), len(chain)), -1, dtype=np.int32)
+        weights = np.zeros((len(people), len(chain)), dtype=np.float64)
+        for k, (t_period, group) in enumerate(zip(chain, groups)):
+            is_t[people.get_indexer(group.index), k] = (
+                group == self.treatment_label
+            ).to_numpy()
+            rows = people.get_indexer(t_period.weights.index)
+            bins[rows, k] = t_period.weights["bin"].to_numpy()
+            weights[rows, k] = t_period.weights["weight"].to_numpy()
+        return people, is_t, bins, weights
+
+    def run_chain(self, chain: List) -> Tuple:
+        """Return person index, next T period and counterfactual factors for `chain`
+        Next T period is the position in `chain` of each person's first later T period,
+        or len(chain) if never treated later.
+        Factors have shape (origin period, period, bin).
+        """
+        people, is_t, bins, weights = self.chain_matrices(chain)
+        n_people, n_periods = is_t.shape
+        n_bins = int(bins.max()) + 1
+
+        # Backward scan for each person's first T period after each period
+        next_t = np.full((n_people, n_periods), n_periods, dtype=np.int32)
+        later_t = np.full(n_people, n_periods, dtype=np.int32)
+        for k in reversed(range(n_periods)):
+            next_t[:, k] = later_t
+            later_t = np.where(is_t[:, k], k, later_t)
+
+        t_counts = np.zeros((n_periods, n_bins))
+        for k in range(n_periods):
+            t_counts[k] = np.bincount(bins[is_t[:, k], k], minlength=n_bins)
+
+        # Weighted C records that hand their weight on to a later T bin
+        handover = ~is_t & (weights > 0) & (next_t < n_periods)
+        person, period = np.nonzero(handover)
+        to_period = next_t[person, period]
+        from_bin = bins[person, period]
+        to_bin = bins[person, to_period]
+        amount = weights[person, period]
+
+        # Weight handed directly from each origin period to each later T bin
+        direct = np.bincount(
+            (period.astype(np.int64) * n_periods + to_period) * n_bins + to_bin,
+            weights=amount,
+            minlength=n_periods * n_periods * n_bins,
+        ).reshape(n_periods, n_periods, n_bins)
+
+        # Weight arriving in T bins is shared out to C records in same bin, some of
+        # ...whom hand it on again, so work forwards through the periods
+        by_to_period = np.argsort(to_period, kind="stable")
+        boundaries = np.searchsorted(to_period[by_to_period], np.arange(n_periods + 1))
+        factors = np.zeros((n_periods, n_periods, n_bins))
+        for k in range(n_periods):
+            pairs = by_to_period[boundaries[k] : boundaries[k + 1]]
+            transfer = np.bincount(
+                (period[pairs].astype(np.int64) * n_bins + from_bin[pairs]) * n_bins
+                + to_bin[pairs],
+                weights=amount[pairs],
+                minlength=n_periods * n_bins * n_bins,
+            ).reshape(n_periods, n_bins, n_bins)
+            arriving = direct[:, k, :] + np.einsum(
+                "ipb,pbc->ic", factors[:, :k, :], transfer[:k]
+            )
+            with np.errstate(divide="ignore", invalid="ignore"):
+                factors[:, k, :] = np.where(
+                    t_counts[k] > 0, arriving / t_counts[k], 0.0
+                )
+
+        return people, next_t, factors
+
+    def run(self, treatment_periods: Dict) -> Dict:
+        """Return dict of (weights, counterfactual factors) for each period
+        Weights are each period's weights with added bool "future_T" column.
+        Counterfactual factors are indexed by bin with a column for each earlier period.
+        Keys are the keys of `treatment_periods`.
+        """
+        results = {}
+        for chain in treatment_period_chains(treatment_periods):
+            people, next_t, factors = self.run_chain(chain)
+            n_bins = factors.shape[2]
+            for k, t_period in enumerate(chain):
+                weights = t_period.weights.copy()
+                rows = people.get_indexer(weights.index)
+                weights["future_T"] = next_t[rows, k] < len(chain)
+                counterfactual_factors = pd.DataFrame(
+                    factors[:k, k, :].T,
+                    index=pd.RangeIndex(n_bins, name="bin"),
+                    columns=pd.Index(
+                        [earlier.id.time_period for earlier in chain[:k]],
+                        name="origin",
+                    ),
+                )
+                results[t_period.id] = (weights, counterfactual_factors)
+        return results
+
+    def counterfactual_weights(self, treatment_periods: Dict, t_period_id) -> pd.Series:
+        """Return final counterfactual weights for `t_period_id` C group, by person.
+        Only records that are never treated later in the chain get a weight.
+        Needs run() results stored on `treatment_periods` first.
+        """
+        origin = treatment_periods[t_period_id]
+        chain = [
+            chain
+            for chain in treatment_period_chains(treatment_periods)
+            if chain[0].id.population_slice_id == t_period_id.population_slice_id
+        ][0]
+        parts = []
+        for t_period in chain:
+            if t_period.id.time_period < t_period_id.time_period:
+                continue
+            group = t_period.data[self.group_col].reindex(t_period.weights.index)
+            final = (group == self.control_label) & ~t_period.weights["future_T"]
+            weights = t_period.weights.loc[final]
+            if t_period is origin:
+                parts.append(weights["weight"])
+            else:
+                factor = t_period.counterfactual_factors[t_period_id.time_period]
+                parts.append(
+                    weights["weight"] * factor.reindex(weights["bin"]).to_numpy()
+                )
+        return pd.concat(parts).groupby(level=0).sum()
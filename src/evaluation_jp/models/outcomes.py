@@ -1,18 +1,178 @@
 # %%
 # Standard library
-import collections
-from dataclasses import dataclass, field, InitVar
-from typing import List, Set, MutableMapping
+from dataclasses import dataclass, field
+from typing import Dict
 
 # External packages
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
 # Local packages
-from evaluation_jp.models.model_helpers import NearestKeyDict
-from evaluation_jp.data.import_helpers import get_ists_claims
+from evaluation_jp.data import get_earnings, get_sw_payments
+from evaluation_jp.models import treatment_period_chains
 
 
 @dataclass
-class OutcomeParams:
+class OutcomeGenerator:
+    """Add quarterly earnings and SW payments outcomes to weighted treatment periods.
+
+    Source data is streamed in chunks of `chunksize` people from the evaluation
+    population (everyone with a weight in any treatment period) and aggregated
+    straight into a person x quarter float32 matrix for each outcome, so only one
+    chunk of raw records is ever in memory.
+
+    For each treatment period, weighted outcomes are the mean for the T group and
+    the weighted mean for the C group. If weights have been back-propagated, the C
+    group mean uses counterfactual weights for the whole chain of periods.
+    """
+
+    # Parameters
+    start: pd.Period
     end: pd.Period
-    freq: str = "QS"
\ No newline at end of file
+    chunksize: int = 50_000
+    group_col: str = "evaluation_group"
+    treatment_label: str = "T"
+    control_label: str = "C"
+
+    # Set up by run()
+    people: pd.Index = field(default=None, init=False)
+    outcomes: Dict[str, pd.DataFrame] = field(default=None, init=False)
+
+    @property
+    def quarters(self) -> pd.PeriodIndex:
+        return pd.period_range(start=self.start, end=self.end, freq="Q")
+
+    def _add_to_block(self, block, ids, ppsns, quarter_ordinals, amounts):
+        """Add `amounts` to `block` (len(ids) x quarters) for records in range"""
+        rows = ids.get_indexer(ppsns)
+        cols = quarter_ordinals - self.quarters[0].ordinal
+        in_range = (rows >= 0) & (cols >= 0) & (cols < len(self.quarters))
+        block += np.bincount(
+            rows[in_range] * len(self.quarters) + cols[in_range],
+            weights=amounts[in_range],
+            minlength=block.size,
+        ).reshape(block.shape)
+
+    def earnings_block(self, ids: pd.Index) -> np.ndarray:
+        """Return len(`ids`) x quarters earnings, spread evenly over each CON_YEAR"""
+        block = np.zeros((len(ids), len(self.quarters)))
+        earnings = get_earnings(ids=ids, columns=["CON_YEAR", "EARNINGS_AMT"])
+        # Records without a CON_YEAR can't be placed in any quarter
+        earnings = earnings[earnings["CON_YEAR"].notna()]
+        # Quarterly period ordinals count quarters from 1970Q1
+        first_quarter = (earnings["CON_YEAR"].to_numpy(dtype=np.int64) - 1970) * 4
+        amounts = earnings["EARNINGS_AMT"].fillna(0).to_numpy(dtype=np.float64) / 4
+        for quarter in range(4):
+            self._add_to_block(
+                block, ids, earnings["ppsn"], first_quarter + quarter, amounts
+            )
+        return block
+
+    def sw_payments_block(self, ids: pd.Index) -> np.ndarray:
+        """Return len(`ids`) x quarters SW payments"""
+        block = np.zeros((len(ids), len(self.quarters)))
+        payments = get_sw_payments(ids=ids, columns=["ppsn", "QTR", "AMOUNT"])
+        self._add_to_block(
+            block,
+            ids,
+            payments["ppsn"],
+            pd.PeriodIndex(payments["QTR"].to_numpy(), freq="Q").asi8,
+            payments["AMOUNT"].fillna(0).to_numpy(dtype=np.float64),
+        )
+        return block
+
+    def aggregate(self, people: pd.Index) -> Dict[str, pd.DataFrame]:
+        """Stream source data for `people` into person x quarter outcome matrices"""
+        matrices = {
+            "earnings": np.zeros((len(people), len(self.quarters)), dtype=np.float32),
+            "sw_payments": np.zeros(
+                (len(people), len(self.quarters)), dtype=np.float32
+            ),
+        }
+        for start in range(0, len(people), self.chunksize):
+            ids = people[start : start + self.chunksize]
+            rows = slice(start, start + len(ids))
+            matrices["earnings"][rows] = self.earnings_block(ids)
+            matrices["sw_payments"][rows] = self.sw_payments_block(ids)
+        return {
+            outcome: pd.DataFrame(matrix, index=people, columns=self.quarters)
+            for outcome, matrix in matrices.items()
+        }
+
+    def _weighted_sums_by_bin(self, t_period, values, n_bins):
+        """Return (bin x cols) weighted sums of `values` and bin weight totals
+        for C records that keep their weight (not treated in a later period)
+        """
+        weights = t_period.weights
+        group = t_period.data[self.group_col].reindex(weights.index)
+        final = group == self.control_label
+        if "future_T" in weights.columns:
+            final &= ~weights["future_T"]
+        final_weights = weights.loc[final]
+        rows = self.people.get_indexer(final_weights.index)
+        bins = final_weights["bin"].to_numpy()
+        weight = final_weights["weight"].to_numpy()
+        # Sparse (bin x record) weight matrix does weighted sums by bin in one product
+        bin_weights = sparse.csr_matrix(
+            (weight, (bins, np.arange(len(bins)))), shape=(n_bins, len(bins))
+        )
+        sums = bin_weights @ values[rows].astype(np.float64)
+        return sums, np.bincount(bins, weights=weight, minlength=n_bins)
+
+    def weighted_outcomes(self, treatment_periods: Dict) -> Dict[object, pd.DataFrame]:
+        """Return dataframe of T and C weighted outcomes by quarter for each period"""
+        names = list(self.outcomes)
+        values = np.hstack([self.outcomes[name].to_numpy() for name in names])
+        columns = pd.MultiIndex.from_product(
+            [names, [self.treatment_label, self.control_label]],
+            names=["outcome", "group"],
+        )
+        results = {}
+        for chain in treatment_period_chains(treatment_periods):
+            n_bins = int(max(t_period.weights["bin"].max() for t_period in chain)) + 1
+            by_bin = [
+                self._weighted_sums_by_bin(t_period, values, n_bins)
+                for t_period in chain
+            ]
+            for j, t_period in enumerate(chain):
+                weights = t_period.weights
+                group = t_period.data[self.group_col].reindex(weights.index)
+                t_index = weights.index[group == self.treatment_label]
+                t_rows = self.people.get_indexer(t_index)
+                t_mean = values[t_rows].mean(axis=0)
+
+                c_sum = by_bin[j][0].sum(axis=0)
+                c_weight = by_bin[j][1].sum()
+                # Add weight handed on to C records in later periods
+                for later, (later_sums, later_weights) in zip(
+                    chain[j + 1 :], by_bin[j + 1 :]
+                ):
+                    if later.counterfactual_factors is None:
+                        break
+                    factor = later.counterfactual_factors[t_period.id.time_period]
+                    factor = factor.reindex(range(n_bins), fill_value=0).to_numpy()
+                    c_sum = c_sum + factor @ later_sums
+                    c_weight = c_weight + factor @ later_weights
+                c_mean = c_sum / c_weight if c_weight else np.full(len(c_sum), np.nan)
+
+                outcomes = pd.DataFrame(
+                    index=self.quarters, columns=columns, dtype=float
+                )
+                for i, name in enumerate(names):
+                    cols = slice(i * len(self.quarters), (i + 1) * len(self.quarters))
+                    outcomes[(name, self.treatment_label)] = t_mean[cols]
+                    outcomes[(name, self.control_label)] = c_mean[cols]
+                results[t_period.id] = outcomes
+        return results
+
+    def run(self, treatment_periods: Dict) -> Dict[object, pd.DataFrame]:
+        """Aggregate outcomes for everyone weighted in `treatment_periods`...
+        ...then return weighted outcomes for each period
+        """
+        if not treatment_periods:
+            return {}
+        people = [t_period.weights.index for t_period in treatment_periods.values()]
+        self.people = people[0].append(people[1:]).unique()
+        self.outcomes = self.aggregate(self.people)
+        return self.weighted_outcomes(treatment_periods)
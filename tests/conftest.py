@@ -1,14 +1,19 @@
+import os
 from dataclasses import dataclass
 
 import numpy as np
 import pandas as pd
 import pytest
+import sqlalchemy as sa
 
+from evaluation_jp.data import _import_helpers
 from evaluation_jp.features import SetupStep, SetupSteps
 from evaluation_jp.models import (
     PopulationSliceID,
     PopulationSlice,
     PopulationSliceGenerator,
+    TreatmentPeriodID,
+    TreatmentPeriod,
     TreatmentPeriodGenerator,
 )
 
@@ -141,3 +146,187 @@ def fixture__treatment_period(
         init_data=fixture__random_date_range_df,
     )
     return treatment_period
+
+
+@pytest.fixture
+def fixture__evaluation_treatment_periods(fixture__population_slice):
+    """Chain of 4 monthly TreatmentPeriods, each with "evaluation_group" and "score".
+    Each period's population is the previous period's control group.
+    """
+    rng = np.random.RandomState(0)
+    data = pd.DataFrame(
+        index=pd.Index([f"{i:07d}A" for i in range(2000)], name="ppsn")
+    )
+    treatment_periods = {}
+    for time_period in pd.period_range("2016-01", periods=4, freq="M"):
+        data = data.copy()
+        data["score"] = rng.uniform(size=len(data))
+        data["evaluation_group"] = np.where(
+            rng.uniform(size=len(data)) < 0.1 + 0.2 * data["score"], "T", "C"
+        )
+        t_period = TreatmentPeriod(
+            id=TreatmentPeriodID(
+                population_slice_id=fixture__population_slice.id,
+                time_period=time_period,
+            ),
+            setup_steps=SetupSteps([]),
+            init_data=data,
+        )
+        treatment_periods[t_period.id] = t_period
+        data = data.loc[data["evaluation_group"] == "C", []]
+    return treatment_periods
+
+
+@pytest.fixture(autouse=True)
+def fixture__no_production_db_fallback(monkeypatch):
+    """Skip tests that would open the production source database when it isn't there
+
+    Stops get_engine() and set_source_engine() falling back to DEFAULT_SOURCE_DB,
+    which outside the office network just creates an empty file at that path.
+    """
+    create_source_engine = _import_helpers.create_source_engine
+
+    def guarded(database=None, **kwargs):
+        database = database or os.environ.get(
+            _import_helpers.SOURCE_DB_ENV_VAR, _import_helpers.DEFAULT_SOURCE_DB
+        )
+        if database == _import_helpers.DEFAULT_SOURCE_DB and not os.path.exists(
+            database
+        ):
+            pytest.skip("production source database not available")
+        return create_source_engine(database, **kwargs)
+
+    monkeypatch.setattr(_import_helpers, "create_source_engine", guarded)
+
+
+@pytest.fixture
+def fixture__production_engine():
+    """Read-only engine for the production source database, if it is available"""
+    if not os.path.exists(_import_helpers.DEFAULT_SOURCE_DB):
+        pytest.skip("production source database not available")
+    return _import_helpers.create_source_engine(_import_helpers.DEFAULT_SOURCE_DB)
+
+
+@pytest.fixture
+def fixture__source_db(tmpdir, monkeypatch):
+    """Small local source database, restoring default source engine afterwards"""
+    monkeypatch.setattr(_import_helpers, "_engine", None)
+    path = f"{tmpdir}/wwld.db"
+    les = pd.DataFrame(
+        {
+            "ppsn": ["0000001A", "0000002A"],
+            "client_group": ["LTU", "STU"],
+            "start_date": pd.to_datetime(["2016-01-04", "2016-02-01"]),
+        }
+    )
+    source_engine = sa.create_engine(f"sqlite:///{path}")
+    les.to_sql("les", con=source_engine, index=False)
+    source_engine.execute(
+        "CREATE TABLE ists_personal (id INTEGER, ppsn TEXT, date_of_birth DATETIME)"
+    )
+    source_engine.execute(
+        """\
+        CREATE TABLE ists_claims
+            (id INTEGER, lr_date TEXT, lr_code TEXT, lr_flag BOOLEAN, personal_id INTEGER)
+        """
+    )
+    source_engine.execute(
+        """\
+        INSERT INTO ists_personal VALUES
+            (1, '0000001A', '1980-01-01 00:00:00.000000'),
+            (2, '0000002A', '1990-06-01 00:00:00.000000'),
+            (3, '0000003A', '2000-12-01 00:00:00.000000')
+        """
+    )
+    source_engine.execute(
+        """\
+        INSERT INTO ists_claims VALUES
+            (1, '2016-01-01', 'UA', 1, 1),
+            (2, '2016-01-01', 'UB', 1, 2),
+            (3, '2016-01-01', 'UA', 0, 3),
+            (4, '2016-01-08', 'UA', 1, 1),
+            (5, '2016-01-08', 'UB', 1, 3),
+            (6, '2016-02-05', 'UB', 1, 2)
+        """
+    )
+    flags = ", ".join(f"{flag} TEXT" for flag in _import_helpers.EARNINGS_ERROR_FLAGS)
+    source_engine.execute(
+        f"""\
+        CREATE TABLE earnings
+            (id INTEGER, RSI_NO TEXT, CON_YEAR FLOAT, EARNINGS_AMT FLOAT, {flags})
+        """
+    )
+    source_engine.execute(
+        """\
+        INSERT INTO earnings VALUES
+            (1, '0000001A', 2015, 1000, NULL, NULL, NULL, NULL, NULL, NULL),
+            (2, '0000001A', 2015, 500, '', NULL, NULL, NULL, NULL, NULL),
+            (3, '0000001A', 2016, 2000, NULL, NULL, NULL, NULL, NULL, NULL),
+            (4, '0000002A', 2015, 300, NULL, NULL, NULL, NULL, NULL, NULL),
+            (5, '0000002A', 2016, 9999, NULL, 'Y', NULL, NULL, NULL, NULL),
+            (6, '0000003A', 2016, 700, NULL, NULL, NULL, NULL, NULL, 'N')
+        """
+    )
+    source_engine.execute(
+        "CREATE TABLE payments (id INTEGER, ppsn TEXT, AMOUNT FLOAT, QTR TEXT)"
+    )
+    source_engine.execute(
+        """\
+        INSERT INTO payments VALUES
+            (1, '0000001A', 100, '2015Q4'),
+            (2, '0000001A', 200, '2016Q1'),
+            (3, '0000001A', 300, '2016Q2'),
+            (4, '0000002A', 400, '2016Q1'),
+            (5, '0000003A', NULL, '2016Q1')
+        """
+    )
+    source_engine.execute(
+        """\
+        CREATE TABLE earnings_summary
+            (ppsn TEXT, CON_YEAR INTEGER, class TEXT, EARNINGS_AMT FLOAT,
+            PRIMARY KEY (ppsn, CON_YEAR, class)) WITHOUT ROWID
+        """
+    )
+    source_engine.execute(
+        """\
+        INSERT INTO earnings_summary VALUES
+            ('0000001A', 2015, 'a', 1500),
+            ('0000001A', 2016, 'a', 1200),
+            ('0000001A', 2016, 's', 800),
+            ('0000002A', 2015, 'other', 300),
+            ('0000003A', 2016, 'a', 700)
+        """
+    )
+    source_engine.execute(
+        """\
+        CREATE TABLE payments_summary
+            (ppsn TEXT, QTR TEXT, SCHEME_TYPE TEXT, AMOUNT FLOAT,
+            PRIMARY KEY (ppsn, QTR, SCHEME_TYPE)) WITHOUT ROWID
+        """
+    )
+    source_engine.execute(
+        """\
+        INSERT INTO payments_summary VALUES
+            ('0000001A', '2015Q4', 'JA', 100),
+            ('0000001A', '2016Q1', 'JA', 150),
+            ('0000001A', '2016Q1', 'JB', 50),
+            ('0000002A', '2016Q1', 'JA', 400)
+        """
+    )
+    source_engine.execute(
+        """\
+        CREATE TABLE jld_clusters
+            (ppsn TEXT, date TEXT, cluster INTEGER, PRIMARY KEY (date, ppsn))
+            WITHOUT ROWID
+        """
+    )
+    source_engine.execute(
+        """\
+        INSERT INTO jld_clusters VALUES
+            ('0000001A', '2016-01-01', 1),
+            ('0000002A', '2016-01-01', 3),
+            ('0000001A', '2016-04-01', 2),
+            ('0000003A', '2016-04-01', 5)
+        """
+    )
+    return path
@@ -0,0 +1,34 @@
+import sys
+
+import pytest
+import sqlalchemy as sa
+
+import evaluation_jp.data.etl.pipeline as pipeline
+
+# The ETL modules are run as scripts from the pipeline directory, so they import
+# each other as top-level modules
+if pipeline.__path__[0] not in sys.path:
+    sys.path.insert(0, pipeline.__path__[0])
+
+EARNINGS_COLUMNS = ["RSI_NO", "CON_YEAR", "PAYMENT_LINE_COUNT", "EARNINGS_AMT"]
+EARNINGS_NUMERIC = [False, True, True, True]
+
+
+@pytest.fixture
+def fixture__earnings_db(tmpdir):
+    """SQLite URL of a database with a small earnings table (keyed on 3 columns)"""
+    db = f"sqlite:///{tmpdir}/wwld.db"
+    engine = sa.create_engine(db)
+    engine.execute(
+        """CREATE TABLE earnings (
+            RSI_NO TEXT,
+            CON_YEAR FLOAT,
+            PAYMENT_LINE_COUNT FLOAT,
+            EARNINGS_AMT FLOAT,
+            row_hash INTEGER
+        )"""
+    )
+    engine.execute("CREATE INDEX idx_earnings_row_hash ON earnings (row_hash)")
+    engine.execute("CREATE INDEX idx_earn_ppsn ON earnings (RSI_NO)")
+    engine.dispose()
+    return db
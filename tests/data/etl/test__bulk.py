@@ -0,0 +1,37 @@
+import pytest
+import sqlalchemy as sa
+
+import evaluation_jp.data.etl.pipeline.bulk as bulk
+
+
+def index_names(engine):
+    rows = engine.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+        "ORDER BY name"
+    )
+    return [row[0] for row in rows]
+
+
+def test__bulk_load__restores_indexes_after_error(fixture__earnings_db):
+    engine = sa.create_engine(fixture__earnings_db)
+    engine.execute("CREATE UNIQUE INDEX idx_earnings_key ON earnings (RSI_NO, CON_YEAR)")
+    with pytest.raises(RuntimeError):
+        with bulk.bulk_load(
+            fixture__earnings_db, ["earnings"], keep_indexes=["idx_earnings_row_hash"]
+        ) as load_engine:
+            assert bulk.create_engine(fixture__earnings_db) is load_engine
+            with load_engine.connect() as con:
+                assert con.execute("PRAGMA synchronous").scalar() == 0
+            # Secondary indexes other than kept and unique ones are dropped...
+            assert index_names(engine) == ["idx_earnings_key", "idx_earnings_row_hash"]
+            raise RuntimeError("load failed")
+    # ...and rebuilt, however the load ends
+    assert index_names(engine) == [
+        "idx_earn_ppsn",
+        "idx_earnings_key",
+        "idx_earnings_row_hash",
+    ]
+    assert engine.execute("SELECT COUNT(*) FROM deferred_index").scalar() == 0
+    # Other engines for the database get default settings again
+    assert bulk.create_engine(fixture__earnings_db) is not load_engine
+    assert engine.execute("PRAGMA synchronous").scalar() != 0
@@ -0,0 +1,90 @@
+import os
+import sqlite3
+
+import pytest
+import sqlalchemy as sa
+
+import bulk_apply
+from conftest import EARNINGS_COLUMNS, EARNINGS_NUMERIC
+
+
+def test__insert_lines__rerun_after_failure(fixture__earnings_db, tmpdir):
+    columns = EARNINGS_COLUMNS + ["row_hash"]
+    numeric = EARNINGS_NUMERIC + [True]
+    lines = ["0000001A,2015,1,100,1\n", "0000002A,2015\n", "0000009A,2015,1,900,9\n"]
+    reject_file = f"{tmpdir}/load.rej"
+    engine = sa.create_engine(fixture__earnings_db)
+    engine.execute(
+        "CREATE TRIGGER fail BEFORE INSERT ON earnings WHEN NEW.RSI_NO = '0000009A' "
+        "BEGIN SELECT RAISE(ABORT, 'disk full'); END"
+    )
+    with pytest.raises(sqlite3.IntegrityError):
+        bulk_apply.insert_lines(
+            fixture__earnings_db,
+            "earnings",
+            columns,
+            numeric,
+            lines,
+            batch_size=1,
+            reject_file=reject_file,
+        )
+    assert engine.execute("SELECT COUNT(*) FROM earnings").scalar() == 0
+    assert not os.path.exists(reject_file)
+
+    engine.execute("DROP TRIGGER fail")
+    total = bulk_apply.insert_lines(
+        fixture__earnings_db,
+        "earnings",
+        columns,
+        numeric,
+        lines,
+        batch_size=1,
+        reject_file=reject_file,
+    )
+    assert total == 2
+    rows = engine.execute("SELECT RSI_NO, row_hash FROM earnings ORDER BY RSI_NO")
+    assert [tuple(row) for row in rows] == [("0000001A", 1), ("0000009A", 9)]
+    with open(reject_file) as f:
+        assert f.read() == "0000002A,2015\n"
+
+
+def test__parse_lines():
+    columns = ["RSI_NO", "CON_YEAR", "EMPLOYER"]
+    numeric = [False, True, False]
+    lines = [
+        "0000001A,2015,ACME\n",
+        '0000002A, 2016 ,"Smith, Jones"\n',
+        "0000003A,,\n",
+        "0000004A,2015\n",
+        "0000005A,n/a,ACME\n",
+        '0000006A,2015,"Smith, Jones",extra\n',
+    ]
+    assert bulk_apply.parse_lines(lines, columns, numeric) == [
+        ("0000001A", 2015.0, "ACME"),
+        ("0000002A", 2016.0, "Smith, Jones"),
+        # Empty and non-number text in numeric columns stays text, as SQLite stores it
+        ("0000003A", "", ""),
+        None,
+        ("0000005A", "n/a", "ACME"),
+        None,
+    ]
+    assert bulk_apply.parse_lines(["0000004A,2015\n"], columns, numeric) == [None]
+
+
+def test__Rejects(tmpdir):
+    with pytest.raises(ValueError, match="wrong number of fields"):
+        bulk_apply.Rejects().add(["0000004A,2015\n"])
+
+    reject_file = str(tmpdir / "load.rej")
+    with open(reject_file, "wt") as f:
+        f.write("0000001A\n")
+    rejects = bulk_apply.Rejects(reject_file)
+    rejects.add([])
+    rejects.add(["0000004A,2015\n", "0000005A\r\n"])
+    # Rejected lines are only added to reject_file once the load commits
+    with open(reject_file) as f:
+        assert f.read() == "0000001A\n"
+    rejects.commit()
+    with open(reject_file) as f:
+        assert f.read() == "0000001A\n0000004A,2015\n0000005A\n"
+    assert not os.path.exists(reject_file + ".tmp")
@@ -0,0 +1,177 @@
+import os
+import sqlite3
+
+import pytest
+import sqlalchemy as sa
+
+import changes
+from conftest import EARNINGS_COLUMNS, EARNINGS_NUMERIC
+
+
+def earnings_rows(db):
+    engine = sa.create_engine(db)
+    rows = engine.execute(
+        "SELECT RSI_NO, CON_YEAR, PAYMENT_LINE_COUNT, EARNINGS_AMT FROM earnings "
+        "ORDER BY RSI_NO, CON_YEAR, PAYMENT_LINE_COUNT"
+    ).fetchall()
+    engine.dispose()
+    return [tuple(row) for row in rows]
+
+
+def test__apply_change_set__same_hash_different_key(fixture__earnings_db, tmpdir):
+    # Two records whose rows (as a stand-in for a hash collision) have the same hash
+    engine = sa.create_engine(fixture__earnings_db)
+    engine.execute(
+        "INSERT INTO earnings VALUES "
+        "('0000001A', 2015, 1, 100, 42), ('0000002A', 2015, 1, 200, 42)"
+    )
+    engine.dispose()
+    change_file = f"{tmpdir}/diff.chg"
+    changes.write_change_set(
+        [
+            (changes.DELETE, 42, None, "0000002A,2015.0,1.0,"),
+            (changes.UPDATE, 42, 7, "0000003A,2016,1,300"),
+            (changes.UPDATE, 42, 7, "0000001A,2015,1,150"),
+        ],
+        change_file,
+    )
+    ids = changes.apply_change_set(
+        fixture__earnings_db,
+        "earnings",
+        EARNINGS_COLUMNS,
+        EARNINGS_NUMERIC,
+        3,
+        change_file,
+    )
+    assert ids == {"0000001A", "0000002A", "0000003A"}
+    # The update with no row of its key changes nothing
+    assert earnings_rows(fixture__earnings_db) == [("0000001A", 2015.0, 1.0, 150.0)]
+
+
+def test__apply_change_set__rerun_after_failure(fixture__earnings_db, tmpdir):
+    old_hash = changes.line_hash("0000001A,2015,1,100", EARNINGS_NUMERIC)
+    engine = sa.create_engine(fixture__earnings_db)
+    # Two identical rows: applying the delete twice would remove both
+    for _ in range(2):
+        engine.execute(
+            "INSERT INTO earnings VALUES ('0000001A', 2015, 1, 100, ?)", old_hash
+        )
+    # Fails part way through, after earlier batches would have been committed
+    engine.execute(
+        "CREATE TRIGGER fail BEFORE INSERT ON earnings WHEN NEW.RSI_NO = '0000009A' "
+        "BEGIN SELECT RAISE(ABORT, 'disk full'); END"
+    )
+    change_file = f"{tmpdir}/diff.chg"
+    reject_file = f"{tmpdir}/diff.rej"
+    changes.write_change_set(
+        [
+            (changes.DELETE, old_hash, None, "0000001A,2015,1,"),
+            (changes.INSERT, None, 1, "0000002A,2015,1,200"),
+            (changes.INSERT, None, 2, "0000003A,2015,1"),
+            (changes.INSERT, None, 3, "0000009A,2015,1,900"),
+        ],
+        change_file,
+    )
+    args = (fixture__earnings_db, "earnings", EARNINGS_COLUMNS, EARNINGS_NUMERIC, 3)
+    with pytest.raises(sqlite3.IntegrityError):
+        changes.apply_change_set(
+            *args, change_file, batch_size=1, reject_file=reject_file
+        )
+    assert earnings_rows(fixture__earnings_db) == [("0000001A", 2015.0, 1.0, 100.0)] * 2
+    assert not os.path.exists(reject_file)
+
+    engine.execute("DROP TRIGGER fail")
+    engine.dispose()
+    changes.apply_change_set(*args, change_file, batch_size=1, reject_file=reject_file)
+    assert earnings_rows(fixture__earnings_db) == [
+        ("0000001A", 2015.0, 1.0, 100.0),
+        ("0000002A", 2015.0, 1.0, 200.0),
+        ("0000009A", 2015.0, 1.0, 900.0),
+    ]
+    with open(reject_file) as f:
+        assert f.read() == "0000003A,2015,1\n"
+
+
+def test__write_diff__read_change_set(tmpdir):
+    old = ["0000001A,2015,1,100\n", "0000001A,2015,2,50\n", "0000002A,2015,1,200\n"]
+    new = ["0000001A,2015,1,100.0\n", "0000001A,2015,2,60\n", "0000003A,2016,1,300\n"]
+    change_file = str(tmpdir / "diff.chg")
+    changes.write_diff(
+        changes.Text_rows(old, 3, EARNINGS_NUMERIC),
+        changes.Text_rows(new, 3, EARNINGS_NUMERIC),
+        change_file,
+    )
+
+    def line_hash(line):
+        return changes.line_hash(line, EARNINGS_NUMERIC)
+
+    # '100' and '100.0' are the same number, so that row is unchanged
+    assert list(changes.read_change_set(change_file)) == [
+        (
+            changes.UPDATE,
+            line_hash("0000001A,2015,2,50"),
+            line_hash("0000001A,2015,2,60"),
+            "0000001A,2015,2,60",
+        ),
+        (changes.DELETE, line_hash("0000002A,2015,1,200"), None, "0000002A,2015,1,"),
+        (changes.INSERT, None, line_hash("0000003A,2016,1,300"), "0000003A,2016,1,300"),
+    ]
+
+
+def test__write_diff__unsorted(tmpdir):
+    old = ["0000002A,2015,1,200\n", "0000001A,2015,1,100\n"]
+    change_file = str(tmpdir / "diff.chg")
+    with pytest.raises(ValueError, match="old snapshot is not sorted"):
+        changes.write_diff(
+            changes.Text_rows(old, 3, EARNINGS_NUMERIC),
+            changes.Text_rows([], 3, EARNINGS_NUMERIC),
+            change_file,
+        )
+    # No partial change set is left to be applied
+    assert not os.path.exists(change_file)
+
+
+def test__read_change_set__not_a_change_set(tmpdir):
+    change_file = tmpdir / "diff.chg"
+    change_file.write_text("<0000001A,2015,1,100\n", encoding="utf-8")
+    with pytest.raises(ValueError, match="is not a change set"):
+        list(changes.read_change_set(str(change_file)))
+
+
+def test__add_row_hash__resumes_after_interruption(tmpdir, monkeypatch):
+    engine = sa.create_engine(f"sqlite:///{tmpdir}/old.db")
+    engine.execute(
+        "CREATE TABLE earnings "
+        "(RSI_NO TEXT, CON_YEAR FLOAT, PAYMENT_LINE_COUNT FLOAT, EARNINGS_AMT FLOAT)"
+    )
+    lines = [f"000000{i}A,2015,1,{i}00" for i in range(1, 6)]
+    for line in lines:
+        engine.execute("INSERT INTO earnings VALUES (?, ?, ?, ?)", line.split(","))
+    hash_query = "SELECT row_hash FROM earnings ORDER BY rowid"
+    progress = []
+
+    def interrupt_after_first_chunk(label, rows, start):
+        progress.append(rows)
+        if len(progress) == 1:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(changes.bulk_apply, "report", interrupt_after_first_chunk)
+    with engine.connect() as conn:
+        with pytest.raises(KeyboardInterrupt):
+            changes.add_row_hash(
+                conn, "earnings", EARNINGS_COLUMNS, EARNINGS_NUMERIC, chunk_rows=2
+            )
+    # The first chunk was committed, and the index isn't there to mark it finished
+    hashes = [row[0] for row in engine.execute(hash_query)]
+    assert [h is not None for h in hashes] == [True, True, False, False, False]
+    with engine.connect() as conn:
+        changes.add_row_hash(
+            conn, "earnings", EARNINGS_COLUMNS, EARNINGS_NUMERIC, chunk_rows=2
+        )
+    # Only the rows left are hashed again
+    assert progress == [2, 2, 3]
+    hashes = [row[0] for row in engine.execute(hash_query)]
+    assert hashes == [changes.line_hash(line, EARNINGS_NUMERIC) for line in lines]
+    indexes = [row[1] for row in engine.execute("PRAGMA index_list(earnings)")]
+    assert indexes == ["idx_earnings_row_hash"]
+    engine.dispose()
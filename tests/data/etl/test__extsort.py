@@ -0,0 +1,59 @@
+import os
+
+import extsort
+
+
+def write_lines(path, lines):
+    with open(path, "wt") as f:
+        f.writelines(lines)
+    return str(path)
+
+
+def read_lines(path):
+    with open(path, "rt") as f:
+        return f.read().splitlines()
+
+
+def test__chunk_ranges(tmpdir):
+    infile = write_lines(tmpdir / "in.txt", ["a\n", "bb\n", "\n", "ccc\n", "d"])
+    assert list(extsort.chunk_ranges(infile, 2)) == [(0, 5), (5, 10), (10, 11)]
+    assert list(extsort.chunk_ranges(infile, 10)) == [(0, 11)]
+    empty = write_lines(tmpdir / "empty.txt", [])
+    assert list(extsort.chunk_ranges(empty, 2)) == []
+
+
+def test__external_sort__more_runs_than_fan_in(tmpdir, monkeypatch):
+    # 3 merge passes: 20 runs -> 7 -> 3 -> outfile
+    monkeypatch.setattr(extsort, "MAX_FAN_IN", 3)
+    lines = [f" {(i * 7) % 20:03d},B,{i} \n" for i in range(20)] + ["\n", "  \n"]
+    infile = write_lines(tmpdir / "in.txt", lines)
+    outfile = str(tmpdir / "out.txt")
+    extsort.external_sort(infile, outfile, str(tmpdir), chunk_lines=1, processes=2)
+    assert read_lines(outfile) == sorted(line.strip() for line in lines if line.strip())
+    # Run files are cleaned up
+    assert sorted(os.listdir(tmpdir)) == ["in.txt", "out.txt"]
+
+
+def test__external_sort__empty(tmpdir):
+    infile = write_lines(tmpdir / "in.txt", [])
+    outfile = str(tmpdir / "out.txt")
+    extsort.external_sort(infile, outfile, str(tmpdir), chunk_lines=10, processes=1)
+    assert read_lines(outfile) == []
+
+
+def test__ensure_sorted__legacy_file(tmpdir):
+    # Windows sort order ignores case, unlike the order diffs compare lines in
+    legacy = ["0000001a,2015\n", "0000001B,2015\n", "0000001c,2015\n"]
+    filename = write_lines(tmpdir / "earn_current.txt", legacy)
+    extsort.ensure_sorted(filename, str(tmpdir), chunk_lines=2, processes=1)
+    assert read_lines(filename) == ["0000001B,2015", "0000001a,2015", "0000001c,2015"]
+    assert os.path.exists(filename + extsort.SORTED_SUFFIX)
+
+    # Files marked as sorted are left alone
+    write_lines(filename, legacy)
+    extsort.ensure_sorted(filename, str(tmpdir), chunk_lines=2, processes=1)
+    assert read_lines(filename) == [line.strip() for line in legacy]
+
+    # And so are missing files
+    extsort.ensure_sorted(str(tmpdir / "missing.txt"), str(tmpdir), 2)
+    assert not os.path.exists(tmpdir / "missing.txt.sorted")
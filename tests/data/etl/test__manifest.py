@@ -0,0 +1,57 @@
+import datetime
+import os
+
+import sqlalchemy as sa
+
+import manifest
+
+
+def test__Load_manifest__processed(tmpdir, monkeypatch):
+    db = f"sqlite:///{tmpdir}/wwld.db"
+    sa.create_engine(db).execute(
+        "CREATE TABLE load_file (id INTEGER PRIMARY KEY AUTOINCREMENT, file TEXT, "
+        "mod_date DATETIME, load_time DATETIME)"
+    )
+    source = tmpdir / "ists_ext_03jan2016.sas7bdat"
+    source.write_binary(b"claims")
+    filename = str(source)
+    hashed = []
+    content_hash = manifest.content_hash
+
+    def counting_hash(filename, *args, **kwargs):
+        hashed.append(filename)
+        return content_hash(filename, *args, **kwargs)
+
+    monkeypatch.setattr(manifest, "content_hash", counting_hash)
+
+    loads = manifest.Load_manifest(db)
+    assert not loads.processed(filename)
+    loads.record(
+        filename,
+        loads.mod_date(filename),
+        os.path.getsize(filename),
+        loads.content_hash(filename),
+    )
+    assert loads.processed(filename)
+    assert len(hashed) == 1
+
+    # Copied again: new modification date, same contents
+    os.utime(filename, (0, 1_000_000_000))
+    loads = manifest.Load_manifest(db)
+    assert loads.processed(filename)
+    assert len(hashed) == 2
+    # The load's record reuses the hash processed() worked out
+    assert loads.content_hash(filename) == content_hash(filename)
+    assert len(hashed) == 2
+    # New modification date is recorded, so the next check needs no hash
+    mod_date = sa.create_engine(db).execute("SELECT mod_date FROM load_file").scalar()
+    assert mod_date == datetime.datetime.fromtimestamp(1_000_000_000).strftime(
+        manifest.MOD_DATE_FORMAT
+    )
+    assert manifest.Load_manifest(db).processed(filename)
+    assert len(hashed) == 2
+
+    # Changed contents (of the same size) are loaded again
+    source.write_binary(b"CLAIMS")
+    os.utime(filename, (0, 1_100_000_000))
+    assert not manifest.Load_manifest(db).processed(filename)
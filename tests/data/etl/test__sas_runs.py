@@ -0,0 +1,71 @@
+import os
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyreadstat")
+
+import changes
+import sas_runs
+from conftest import EARNINGS_COLUMNS, EARNINGS_NUMERIC
+
+
+def earnings_df(rows):
+    return pd.DataFrame(rows, columns=EARNINGS_COLUMNS).astype(
+        {"CON_YEAR": float, "PAYMENT_LINE_COUNT": float, "EARNINGS_AMT": float}
+    )
+
+
+def test__Run_rows__merge_order(tmpdir):
+    run_dir = str(tmpdir)
+    runs = [
+        earnings_df([("0000003A", 2015, 1, 300), ("0000001A", 2015, 1, 100)]),
+        earnings_df(
+            [
+                ("0000002A", 2015, 1, 200),
+                ("0000001A", 2015, 1, 150),
+                ("0000001A", 2014, 1, 50),
+            ]
+        ),
+    ]
+    for i, df in enumerate(runs):
+        run_file = os.path.join(run_dir, f"run_{i:05d}.arrow")
+        sas_runs.write_run(df, run_file, EARNINGS_COLUMNS, EARNINGS_NUMERIC, 3, None)
+
+    rows = sas_runs.Run_rows(run_dir)
+    groups = list(rows.groups())
+    # Runs are merged into one key order, with each key's rows from every run
+    assert [key for key, _ in groups] == [
+        "0000001A,2014.0,1.0,",
+        "0000001A,2015.0,1.0,",
+        "0000002A,2015.0,1.0,",
+        "0000003A,2015.0,1.0,",
+    ]
+    assert sorted(rows.line(row) for row in groups[1][1]) == [
+        "0000001A,2015.0,1.0,100.0",
+        "0000001A,2015.0,1.0,150.0",
+    ]
+    # Row hashes are those of the lines the old text export had
+    for _, group in groups:
+        for row in group:
+            assert rows.hash(row) == changes.line_hash(rows.line(row), EARNINGS_NUMERIC)
+
+
+def test__convert_sas__failure_leaves_no_snapshot(tmpdir, monkeypatch):
+    run_dir = str(tmpdir / "earn_new")
+    os.makedirs(run_dir)
+    # Done marker from the last conversion
+    open(os.path.join(run_dir, sas_runs.DONE_FILE), "w").close()
+    meta = SimpleNamespace(original_variable_types={})
+
+    def failing_chunks(*args, **kwargs):
+        yield earnings_df([("0000001A", 2015, 1, 100)]), meta
+        raise OSError("read failed")
+
+    monkeypatch.setattr(sas_runs.pyreadstat, "read_file_in_chunks", failing_chunks)
+    with pytest.raises(OSError):
+        sas_runs.convert_sas(
+            "earnings.sas7bdat", run_dir, EARNINGS_COLUMNS, EARNINGS_NUMERIC, 3
+        )
+    assert not sas_runs.converted(run_dir)
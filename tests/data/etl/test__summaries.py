@@ -0,0 +1,46 @@
+import sqlalchemy as sa
+
+import summaries
+
+
+def payments_summary(engine):
+    rows = engine.execute(
+        "SELECT ppsn, QTR, SCHEME_TYPE, AMOUNT FROM payments_summary ORDER BY 1, 2, 3"
+    )
+    return [tuple(row) for row in rows]
+
+
+def test__refresh_summary(tmpdir):
+    db = f"sqlite:///{tmpdir}/wwld.db"
+    engine = sa.create_engine(db)
+    engine.execute(
+        "CREATE TABLE payments (ppsn TEXT, QTR TEXT, SCHEME_TYPE TEXT, AMOUNT FLOAT)"
+    )
+    engine.execute(
+        "INSERT INTO payments VALUES "
+        "('0000001A', '2015Q1', 'JA', 100), ('0000001A', '2015Q1', 'JA', 50), "
+        "('0000002A', '2015Q1', NULL, 200)"
+    )
+    # Empty summary table is built in full, even when given ids
+    summaries.refresh_summary(db, "payments_summary", ids={"0000001A"})
+    assert payments_summary(engine) == [
+        ("0000001A", "2015Q1", "JA", 150.0),
+        ("0000002A", "2015Q1", "", 200.0),
+    ]
+
+    engine.execute("UPDATE payments SET AMOUNT = AMOUNT + 1")
+    engine.execute("INSERT INTO payments VALUES ('0000003A', '2015Q2', 'JA', 300)")
+    # Incremental refresh only recalculates the given ids...
+    summaries.refresh_summary(db, "payments_summary", ids={"0000001A", "0000003A"})
+    assert payments_summary(engine) == [
+        ("0000001A", "2015Q1", "JA", 152.0),
+        ("0000002A", "2015Q1", "", 200.0),
+        ("0000003A", "2015Q2", "JA", 300.0),
+    ]
+    # ...and a full one everything
+    summaries.refresh_summary(db, "payments_summary")
+    assert payments_summary(engine) == [
+        ("0000001A", "2015Q1", "JA", 152.0),
+        ("0000002A", "2015Q1", "", 201.0),
+        ("0000003A", "2015Q2", "JA", 300.0),
+    ]
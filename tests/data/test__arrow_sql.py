@@ -0,0 +1,77 @@
+import pandas as pd
+import sqlalchemy as sa
+
+from evaluation_jp.data import (
+    _arrow_sql,
+    arrow_reads,
+    get_ists_claims,
+    read_sql_arrow,
+    set_source_engine,
+)
+
+
+def test__read_sql_arrow(fixture__source_db):
+    engine = set_source_engine(fixture__source_db)
+    query = """\
+        SELECT ppsn, lr_code, lr_flag, date_of_birth
+            FROM ists_claims c
+            JOIN ists_personal p
+            ON c.personal_id=p.id
+        """
+    with engine.connect() as con:
+        results = read_sql_arrow(query, con, engine, ["ists_claims", "ists_personal"])
+        expected = pd.read_sql(query, con=con, parse_dates=["date_of_birth"])
+    assert results["ppsn"].dtype == object
+    assert results["lr_code"].dtype == "category"
+    assert results["date_of_birth"].dtype == "datetime64[ns]"
+    pd.testing.assert_frame_equal(
+        results.astype({"lr_code": object}), expected, check_dtype=False
+    )
+
+
+def test__read_sql_arrow__chunks(fixture__source_db):
+    engine = set_source_engine(fixture__source_db)
+    query = sa.sql.text("SELECT * FROM earnings WHERE CON_YEAR IN :years").bindparams(
+        sa.sql.expression.bindparam("years", expanding=True)
+    )
+    with engine.connect() as con:
+        chunks = list(
+            read_sql_arrow(
+                query, con, engine, ["earnings"], params={"years": [2015]}, chunksize=2
+            )
+        )
+        assert [len(chunk) for chunk in chunks] == [2, 1]
+        assert all(chunk["EARNINGS_AMT"].dtype == "float64" for chunk in chunks)
+        # Empty result still has typed columns
+        empty = read_sql_arrow(query, con, engine, ["earnings"], params={"years": []})
+    assert empty.empty
+    assert empty["RSI_NO"].dtype == object
+    assert empty["EARNINGS_AMT"].dtype == "float64"
+
+
+def test__get_ists_claims__arrow_reads_opt_in(fixture__source_db, monkeypatch):
+    engine = set_source_engine(fixture__source_db)
+    date = pd.Timestamp("2016-01-10")
+    columns = ["lr_code", "date_of_birth"]
+    # By default callers get the dtypes pd.read_sql() gives them
+    assert not arrow_reads()
+    results = get_ists_claims(date, columns=columns)
+    with engine.connect() as con:
+        expected = pd.read_sql(
+            "SELECT lr_code, date_of_birth FROM ists_claims c "
+            "JOIN ists_personal p ON c.personal_id=p.id",
+            con=con,
+            parse_dates=["date_of_birth"],
+        )
+    pd.testing.assert_series_equal(
+        results[columns].dtypes, expected[columns].dtypes
+    )
+    assert results["lr_code"].dtype == object
+
+    # Arrow reads are opted into, and give the same values
+    monkeypatch.setattr(_arrow_sql, "_arrow_reads", True)
+    arrow_results = get_ists_claims(date, columns=columns)
+    assert arrow_results["lr_code"].dtype == "category"
+    pd.testing.assert_frame_equal(
+        arrow_results.astype({"lr_code": object}), results
+    )
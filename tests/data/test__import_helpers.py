@@ -1,33 +1,48 @@
+import os
+import sqlite3
+
 import pandas as pd
+import pytest
 import sqlalchemy as sa
 
 from IPython.display import display
 
+from evaluation_jp.data import _import_helpers
 from evaluation_jp.data import (
+    create_source_engine,
+    set_source_engine,
+    temp_ids_con,
     datetime_cols,
     get_col_list,
     # unpack,
     # parameterized_query,
-    # get_clusters,
+    get_clusters,
+    get_clusters_many,
     get_ists_claims,
+    get_ists_claims_many,
     get_vital_statistics,
     get_les_data,
     get_jobpath_data,
     get_earnings,
+    get_earnings_totals,
+    get_earnings_summary,
     get_sw_payments,
+    get_sw_payments_totals,
+    get_sw_payments_summary,
 )
 
-engine = sa.create_engine(
-    "sqlite:///\\\\cskma0294\\F\\Evaluations\\data\\wwld.db", echo=False
-)
-insp = sa.engine.reflection.Inspector.from_engine(engine)
+
+@pytest.fixture
+def engine(fixture__production_engine):
+    return fixture__production_engine
+
 
 # TODO Move data to fixtures
 
 # TODO Move test__datetime_cols to test__ModelDataHandler
 
 # TODO Parameterised test with and without actual list of columns
-def test__get_col_list():
+def test__get_col_list(engine):
     test__inputs = ["les", "ists_claims"]
     results = {
         table_name: set(get_col_list(engine, table_name, columns=None))
@@ -72,10 +87,30 @@ def test__get_col_list():
 
 # TODO test parameterized_query()
 
-# TODO test get_clusters()
+
+def test__create_source_engine(fixture__source_db):
+    engine = create_source_engine(fixture__source_db, mmap_size=2 ** 20)
+    assert engine.execute("SELECT COUNT(*) FROM les").scalar() == 2
+    assert engine.execute("PRAGMA mmap_size").scalar() == 2 ** 20
+    with pytest.raises(sa.exc.OperationalError):
+        engine.execute("DELETE FROM les")
+
+
+def test__set_source_engine(fixture__source_db, monkeypatch):
+    # Environment variable is used when no database is given
+    monkeypatch.setenv(_import_helpers.SOURCE_DB_ENV_VAR, fixture__source_db)
+    assert _import_helpers._engine is None
+    results = get_les_data(columns=["ppsn", "start_date"])
+    assert list(results["ppsn"]) == ["0000001A", "0000002A"]
+    assert fixture__source_db in str(_import_helpers.engine.url)
+
+    set_source_engine(fixture__source_db, immutable=True)
+    assert "immutable=1" in str(_import_helpers.engine.url)
+    results = get_les_data(ids=["0000002A"], columns=["ppsn", "start_date"])
+    assert list(results["start_date"]) == [pd.Timestamp("2016-02-01")]
 
 
-def test__get_ists_claims():
+def test__get_ists_claims(engine):
     date = pd.Timestamp("2016-01-01")
     query = f"""\
         SELECT ppsn, lr_code, clm_comm_date, lr_flag, date_of_birth
@@ -109,7 +144,7 @@ def test__get_ists_claims():
     #     assert str(results[col_name].dtype) == 'datetime64[ns]'
 
 
-def test__get_vital_statistics():
+def test__get_vital_statistics(engine):
     query = f"""\
         SELECT ppsn, date_of_birth, sex
             FROM ists_personal 
@@ -129,7 +164,7 @@ def test__get_vital_statistics():
     assert results.equals(expected)
 
 
-def test__get_les_data():
+def test__get_les_data(engine):
     test__inputs = pd.Index(
         ["6892436U", "5051366B", "6049367W", "5092934S", "8420262S",]
     )
@@ -172,7 +207,7 @@ def test__get_les_data():
     assert results.equals(expected)
 
 
-def test__get_jobpath_data():
+def test__get_jobpath_data(engine):
     test__sample = (
         pd.read_sql(
             "select ppsn, jobpath_start_date from jobpath_referrals",
@@ -198,7 +233,7 @@ def test__get_jobpath_data():
     assert results.equals(expected)
 
 
-def test__get_earnings():
+def test__get_earnings(engine):
     columns = ["ppsn", "NO_OF_CONS", "EARNINGS_AMT",]
     test_ids = pd.Index(
         ["6892436U", "5051366B", "6049367W", "5092934S", "8420262S",]
@@ -209,7 +244,7 @@ def test__get_earnings():
     assert len(results) > 0 
 
 
-def test__get_sw_payments():
+def test__get_sw_payments(engine):
     columns = ["ppsn", "SCHEME_TYPE", "AMOUNT",]
     test_ids = pd.Index(
         ["6892436U", "5051366B", "6049367W", "5092934S", "8420262S",]
@@ -221,3 +256,279 @@ def test__get_sw_payments():
     assert len(results) > 0
 
 
+
+
+def test__get_ists_claims_many(fixture__source_db):
+    set_source_engine(fixture__source_db)
+    dates = pd.to_datetime(["2016-01-01", "2016-01-03", "2016-01-10", "2016-02-05"])
+    columns = ["lr_code", "date_of_birth"]
+    results = get_ists_claims_many(dates, columns=columns)
+    assert list(results) == list(dates)
+    for date in dates:
+        expected = get_ists_claims(date, columns=columns)
+        # Categories can differ as each query finds its own set of codes
+        pd.testing.assert_frame_equal(
+            results[date].sort_index(), expected.sort_index(), check_categorical=False
+        )
+    assert list(results[pd.Timestamp("2016-01-10")].index) == ["0000001A", "0000003A"]
+
+    results = get_ists_claims_many(dates, ids=["0000002A"], lr_flag=False)
+    assert results[pd.Timestamp("2016-01-03")]["lr_date"].tolist() == ["2016-01-01"]
+    assert results[pd.Timestamp("2016-01-10")].empty
+
+
+def move_claims_to_partitions(source_db, partition_dir, frozen=()):
+    """Move all claims to per-year partition files, recording them as the ETL would"""
+    with sqlite3.connect(source_db) as con:
+        ddl = con.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'ists_claims'"
+        ).fetchone()[0]
+        years = [
+            int(row[0])
+            for row in con.execute(
+                "SELECT DISTINCT substr(lr_date, 1, 4) FROM ists_claims"
+            )
+        ]
+        con.execute(
+            "CREATE TABLE ists_partitions (year INTEGER PRIMARY KEY, frozen INTEGER)"
+        )
+        for year in years:
+            con.execute(
+                f"ATTACH DATABASE '{partition_dir}/ists_claims_{year}.db' AS part"
+            )
+            con.execute(ddl.replace("ists_claims", "part.ists_claims", 1))
+            con.execute(
+                "CREATE INDEX part.idx_ists_claims_lr_pid "
+                "ON ists_claims (lr_date, personal_id)"
+            )
+            con.execute(
+                "INSERT INTO part.ists_claims SELECT * FROM main.ists_claims "
+                f"WHERE lr_date LIKE '{year}%'"
+            )
+            con.execute(
+                "INSERT INTO ists_partitions VALUES (?, ?)", (year, year in frozen)
+            )
+            con.commit()
+            con.execute("DETACH DATABASE part")
+        con.execute("DELETE FROM ists_claims")
+    return years
+
+
+def test__get_ists_claims_many__partitioned(fixture__source_db, tmpdir):
+    set_source_engine(fixture__source_db)
+    dates = pd.to_datetime(["2016-01-01", "2016-01-10", "2016-02-05"])
+    columns = ["lr_code", "date_of_birth"]
+    expected = get_ists_claims_many(dates, columns=columns)
+
+    partition_dir = tmpdir.mkdir("partitions")
+    move_claims_to_partitions(fixture__source_db, partition_dir)
+
+    set_source_engine(fixture__source_db, ists_partition_dir=str(partition_dir))
+    results = get_ists_claims_many(dates, columns=columns)
+    for date in dates:
+        pd.testing.assert_frame_equal(
+            results[date].sort_index(),
+            expected[date].sort_index(),
+            check_categorical=False,
+        )
+
+
+def test__create_source_engine__finds_partitions(fixture__source_db, monkeypatch):
+    date = pd.Timestamp("2016-01-10")
+    set_source_engine(fixture__source_db)
+    expected = get_ists_claims(date, columns=["lr_code"])
+
+    # Partitions next to the database are found without being configured
+    partition_dir = os.path.join(
+        os.path.dirname(fixture__source_db), _import_helpers.ISTS_PARTITIONS_DIRNAME
+    )
+    os.mkdir(partition_dir)
+    move_claims_to_partitions(fixture__source_db, partition_dir)
+    set_source_engine(fixture__source_db)
+    pd.testing.assert_frame_equal(get_ists_claims(date, columns=["lr_code"]), expected)
+
+    # Elsewhere they're found through the environment variable...
+    moved_dir = os.path.join(os.path.dirname(fixture__source_db), "moved")
+    os.rename(partition_dir, moved_dir)
+    monkeypatch.setenv(_import_helpers.ISTS_PARTITIONS_ENV_VAR, moved_dir)
+    set_source_engine(fixture__source_db)
+    pd.testing.assert_frame_equal(get_ists_claims(date, columns=["lr_code"]), expected)
+
+    # ...and without it, reading just the (now empty) main table fails loudly
+    monkeypatch.delenv(_import_helpers.ISTS_PARTITIONS_ENV_VAR)
+    set_source_engine(fixture__source_db)
+    with pytest.raises(ValueError, match="aren't in a partition directory"):
+        get_ists_claims(date, columns=["lr_code"])
+
+
+def test__create_source_engine__frozen_partitions(
+    fixture__source_db, tmpdir, monkeypatch
+):
+    partition_dir = tmpdir.mkdir("partitions")
+    (year,) = move_claims_to_partitions(fixture__source_db, partition_dir)
+    sqlite3.connect(f"{partition_dir}/ists_claims_{year - 1}.db").close()
+    with sqlite3.connect(fixture__source_db) as con:
+        con.execute("INSERT INTO ists_partitions VALUES (?, 1)", (year - 1,))
+    ists_partition_uri = _import_helpers.ists_partition_uri
+    opened = {}
+
+    def recording_uri(path, frozen):
+        opened[os.path.basename(path)] = uri = ists_partition_uri(path, frozen)
+        return uri
+
+    monkeypatch.setattr(_import_helpers, "ists_partition_uri", recording_uri)
+    engine = create_source_engine(
+        fixture__source_db, ists_partition_dir=str(partition_dir)
+    )
+    with engine.connect() as con:
+        attached = [row[1] for row in con.execute("PRAGMA database_list")]
+    assert {f"p{year - 1}", f"p{year}"} <= set(attached)
+    # Only the year the ETL has frozen is opened as immutable
+    assert opened[f"ists_claims_{year - 1}.db"].endswith("?mode=ro&immutable=1")
+    assert opened[f"ists_claims_{year}.db"].endswith("?mode=ro")
+
+
+def test__get_ists_claims_many__more_partitions_than_attach_limit(
+    fixture__source_db, tmpdir
+):
+    set_source_engine(fixture__source_db)
+    dates = pd.to_datetime(["2016-01-01", "2016-01-10", "2016-02-05"])
+    columns = ["lr_code", "date_of_birth"]
+    expected = get_ists_claims_many(dates, columns=columns)
+
+    partition_dir = tmpdir.mkdir("partitions")
+    (year,) = move_claims_to_partitions(fixture__source_db, partition_dir)
+    # Empty earlier years, so there are more files than SQLite attaches by default
+    ddl = sqlite3.connect(fixture__source_db).execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'ists_claims'"
+    ).fetchone()[0]
+    old_years = range(year - _import_helpers.MAX_ATTACHED - 1, year)
+    for old_year in old_years:
+        with sqlite3.connect(f"{partition_dir}/ists_claims_{old_year}.db") as con:
+            con.execute(ddl)
+
+    set_source_engine(fixture__source_db, ists_partition_dir=str(partition_dir))
+    results = get_ists_claims_many(dates, columns=columns)
+    for date in dates:
+        pd.testing.assert_frame_equal(
+            results[date].sort_index(),
+            expected[date].sort_index(),
+            check_categorical=False,
+        )
+    # Dates spread over more years than can be attached at once
+    many_dates = [pd.Timestamp(f"{old_year}-06-01") for old_year in old_years]
+    results = get_ists_claims_many(many_dates + list(dates), columns=columns)
+    assert all(results[date].empty for date in many_dates)
+    pd.testing.assert_frame_equal(
+        results[dates[1]].sort_index(),
+        expected[dates[1]].sort_index(),
+        check_categorical=False,
+    )
+
+
+def test__temp_ids_con(fixture__source_db):
+    engine = set_source_engine(fixture__source_db)
+    # More ids than SQLite allows bound variables in one query
+    ids = [f"{i:07d}A" for i in range(5000)]
+    with temp_ids_con(engine, ids) as con:
+        assert con.execute("SELECT COUNT(*) FROM temp.ids").scalar() == 5000
+        con.execute("INSERT INTO temp.ids VALUES ('reused')")
+    # Same ids (in any order) on same pooled connection aren't loaded again
+    with temp_ids_con(engine, reversed(ids)) as con:
+        assert con.execute("SELECT COUNT(*) FROM temp.ids").scalar() == 5001
+    with temp_ids_con(engine, ids[:10]) as con:
+        assert con.execute("SELECT COUNT(*) FROM temp.ids").scalar() == 10
+
+    results = get_les_data(ids=ids, columns=["ppsn", "start_date"])
+    assert list(results["ppsn"]) == ["0000001A", "0000002A"]
+    results = get_ists_claims(pd.Timestamp("2016-01-08"), ids=ids[2:])
+    assert list(results.index) == ["0000003A"]
+
+
+def test__get_earnings__chunks(fixture__source_db):
+    set_source_engine(fixture__source_db)
+    # Records with any error flag set are excluded
+    results = get_earnings(columns=["CON_YEAR", "EARNINGS_AMT"])
+    assert list(results["EARNINGS_AMT"]) == [1000, 500, 2000, 300]
+    assert set(results.columns) == {"ppsn", "CON_YEAR", "EARNINGS_AMT"}
+
+    chunks = list(get_earnings(columns=["CON_YEAR", "EARNINGS_AMT"], chunksize=3))
+    assert [len(chunk) for chunk in chunks] == [3, 1]
+    assert all(chunk["CON_YEAR"].dtype == "float64" for chunk in chunks)
+    assert pd.concat(chunks, ignore_index=True).equals(results)
+
+    results = get_earnings_totals(ids=["0000001A", "0000002A"], chunksize=2)
+    assert results["EARNINGS_AMT"].to_dict() == {
+        ("0000001A", 2015): 1500,
+        ("0000001A", 2016): 2000,
+        ("0000002A", 2015): 300,
+    }
+
+
+def test__get_sw_payments__chunks(fixture__source_db):
+    set_source_engine(fixture__source_db)
+    chunks = list(get_sw_payments(columns=["AMOUNT", "QTR"], chunksize=2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    # All-null chunk still gets float AMOUNT
+    assert chunks[-1]["AMOUNT"].dtype == "float64"
+
+    results = get_sw_payments_totals(period="2016Q1")
+    assert list(results.index) == [
+        ("0000001A", 2016),
+        ("0000002A", 2016),
+        ("0000003A", 2016),
+    ]
+    results = get_sw_payments_totals(ids=["0000001A"], chunksize=1)
+    assert results["AMOUNT"].to_dict() == {
+        ("0000001A", 2015): 100,
+        ("0000001A", 2016): 500,
+    }
+
+
+def test__get_earnings_summary(fixture__source_db):
+    set_source_engine(fixture__source_db)
+    results = get_earnings_summary(ids=["0000001A", "0000002A"], years=[2016])
+    assert results["EARNINGS_AMT"].to_dict() == {
+        ("0000001A", 2016, "a"): 1200,
+        ("0000001A", 2016, "s"): 800,
+    }
+    results = get_earnings_summary(wide=True)
+    assert list(results.columns) == ["earn_a", "earn_s", "earn_other"]
+    assert results.loc[("0000002A", 2015)].to_list() == [0, 0, 300]
+    assert len(results) == 4
+
+
+def test__get_sw_payments_summary(fixture__source_db):
+    set_source_engine(fixture__source_db)
+    results = get_sw_payments_summary(
+        ids=["0000001A"], periods=[pd.Period("2016Q1")], schemes=["JA"]
+    )
+    assert results["AMOUNT"].to_dict() == {("0000001A", "2016Q1", "JA"): 150}
+    assert len(get_sw_payments_summary(periods=["2016Q1"])) == 3
+
+
+def test__get_clusters(fixture__source_db):
+    set_source_engine(fixture__source_db)
+    results = get_clusters(pd.Timestamp("2016-01-01"))
+    assert list(results.columns) == ["ppsn", "date", "cluster"]
+    assert results.set_index("ppsn")["cluster"].to_dict() == {
+        "0000001A": 1,
+        "0000002A": 3,
+    }
+    # No extract on this date
+    assert get_clusters(pd.Timestamp("2016-02-01")).empty
+
+
+def test__get_clusters_many(fixture__source_db):
+    set_source_engine(fixture__source_db)
+    dates = pd.to_datetime(["2015-12-01", "2016-02-01", "2016-04-01", "2016-06-01"])
+    results = get_clusters_many(dates, ids=["0000001A", "0000003A"], how="previous")
+    assert list(results) == list(dates)
+    assert results[dates[0]].empty
+    assert results[dates[1]]["cluster"].to_list() == [1]
+    assert (results[dates[1]]["date"] == pd.Timestamp("2016-01-01")).all()
+    for date in dates[2:]:
+        assert results[date].set_index("ppsn")["cluster"].to_dict() == {
+            "0000001A": 2,
+            "0000003A": 5,
+        }
@@ -0,0 +1,98 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from evaluation_jp.data import (
+    _ists_snapshots,
+    set_source_engine,
+    set_ists_snapshot_dir,
+    write_ists_snapshots,
+    read_ists_snapshot,
+    get_ists_claims,
+    get_ists_claims_many,
+)
+
+
+@pytest.fixture
+def fixture__ists_snapshot_dir(fixture__source_db, tmpdir, monkeypatch):
+    monkeypatch.setattr(_ists_snapshots, "_ists_snapshot_dir", None)
+    set_source_engine(fixture__source_db)
+    return f"{tmpdir}/snapshots"
+
+
+def test__write_ists_snapshots(fixture__ists_snapshot_dir):
+    lr_dates = pd.to_datetime(["2016-01-01", "2016-01-08"])
+    # Compare with database before snapshots are in use
+    expected = {
+        lr_date: get_ists_claims(lr_date, lr_flag=False).sort_index()
+        for lr_date in lr_dates
+    }
+    paths = write_ists_snapshots(lr_dates, directory=fixture__ists_snapshot_dir)
+    assert [path.name for path in paths] == [
+        "ists_2016-01-01.arrow",
+        "ists_2016-01-08.arrow",
+    ]
+    assert read_ists_snapshot(lr_dates[0]) is None
+
+    set_ists_snapshot_dir(fixture__ists_snapshot_dir)
+    for lr_date in lr_dates:
+        results = read_ists_snapshot(lr_date, lr_flag=False).sort_index()
+        assert list(results.index) == list(expected[lr_date].index)
+        assert results["lr_code"].dtype == "category"
+        assert results["date_of_birth"].equals(expected[lr_date]["date_of_birth"])
+
+    results = read_ists_snapshot(lr_dates[0], columns=["lr_code"])
+    assert list(results.columns) == ["lr_code", "lr_flag"]
+    assert list(results.index) == ["0000001A", "0000002A"]
+    results = read_ists_snapshot(lr_dates[0], ids=["0000002A", "0000003A"])
+    assert list(results.index) == ["0000002A"]
+
+
+def test__read_ists_snapshot__same_as_database(
+    fixture__source_db, fixture__ists_snapshot_dir
+):
+    # Several records per ppsn, where the first isn't always on the Live Register
+    with sqlite3.connect(fixture__source_db) as con:
+        con.execute(
+            """\
+            INSERT INTO ists_claims VALUES
+                (7, '2016-01-15', 'UA', 0, 1),
+                (8, '2016-01-15', 'UB', 1, 1),
+                (9, '2016-01-15', 'UC', 1, 1),
+                (10, '2016-01-15', 'UA', 1, 2),
+                (11, '2016-01-15', 'UB', 0, 2),
+                (12, '2016-01-15', 'UC', 0, 3)
+            """
+        )
+    lr_date = pd.Timestamp("2016-01-15")
+    expected = {
+        lr_flag: get_ists_claims(lr_date, lr_flag=lr_flag).sort_index()
+        for lr_flag in [True, False]
+    }
+    write_ists_snapshots([lr_date], directory=fixture__ists_snapshot_dir)
+    set_ists_snapshot_dir(fixture__ists_snapshot_dir)
+    for lr_flag in [True, False]:
+        results = read_ists_snapshot(lr_date, lr_flag=lr_flag).sort_index()
+        assert list(results.index) == list(expected[lr_flag].index)
+        assert list(results["lr_code"]) == list(expected[lr_flag]["lr_code"])
+    assert list(expected[False]["lr_code"]) == ["UA", "UA", "UC"]
+    assert list(expected[True]["lr_code"]) == ["UB", "UA"]
+
+
+def test__get_ists_claims__snapshot(fixture__ists_snapshot_dir):
+    write_ists_snapshots(
+        [pd.Timestamp("2016-01-01")], directory=fixture__ists_snapshot_dir
+    )
+    set_ists_snapshot_dir(fixture__ists_snapshot_dir)
+    # Database reads give object lr_code, so it's clear which path each date took
+    results = get_ists_claims(pd.Timestamp("2016-01-03"), columns=["lr_code"])
+    assert list(results.index) == ["0000001A", "0000002A"]
+    # Only dates without snapshots are read from the database
+    results = get_ists_claims_many(
+        pd.to_datetime(["2016-01-03", "2016-01-10"]), columns=["lr_code"]
+    )
+    assert list(results[pd.Timestamp("2016-01-03")].index) == ["0000001A", "0000002A"]
+    assert list(results[pd.Timestamp("2016-01-10")].index) == ["0000001A", "0000003A"]
+    assert results[pd.Timestamp("2016-01-03")]["lr_code"].dtype == "category"
+    assert results[pd.Timestamp("2016-01-10")]["lr_code"].dtype == object
@@ -5,14 +5,12 @@ import numpy as np
 import pandas as pd
 import sqlalchemy as sa
 
-from evaluation_jp.data import ModelDataHandler, datetime_cols
+from evaluation_jp.data import ModelDataHandler, datetime_cols, table_columns
 from evaluation_jp.models import PopulationSlice, PopulationSliceID
 
 
-def test__datetime_cols():
-    engine = sa.create_engine(
-        "sqlite:///\\\\cskma0294\\F\\Evaluations\\data\\wwld.db", echo=False
-    )
+def test__datetime_cols(fixture__production_engine):
+    engine = fixture__production_engine
     test__inputs = ["les", "ists_personal", "jobpath_referrals"]
     results = {
         table_name: set(datetime_cols(engine, table_name))
@@ -36,6 +34,22 @@ def test__datetime_cols():
     assert results == expected
 
 
+def test__table_columns(tmpdir):
+    """Column metadata is cached until the schema changes
+    """
+    engine = sa.create_engine(f"sqlite:///{tmpdir}/test.db")
+    engine.execute("CREATE TABLE people (ppsn TEXT, date_of_birth DATETIME)")
+    results = table_columns(engine, "people")
+    assert [col["name"] for col in results] == ["ppsn", "date_of_birth"]
+    assert table_columns(engine, "people") is results
+    assert datetime_cols(engine, "people") == ["date_of_birth"]
+
+    engine.execute("ALTER TABLE people ADD COLUMN start_date DATETIME")
+    results = table_columns(engine, "people")
+    assert [col["name"] for col in results] == ["ppsn", "date_of_birth", "start_date"]
+    assert datetime_cols(engine, "people") == ["date_of_birth", "start_date"]
+
+
 def test__ModelDataHandler__init(tmpdir):
     """Simple test to make sure everything gets initiated correctly
     """
@@ -0,0 +1,59 @@
+import threading
+
+import pandas as pd
+
+from evaluation_jp.data import (
+    Source,
+    SourceFetcher,
+    fetch_source,
+    source_fetching,
+    set_source_engine,
+    get_les_data,
+)
+
+
+def test__Source():
+    def read(*args, **kwargs):
+        return args, kwargs
+
+    source = Source.of(read, 1, columns={"b": 0, "a": 1}.keys())
+    # Same call is same source, whatever the type of `columns`
+    assert source == Source.of(read, 1, columns=["b", "a"])
+    assert len({source, Source.of(read, 1, columns=("b", "a"))}) == 1
+    assert source() == ((1,), {"columns": ("b", "a")})
+
+
+def test__SourceFetcher():
+    threads = []
+
+    def read(value):
+        threads.append(threading.current_thread().name)
+        return pd.DataFrame({"value": [value]})
+
+    fetcher = SourceFetcher()
+    fetcher.prefetch([Source.of(read, 1), Source.of(read, 2), Source.of(read, 1)])
+    first = fetcher.fetch(Source.of(read, 1))
+    first["value"] = 0
+    # Each fetch gets a copy of the prefetched result
+    assert fetcher.fetch(Source.of(read, 1))["value"].tolist() == [1]
+    assert fetcher.fetch(Source.of(read, 2))["value"].tolist() == [2]
+    assert len(threads) == 2
+    assert all(name.startswith("SourceFetcher") for name in threads)
+    # Sources not prefetched are read directly
+    fetcher.prefetch([Source.of(read, 2)])
+    assert fetcher.fetch(Source.of(read, 1))["value"].tolist() == [1]
+    assert threads[-1] == threading.current_thread().name
+    fetcher.close()
+
+
+def test__source_fetching(fixture__source_db):
+    set_source_engine(fixture__source_db)
+    source = Source.of(get_les_data, columns=["start_date"])
+    expected = fetch_source(source)
+    with source_fetching() as fetcher:
+        fetcher.prefetch([source])
+        # Read on worker thread with its own pooled connection
+        pd.testing.assert_frame_equal(fetch_source(source), expected)
+    with source_fetching(enabled=False) as fetcher:
+        assert fetcher is None
+        pd.testing.assert_frame_equal(fetch_source(source), expected)
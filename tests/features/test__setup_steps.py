@@ -27,7 +27,7 @@ from evaluation_jp.models import (
     TreatmentPeriodGenerator,
     EvaluationModel,
 )
-from evaluation_jp.data import ModelDataHandler
+from evaluation_jp.data import ModelDataHandler, set_source_engine
 
 # TODO test__NearestKeyDict()
 
@@ -69,6 +69,82 @@ def fixture__live_register_population(fixture__population_slice):
     return live_register_population.run(data_id=fixture__population_slice.id)
 
 
+def test__LiveRegisterPopulation__prefetch(monkeypatch):
+    """With prefetch, all slices' LR populations come from one batched query"""
+    calls = []
+
+    def fake_get_ists_claims_many(dates, columns=None):
+        calls.append(list(dates))
+        return {
+            date: pd.DataFrame(
+                {"lr_code": ["UA"], "lr_flag": [True]},
+                index=pd.Index([f"{date.month:07d}A"], name="ppsn"),
+            )
+            for date in dates
+        }
+
+    def fake_get_ists_claims(date, columns=None):
+        raise AssertionError("get_ists_claims() called for prefetched date")
+
+    monkeypatch.setattr(
+        "evaluation_jp.features._setup_steps.get_ists_claims_many",
+        fake_get_ists_claims_many,
+    )
+    monkeypatch.setattr(
+        "evaluation_jp.features._setup_steps.get_ists_claims", fake_get_ists_claims
+    )
+    population_slice_generator = PopulationSliceGenerator(
+        start=pd.Timestamp("2016-01-01"),
+        end=pd.Timestamp("2016-12-31"),
+        setup_steps_by_date={
+            pd.Timestamp("2016-01-01"): SetupSteps(
+                [LiveRegisterPopulation(columns_by_type={"lr_code": "category"})]
+            )
+        },
+        prefetch=True,
+    )
+    results = list(population_slice_generator.run())
+    assert len(calls) == 1
+    assert calls[0] == list(population_slice_generator.date_range)
+    assert [list(s.data.index) for s in results] == [
+        ["0000001A"],
+        ["0000004A"],
+        ["0000007A"],
+        ["0000010A"],
+    ]
+
+
+def test__PopulationSliceGenerator__fetch_ahead(fixture__source_db):
+    """Fetching ahead gives same slices as reading sources one after another"""
+    set_source_engine(fixture__source_db)
+    setup_steps_by_date = {
+        pd.Timestamp("2016-01-01"): SetupSteps(
+            [
+                LiveRegisterPopulation(
+                    columns_by_type={
+                        "lr_code": "category",
+                        "date_of_birth": "datetime64",
+                    }
+                ),
+                OnLES(assumed_episode_length={"years": 1}),
+            ]
+        )
+    }
+    results = {}
+    for fetch_ahead in [False, True]:
+        population_slice_generator = PopulationSliceGenerator(
+            start=pd.Timestamp("2016-01-01"),
+            end=pd.Timestamp("2016-01-08"),
+            freq="7D",
+            setup_steps_by_date=setup_steps_by_date,
+            fetch_ahead=fetch_ahead,
+        )
+        results[fetch_ahead] = list(population_slice_generator.run())
+    for expected, population_slice in zip(results[False], results[True]):
+        pd.testing.assert_frame_equal(population_slice.data, expected.data)
+    assert results[True][1].data["on_les"].any()
+
+
 def test__LiveRegisterPopulation(fixture__live_register_population):
     """Check that number of people on LR == official total per CSO, and correct columns generated
     """
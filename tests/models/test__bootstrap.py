@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from evaluation_jp.models import Bootstrap
+
+
+@pytest.fixture
+def fixture__impact_data():
+    rng = np.random.RandomState(0)
+    n = 4000
+    data = pd.DataFrame(
+        {
+            "evaluation_group": np.where(rng.uniform(size=n) < 0.3, "T", "C"),
+            "cluster": rng.randint(0, 3, size=n),
+            "weight": rng.uniform(0.5, 1.5, size=n),
+            "earnings": rng.normal(1000, 200, size=n),
+        }
+    )
+    data["income"] = data["earnings"] + rng.normal(0, 50, size=n)
+    data.loc[data["evaluation_group"] == "T", "earnings"] += 100
+    return data
+
+
+def weighted_diff(data, col):
+    means = {}
+    for group, group_data in data.groupby("evaluation_group"):
+        means[group] = np.average(group_data[col], weights=group_data["weight"])
+    return means["T"] - means["C"]
+
+
+@pytest.mark.parametrize("method", ["poisson", "multinomial"])
+def test__Bootstrap(fixture__impact_data, method):
+    data = fixture__impact_data
+    results = Bootstrap(n_replicates=200, block_size=30, method=method).run(
+        data, ["earnings", "income"], by="cluster"
+    )
+    assert list(results.index) == [0, 1, 2]
+    for cluster, cluster_data in data.groupby("cluster"):
+        for col in ["earnings", "income"]:
+            impact = results.loc[cluster, (col, "impact")]
+            assert np.isclose(impact, weighted_diff(cluster_data, col))
+            assert results.loc[cluster, (col, "lower")] < impact
+            assert impact < results.loc[cluster, (col, "upper")]
+            # Roughly the unweighted standard error of a difference in means
+            group_size = cluster_data["evaluation_group"].value_counts()
+            approx_se = 200 * np.sqrt(1 / group_size["T"] + 1 / group_size["C"])
+            se = results.loc[cluster, (col, "se")]
+            assert 0.7 * approx_se < se < 1.5 * approx_se
+
+
+def test__Bootstrap__deterministic(fixture__impact_data):
+    data = fixture__impact_data
+    one_process = Bootstrap(n_replicates=40, block_size=15, n_jobs=1, seed=1)
+    two_processes = Bootstrap(n_replicates=40, block_size=15, n_jobs=2, seed=1)
+    replicates = one_process.replicates(data, ["earnings"])
+    assert replicates.shape == (40, 1, 1)
+    assert np.array_equal(replicates, two_processes.replicates(data, ["earnings"]))
+    other_seed = Bootstrap(n_replicates=40, block_size=15, n_jobs=1, seed=2)
+    assert not np.array_equal(replicates, other_seed.replicates(data, ["earnings"]))
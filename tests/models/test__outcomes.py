@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from evaluation_jp.models import (
+    EvaluationModel,
+    OutcomeGenerator,
+    Weighting,
+    WeightBackPropagation,
+)
+
+
+def requested_columns(df, columns):
+    """Like the get_{data}() helpers, just `columns` (if given) plus ppsn"""
+    if columns is None:
+        return df
+    return df[[col for col in df.columns if col == "ppsn" or col in columns]]
+
+
+def fake_get_earnings(ids=None, year=None, columns=None):
+    """Two CON_YEARs of earnings per person, equal to 1000 x person number, and a
+    record without a CON_YEAR
+    """
+    amounts = np.array([int(ppsn[:7]) for ppsn in ids], dtype=float) * 1000
+    earnings = pd.DataFrame(
+        {
+            "ppsn": np.repeat(ids, 3),
+            "CON_YEAR": np.tile([2016.0, 2017.0, np.nan], len(ids)),
+            "EARNINGS_AMT": np.repeat(amounts, 3),
+            "NO_OF_CONS": 52.0,
+        }
+    )
+    return requested_columns(earnings, columns)
+
+
+def fake_get_sw_payments(ids=None, period=None, columns=None):
+    """Payment of 100 per person in 2016Q2 and a payment outside outcome quarters"""
+    payments = pd.DataFrame(
+        {
+            "ppsn": np.repeat(ids, 2),
+            "QTR": np.tile(["2016Q2", "2019Q1"], len(ids)),
+            "AMOUNT": 100.0,
+            "SCHEME_TYPE": "JA",
+        }
+    )
+    return requested_columns(payments, columns)
+
+
+@pytest.fixture
+def fixture__outcome_generator(monkeypatch):
+    monkeypatch.setattr("evaluation_jp.models.outcomes.get_earnings", fake_get_earnings)
+    monkeypatch.setattr(
+        "evaluation_jp.models.outcomes.get_sw_payments", fake_get_sw_payments
+    )
+    return OutcomeGenerator(
+        start=pd.Period("2016Q1"), end=pd.Period("2017Q4"), chunksize=300
+    )
+
+
+def test__OutcomeGenerator__aggregate(fixture__outcome_generator):
+    people = pd.Index([f"{i:07d}A" for i in range(1000)])
+    results = fixture__outcome_generator.aggregate(people)
+    assert results["earnings"].shape == (1000, 8)
+    assert (results["earnings"].dtypes == np.float32).all()
+    # Annual earnings are spread evenly over the 4 quarters of each year
+    assert results["earnings"].loc["0000999A", pd.Period("2017Q3")] == 250 * 999
+    # Records without a CON_YEAR are left out
+    assert results["earnings"].loc["0000999A"].sum() == 2000 * 999
+    assert results["sw_payments"].sum(axis="columns").eq(100).all()
+    assert results["sw_payments"][pd.Period("2016Q2")].eq(100).all()
+
+
+def test__OutcomeGenerator__run__no_treatment_periods(fixture__outcome_generator):
+    assert fixture__outcome_generator.run({}) == {}
+
+
+def test__EvaluationModel__add_outcomes(
+    fixture__evaluation_treatment_periods, fixture__outcome_generator
+):
+    evaluation_model = EvaluationModel(
+        weighting=Weighting(score_col="score", n_bins=5),
+        weight_back_propagation=WeightBackPropagation(),
+        outcome_generator=fixture__outcome_generator,
+    )
+    evaluation_model.treatment_periods = fixture__evaluation_treatment_periods
+    evaluation_model.add_weights()
+    evaluation_model.back_propagate_weights()
+    evaluation_model.add_outcomes()
+
+    earnings = fixture__outcome_generator.outcomes["earnings"]
+    for t_period in evaluation_model.treatment_periods.values():
+        results = t_period.outcomes["earnings"]
+        t_group = t_period.data.index[t_period.data["evaluation_group"] == "T"]
+        assert np.allclose(results["T"], earnings.loc[t_group].mean())
+        # C group outcomes are weighted by back-propagated counterfactual weights
+        weights = evaluation_model.weight_back_propagation.counterfactual_weights(
+            evaluation_model.treatment_periods, t_period.id
+        )
+        expected = earnings.loc[weights.index].mul(weights, axis="index").sum()
+        assert np.allclose(results["C"], expected / weights.sum())
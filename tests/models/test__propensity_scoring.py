@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+from evaluation_jp.models import EvaluationModel, PropensityScoring, Weighting
+
+
+def add_features(treatment_periods):
+    for t_period in treatment_periods.values():
+        t_period.data["sex"] = np.where(t_period.data["score"] > 0.5, "M", "F")
+    return treatment_periods
+
+
+def test__PropensityScoring(fixture__evaluation_treatment_periods):
+    treatment_periods = add_features(fixture__evaluation_treatment_periods)
+    propensity_scoring = PropensityScoring(features=["score", "sex"])
+    results = propensity_scoring.run(treatment_periods)
+
+    assert list(results) == list(treatment_periods)
+    for t_period_id, scores in results.items():
+        data = treatment_periods[t_period_id].data
+        assert scores.index.equals(data.index)
+        assert scores.dtype == np.float32
+        assert ((scores > 0) & (scores < 1)).all()
+        # T more likely with higher score so propensity increases with score
+        assert np.corrcoef(scores, data["score"])[0, 1] > 0.5
+    # Everything cached for this fingerprint
+    assert len(propensity_scoring.cache) == len(treatment_periods)
+
+
+def test__PropensityScoring__cache(fixture__evaluation_treatment_periods):
+    treatment_periods = add_features(fixture__evaluation_treatment_periods)
+    propensity_scoring = PropensityScoring(features=["score", "sex"])
+    first = propensity_scoring.run(treatment_periods)
+    cached = {key: value[0] for key, value in propensity_scoring.cache.items()}
+    second = propensity_scoring.run(treatment_periods)
+    for t_period_id, scores in second.items():
+        assert scores is first[t_period_id]
+    # Different feature set gets its own scores
+    propensity_scoring.features = ["score"]
+    propensity_scoring.run(treatment_periods)
+    assert len(propensity_scoring.cache) == 2 * len(cached)
+
+
+def test__EvaluationModel__add_propensity_scores(fixture__evaluation_treatment_periods):
+    evaluation_model = EvaluationModel(
+        propensity_scoring=PropensityScoring(features=["score", "sex"]),
+        weighting=Weighting(score_col="propensity", n_bins=10),
+    )
+    evaluation_model.treatment_periods = add_features(
+        fixture__evaluation_treatment_periods
+    )
+    evaluation_model.add_propensity_scores()
+    evaluation_model.add_weights()
+    for t_period in evaluation_model.treatment_periods.values():
+        assert t_period.data["propensity"].notna().all()
+        assert pd.api.types.is_float_dtype(t_period.weights["weight"])
+
+
+def test__PropensityScoring__cache_data(fixture__evaluation_treatment_periods):
+    treatment_periods = add_features(fixture__evaluation_treatment_periods)
+    propensity_scoring = PropensityScoring(features=["score", "sex"])
+    first = propensity_scoring.run(treatment_periods)
+    # Same periods with a record dropped from the last one are scored again
+    last = list(treatment_periods)[-1]
+    data = treatment_periods[last].data
+    treatment_periods[last].data = data.drop(data.index[0])
+    second = propensity_scoring.run(treatment_periods)
+    assert second[last] is not first[last]
+    assert second[last].index.equals(treatment_periods[last].data.index)
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+from evaluation_jp.models import EvaluationModel, Weighting, WeightBackPropagation
+
+
+def test__Weighting(fixture__evaluation_treatment_periods):
+    treatment_periods = fixture__evaluation_treatment_periods
+    results = Weighting(score_col="score", n_bins=10).run(treatment_periods)
+
+    assert list(results) == list(treatment_periods)
+    for t_period_id, weights in results.items():
+        data = treatment_periods[t_period_id].data.loc[weights.index]
+        t_weights = weights.loc[data["evaluation_group"] == "T"]
+        c_weights = weights.loc[data["evaluation_group"] == "C"]
+        # All T records are kept, each with weight 1
+        assert len(t_weights) == (
+            treatment_periods[t_period_id].data["evaluation_group"] == "T"
+        ).sum()
+        assert (t_weights["weight"] == 1).all()
+        # Weighted C records add up to the number of T records in each bin
+        t_by_bin = t_weights.groupby("bin")["weight"].sum()
+        c_by_bin = c_weights.groupby("bin")["weight"].sum()
+        assert np.allclose(c_by_bin, t_by_bin.loc[c_by_bin.index])
+
+
+def test__Weighting__bins_and_outliers():
+    data = pd.DataFrame(
+        {
+            "evaluation_group": ["T"] * 4 + ["C"] * 6,
+            "score": [0.2, 0.4, 0.6, 0.8, 0.1, 0.3, 0.3, 0.5, 0.8, 0.9],
+        }
+    )
+    data["period"] = 0
+    results = Weighting(score_col="score", n_bins=2).weight_stacked(data)
+    # C scoring 0.1 (below lowest T) and 0.9 (above highest T) are excluded
+    assert list(results.index) == [0, 1, 2, 3, 5, 6, 7, 8]
+    assert list(results["bin"]) == [0, 0, 1, 1, 0, 0, 0, 1]
+    # Bin 0 has 2 T and 3 C, bin 1 has 2 T and 1 C
+    assert np.allclose(results["weight"], [1, 1, 1, 1, 2 / 3, 2 / 3, 2 / 3, 2])
+
+
+def test__EvaluationModel__add_weights(fixture__evaluation_treatment_periods):
+    evaluation_model = EvaluationModel(weighting=Weighting(score_col="score"))
+    evaluation_model.treatment_periods = fixture__evaluation_treatment_periods
+    evaluation_model.add_weights()
+    for t_period in evaluation_model.treatment_periods.values():
+        assert set(t_period.weights.columns) == {"bin", "weight"}
+        assert t_period.weights.index.isin(t_period.data.index).all()
+
+
+def naive_counterfactual_weights(chain, origin):
+    """Hand weight from later T to later C one period and one bin at a time"""
+    weights = chain[origin].weights
+    group = chain[origin].data.loc[weights.index, "evaluation_group"]
+    mass = weights.loc[group == "C", "weight"]
+    for t_period in chain[origin + 1 :]:
+        group = t_period.data.loc[t_period.weights.index, "evaluation_group"]
+        t_weights = t_period.weights.loc[group == "T"]
+        c_weights = t_period.weights.loc[group == "C"]
+        treated = mass.index.intersection(t_weights.index)
+        arriving = mass.loc[treated].groupby(t_weights.loc[treated, "bin"]).sum()
+        t_counts = t_weights.groupby("bin")["weight"].sum()
+        for b, amount in arriving.items():
+            in_bin = c_weights.loc[c_weights["bin"] == b, "weight"]
+            mass = mass.add(amount * in_bin / t_counts[b], fill_value=0)
+        mass = mass.drop(treated)
+    return mass
+
+
+def test__WeightBackPropagation(fixture__evaluation_treatment_periods):
+    evaluation_model = EvaluationModel(
+        weighting=Weighting(score_col="score", n_bins=5),
+        weight_back_propagation=WeightBackPropagation(),
+    )
+    evaluation_model.treatment_periods = fixture__evaluation_treatment_periods
+    evaluation_model.add_weights()
+    evaluation_model.back_propagate_weights()
+
+    chain = list(evaluation_model.treatment_periods.values())
+    for origin, t_period in enumerate(chain):
+        assert list(t_period.counterfactual_factors.columns) == [
+            earlier.id.time_period for earlier in chain[:origin]
+        ]
+        results = evaluation_model.weight_back_propagation.counterfactual_weights(
+            evaluation_model.treatment_periods, t_period.id
+        )
+        expected = naive_counterfactual_weights(chain, origin)
+        assert results.index.sort_values().equals(expected.index.sort_values())
+        assert np.allclose(results.sort_index(), expected.sort_index())
+        # Every bin has C records so counterfactual weight adds up to size of T group
+        assert np.isclose(
+            results.sum(), (t_period.data["evaluation_group"] == "T").sum()
+        )